@@ -0,0 +1,65 @@
+"""
+Compare the number of GeoTIFF blocks decoded when an image is split into
+row chunks evenly versus on block boundaries.
+
+Usage: python benchmarks/decode_volume.py covariate.tif -n 16
+"""
+import time
+
+import click
+import numpy as np
+
+from uncoverml import geoio
+from uncoverml.image import Image, construct_splits
+
+
+def decoded_blocks(source, splits):
+    """Total blocks touched by reading every row window in splits."""
+    block_cols, block_rows = source.block_shape
+    res_x, res_y = source.full_resolution[:2]
+    n_cols = -(-res_x // block_cols)
+    total = 0
+    for ymin, ymax in splits:
+        # file rows are flipped relative to image rows
+        first = (res_y - ymax) // block_rows
+        last = (res_y - ymin - 1) // block_rows
+        total += (last - first + 1) * n_cols
+    return total
+
+
+def read_time(source, nchunks, block_rows):
+    start = time.time()
+    for i in range(nchunks):
+        Image(source, i, nchunks, block_rows=block_rows).data()
+    geoio.close_datasets()
+    return time.time() - start
+
+
+@click.command()
+@click.argument('geotiff')
+@click.option('-n', '--nchunks', type=int, default=16,
+              help='number of row chunks (ranks x partitions)')
+def main(geotiff, nchunks):
+    source = geoio.RasterioImageSource(geotiff)
+    block_rows = source.block_shape[1]
+    offset = source.block_offset(block_rows)
+    res_y = source.full_resolution[1]
+    n_blocks = decoded_blocks(source, [(0, res_y)])
+
+    even = construct_splits(res_y, nchunks)
+    aligned = construct_splits(res_y, nchunks, block_rows=block_rows,
+                               block_offset=offset)
+    click.echo("{} blocks of shape {}".format(n_blocks, source.block_shape))
+    for name, splits, rows in [('even', even, None),
+                               ('aligned', aligned, block_rows)]:
+        n = decoded_blocks(source, splits)
+        click.echo("{:>8}: {} blocks decoded ({:.1%} redundant), "
+                   "{:.2f}s".format(name, n, n / n_blocks - 1,
+                                    read_time(source, nchunks, rows)))
+    sizes = np.diff(np.array(aligned), axis=1).ravel()
+    click.echo("aligned chunk rows: min {} max {}".format(sizes.min(),
+                                                          sizes.max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@
 import numpy as np
 from sklearn.metrics import r2_score
 
-from uncoverml.cubist import Cubist, MultiCubist
+from uncoverml.cubist import Cubist, MultiCubist, Rule, RuleSet, save_array
 
 # Declare some test data taken from the boston houses dataset
 x = np.array([
@@ -93,3 +93,30 @@ def test_multicibist_mpi(mpisync):
     score = r2_score(y, y_pred_p)
 
     assert 0.5 < score < 0.8
+
+
+def test_rule_set():
+    rules = [Rule('="2"\n'
+                  'type="2" att="f0.tif_0" cut="0.1" result="<"\n'
+                  'type="3" att="f7.tif_7" elts="1","3"\n'
+                  'coeff="1.5" att="f4.tif_4" coeff="2"\n', 10),
+             Rule('="1"\n'
+                  'type="2" att="f1.tif_1" cut="10" result=">="\n'
+                  'coeff="-3" att="f0.tif_0" coeff="0.5" '
+                  'att="f9.tif_9" coeff="0.1"\n', 10),
+             Rule('="0"\n'
+                  'coeff="2"\n', 10)]
+    y_rules = np.zeros(len(x))
+    for rule in rules:
+        mask = rule.satisfied(x)
+        y_rules[mask] += rule.regress(x, mask)
+
+    rule_set = RuleSet(rules)
+    rule_set.chunk_rows = 4
+    assert np.allclose(rule_set.predict(x), y_rules)
+
+
+def test_save_array(tmpdir):
+    filename = str(tmpdir.join('x.data'))
+    save_array(filename, x, chunk_rows=4)
+    assert np.array_equal(np.loadtxt(filename, delimiter=','), x)
@@ -1,10 +1,14 @@
+import os
+import time
 import pytest
 from affine import Affine
 import numpy as np
 import rasterio
+import shapefile as shp
 
 from uncoverml import geoio
-from uncoverml.image import Image
+from uncoverml import features
+from uncoverml.image import Image, construct_splits, _coord2pix
 
 crs = rasterio.crs.CRS({'init': 'epsg:4326'})
 
@@ -151,6 +155,24 @@ def test_load_shapefile(shapefile):
         assert all(vals == i)
 
 
+def test_read_dbf_encoding(random_filename):
+    filename = random_filename(ext='.shp')
+    w = shp.Writer(shp.POINT)
+    w.field('name', 'C', 20)
+    w.point(0., 0.)
+    w.record(name='Zürich')
+    w.save(filename)
+    dbf = filename.rsplit('.', 1)[0] + '.dbf'
+    columns, _ = geoio._read_dbf(dbf)
+    assert columns['name'][0] == 'Zürich'
+
+    # a .cpg file names the encoding
+    with open(filename.rsplit('.', 1)[0] + '.cpg', 'w') as f:
+        f.write('ISO-8859-1\n')
+    columns, _ = geoio._read_dbf(dbf)
+    assert columns['name'][0] == 'Zürich'.encode('utf-8').decode('latin-1')
+
+
 def test_array_image_src():
     res_x = 1000
     res_y = 500
@@ -244,3 +266,560 @@ def test_Image_split_overlap(array_image_src, num_chunks, overlap_pixels):
     Irecon = np.hstack(Ichunks)
     assert I.shape == Irecon.shape
     assert np.all(I == Irecon)
+
+
+@pytest.fixture
+def geotiffs(random_filename):
+    filenames = []
+    A = Affine(1., 0, 0., 0, -1., 10.)
+    for i in range(3):
+        filename = random_filename(ext='.tif')
+        with rasterio.open(filename, 'w', driver='GTiff', width=8, height=10,
+                           count=1, dtype=np.float32, crs=crs,
+                           transform=A, nodata=-1.) as f:
+            f.write(np.full((1, 10, 8), i, dtype=np.float32))
+        filenames.append(filename)
+    return filenames
+
+
+def test_dataset_pool(geotiffs):
+    pool = geoio.DatasetPool(maxsize=2)
+    for f in geotiffs + geotiffs[-1:]:
+        with pool.open(f) as d:
+            assert d.read(1)[0, 0] == geotiffs.index(f)
+    assert pool.misses == 3
+    assert pool.hits == 1
+    assert len(pool) == 2
+
+    # in-use handles are never evicted
+    with pool.open(geotiffs[0]) as d0:
+        with pool.open(geotiffs[1]) as d1, pool.open(geotiffs[2]) as d2:
+            assert len(pool) == 3
+        assert not d0.closed
+    assert len(pool) == 2
+    pool.close()
+    assert len(pool) == 0
+    assert d0.closed
+
+
+def test_dataset_pool_threads(geotiffs):
+    from concurrent.futures import ThreadPoolExecutor
+    pool = geoio.DatasetPool(maxsize=2)
+    with pool.open(geotiffs[0]) as d0:
+        # a handle in use is not shared
+        with pool.open(geotiffs[0]) as d1:
+            assert d1 is not d0
+
+    # handles returned by one thread are reused by the others
+    def read(f):
+        with pool.open(f) as d:
+            return d.read(1)[0, 0]
+    with ThreadPoolExecutor(1) as executor:
+        assert executor.submit(read, geotiffs[0]).result() == 0
+    assert pool.misses == 2
+    assert pool.hits == 1
+    pool.close()
+
+
+def test_rasterio_image_source_pooled(geotiffs):
+    src = geoio.RasterioImageSource(geotiffs[1])
+    hits = geoio.dataset_pool.hits
+    d = src.data(0, 8, 2, 5)
+    assert d.shape == (8, 3, 1)
+    assert np.all(d == 1)
+    assert geoio.dataset_pool.hits == hits + 1
+
+
+def test_extract_features_block_reads(random_filename):
+    from uncoverml import features
+    from uncoverml.targets import Targets
+    filename = random_filename(ext='.tif')
+    res_x, res_y = 70, 50
+    A = Affine(1., 0, 0., 0, -1., res_y)
+    data = np.arange(res_x * res_y, dtype=np.float32).reshape(1, res_y, res_x)
+    with rasterio.open(filename, 'w', driver='GTiff', width=res_x,
+                       height=res_y, count=1, dtype=np.float32, crs=crs,
+                       transform=A, tiled=True, blockxsize=16,
+                       blockysize=16) as f:
+        f.write(data)
+    src = geoio.RasterioImageSource(filename)
+    assert src.block_shape == (16, 16)
+
+    rnd = np.random.RandomState(1)
+    lonlat = np.vstack((rnd.rand(2, 40) * [[res_x], [res_y]])).T
+    x = features.extract_features(src, Targets(lonlat, np.zeros(40)), 0)
+    full = Image(src).data()
+    pix = Image(src).lonlat2pix(lonlat)
+    assert x.shape == (40, 1, 1, 1)
+    assert np.all(x[:, 0, 0, 0] == full[pix[:, 0], pix[:, 1], 0])
+
+
+def test_construct_splits_block_aligned():
+    from uncoverml.image import construct_splits
+    # 50 rows, 16 row blocks, the last (short) block at the bottom of the
+    # file ends up at the start of the y-up image
+    splits = construct_splits(50, 3, block_rows=16, block_offset=2)
+    assert splits == [(0, 18), (18, 34), (34, 50)]
+
+    # fewer blocks than chunks falls back to even splitting
+    splits = construct_splits(50, 5, block_rows=16, block_offset=2)
+    assert [b - a for a, b in splits] == [10] * 5
+
+
+def test_Image_split_block_aligned(random_filename):
+    filename = random_filename(ext='.tif')
+    res_x, res_y = 20, 50
+    A = Affine(1., 0, 0., 0, -1., res_y)
+    data = np.arange(res_x * res_y, dtype=np.float32).reshape(1, res_y, res_x)
+    with rasterio.open(filename, 'w', driver='GTiff', width=res_x,
+                       height=res_y, count=1, dtype=np.float32, crs=crs,
+                       transform=A, tiled=True, blockxsize=16,
+                       blockysize=16) as f:
+        f.write(data)
+    src = geoio.RasterioImageSource(filename)
+    assert src.block_offset(16) == 2
+
+    chunks = [Image(src, i, 3, block_rows=16) for i in range(3)]
+    # every chunk boundary falls on a block edge of the file
+    for c in chunks[1:]:
+        assert (res_y - c.ymin) % 16 == 0
+    recon = np.hstack([c.data() for c in chunks])
+    assert np.all(recon == Image(src).data())
+
+
+def test_iterate_sources_threaded(geotiffs):
+    from types import SimpleNamespace
+
+    def f(image_source):
+        return Image(image_source).data().data
+
+    feature_sets = [SimpleNamespace(files=geotiffs[:2]),
+                    SimpleNamespace(files=geotiffs[2:])]
+    serial = geoio._iterate_sources(
+        f, SimpleNamespace(feature_sets=feature_sets, io_threads=1,
+                        cube_dir=None))
+    threaded = geoio._iterate_sources(
+        f, SimpleNamespace(feature_sets=feature_sets, io_threads=3,
+                        cube_dir=None))
+    assert [list(d) for d in threaded] == [list(d) for d in serial]
+    for d_t, d_s in zip(threaded, serial):
+        for k in d_s:
+            assert np.all(d_t[k] == d_s[k])
+    assert np.all(threaded[1][geotiffs[2]] == 2)
+
+
+def test_cube_image_source(random_filename, tmpdir):
+    from types import SimpleNamespace
+    filename = random_filename(ext='.tif')
+    res_x, res_y = 13, 11
+    A = Affine(1., 0, 0., 0, -1., res_y)
+    data = np.arange(2 * res_x * res_y, dtype=np.float32).reshape(
+        2, res_y, res_x)
+    data[0, 3, 4] = -1.
+    with rasterio.open(filename, 'w', driver='GTiff', width=res_x,
+                       height=res_y, count=2, dtype=np.float32, crs=crs,
+                       transform=A, nodata=-1.) as f:
+        f.write(data)
+
+    config = SimpleNamespace(feature_sets=[SimpleNamespace(files=[filename])],
+                             cube_dir=str(tmpdir))
+    geoio.build_cube(config, config.cube_dir, max_rows_gb=1e-9)
+    src = geoio.image_source(filename, config)
+    assert isinstance(src, geoio.CubeImageSource)
+
+    tif = geoio.RasterioImageSource(filename)
+    for attr in ['full_resolution', 'pixsize_x', 'pixsize_y',
+                 'origin_latitude', 'origin_longitude', 'nodata_value',
+                 'block_shape']:
+        assert getattr(src, attr) == getattr(tif, attr)
+    assert src.block_offset(4) == tif.block_offset(4)
+    # the index is parsed once
+    index_file = os.path.join(config.cube_dir, 'cube.json')
+    assert geoio._cube_index(index_file) is geoio._cube_index(index_file)
+    d_cube = src.data(2, 9, 1, 8)
+    d_tif = tif.data(2, 9, 1, 8)
+    assert np.all(d_cube.data == d_tif.data)
+    assert np.all(d_cube.mask == d_tif.mask)
+    assert d_cube.mask.sum() == 1
+
+    # a modified covariate is read from the GeoTIFF again
+    with rasterio.open(filename, 'r+') as f:
+        f.write(data + 1)
+    os.utime(filename, (0, 0))
+    assert isinstance(geoio.image_source(filename, config),
+                      geoio.RasterioImageSource)
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+@pytest.mark.parametrize('cog', [False, True])
+@pytest.mark.parametrize('write_behind', [0, 1])
+def test_image_writer(tmpdir, parallel, cog, write_behind):
+    shape = (7, 12)
+    bbox = np.array([[0., 0.], [7., 12.]])
+    outdir = str(tmpdir)
+    # factor 3 overview rows straddle the 4 row partitions
+    writer = geoio.ImageWriter(shape, bbox, crs, 'pred', 3, outdir,
+                               band_tags=['Prediction', 'Variance'],
+                               parallel=parallel, cog=cog, overviews=[2, 3],
+                               thumbnails=5, write_behind=write_behind)
+    y = np.arange(shape[0] * shape[1] * 2, dtype=float).reshape(
+        shape[0], shape[1], 2)
+    mask = np.zeros_like(y, dtype=bool)
+    mask[2, 5] = True
+    y = np.ma.masked_array(y, mask)
+    for i, (ymin, ymax) in enumerate(
+            construct_splits(shape[1], 3)):
+        writer.write(y[:, ymin:ymax].reshape(-1, 2), i)
+    writer.close()
+
+    assert len(writer.file_names) == 2
+    for band, f in enumerate(writer.file_names):
+        with rasterio.open(f) as src:
+            assert src.tags(1)['image_type'] == writer.band_tags[band]
+            assert src.transform == writer.A
+            d = src.read(1, masked=True)
+            if cog:
+                # (rasterio rounds the factors, the shapes are checked below)
+                assert len(src.overviews(1)) == 2
+                if not parallel:
+                    assert src.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+        assert np.all(d.T == y[:, :, band])
+        # overviews average the unmasked pixels of each block
+        for level, k in enumerate([2, 3] if cog else []):
+            with rasterio.open(f, overview_level=level) as src:
+                o = src.read(1)
+            assert o.shape == (-(-d.shape[0] // k), -(-d.shape[1] // k))
+            for i, j in np.ndindex(*o.shape):
+                assert np.isclose(o[i, j], d[i * k:(i + 1) * k,
+                                             j * k:(j + 1) * k].mean())
+        assert np.all(d.mask.T == mask[:, :, band])
+
+        # thumbnails average the unmasked pixels of each 5x5 block
+        with rasterio.open(f.rsplit('.', 1)[0] + '_thumbnail.tif') as src:
+            assert src.shape == (3, 2)
+            assert src.transform == writer.A * Affine.scale(5)
+            t = src.read(1)
+        assert np.isclose(t[1, 0], y[:5, 5:10, band].mean())
+        assert np.isclose(t[2, 1], y[5:, 10:, band].mean())
+    writer.output_thumbnails(5)
+    if cog and not parallel:
+        # only the COGs and their thumbnails are left
+        assert len(os.listdir(outdir)) == 4
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_image_writer_write_behind_error(tmpdir, parallel):
+    # a failed write is raised at the next collective call, on every node
+    shape = (7, 12)
+    bbox = np.array([[0., 0.], [7., 12.]])
+    writer = geoio.ImageWriter(shape, bbox, crs, 'pred', 1, str(tmpdir),
+                               band_tags=['Prediction'], parallel=parallel,
+                               write_behind=1)
+
+    def fail(*args):
+        raise IOError("disk full")
+    writer._write_part = writer._write_window = fail
+    y = np.ma.masked_array(np.zeros((shape[0] * shape[1], 1)), False)
+    writer.write(y, 0)
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_image_writer_outbands(tmpdir, parallel):
+    # more bands are predicted than are written
+    shape = (7, 12, 3)  # as geoio.get_image_spec gives it
+    bbox = np.array([[0., 0.], [7., 12.]])
+    writer = geoio.ImageWriter(shape, bbox, crs, 'pred', 2, str(tmpdir),
+                               band_tags=['Prediction'], parallel=parallel,
+                               thumbnails=5)
+    y = np.ma.masked_array(np.arange(shape[0] * shape[1] * 3, dtype=float)
+                           .reshape(shape[0], shape[1], 3), False)
+    for i, (ymin, ymax) in enumerate(construct_splits(shape[1], 2)):
+        writer.write(y[:, ymin:ymax].reshape(-1, 3), i)
+    writer.close()
+
+    assert len(writer.file_names) == 1
+    with rasterio.open(writer.file_names[0]) as src:
+        assert src.count == 1
+        assert np.all(src.read(1).T == y[:, :, 0])
+    with rasterio.open(writer.file_names[0].rsplit('.', 1)[0] +
+                       '_thumbnail.tif') as src:
+        assert src.count == 1
+
+
+def test_lonlat2pix_matches_pixel_corners(pix_size_single, origin_point):
+    img = make_image(pix_size_single, origin_point, False, 1, 'start')
+    res_x, res_y = img._full_res[:2]
+    corners_x = [img._start_lon + float(k) * img.pixsize_x
+                 for k in range(res_x + 1)]
+    corners_y = [img._start_lat + float(k) * img.pixsize_y
+                 for k in range(res_y + 1)]
+    rnd = np.random.RandomState(0)
+    # points near and exactly on every pixel corner
+    lons = np.concatenate([np.array(corners_x) + d
+                           for d in [0, 1e-12, -1e-12]] +
+                          [rnd.uniform(corners_x[0], corners_x[-1], 100)])
+    lats = np.concatenate([np.array(corners_y) + d
+                           for d in [0, 1e-12, -1e-12]] +
+                          [rnd.uniform(corners_y[0], corners_y[-1], 100)])
+    lonlat = np.array([[a, b] for a in lons for b in lats])
+
+    x = np.searchsorted(corners_x, lonlat[:, 0], side='right') - 1
+    y = np.searchsorted(corners_y, lonlat[:, 1], side='right') - 1
+    x[lonlat[:, 0] == corners_x[-1]] -= 1
+    y[lonlat[:, 1] == corners_y[-1]] -= 1
+    inside = (x >= 0) & (x < res_x) & (y >= 0) & (y < res_y)
+    assert not np.all(inside)
+    with pytest.raises(ValueError):
+        img.lonlat2pix(lonlat[~inside][:1])
+    xy = img.lonlat2pix(lonlat[inside])
+    assert np.all(xy[:, 0] == x[inside])
+    assert np.all(xy[:, 1] == y[inside])
+
+
+def test_lonlat2pix_missing_coordinates(pix_size_single, origin_point):
+    img = make_image(pix_size_single, origin_point, False, 1, 'start')
+    centre = [img._start_lon + 0.5 * img.pixsize_x,
+              img._start_lat + 0.5 * img.pixsize_y]
+    assert np.all(img.lonlat2pix(np.array([centre])) == 0)
+    # not snapped to the first row or column
+    for lonlat in ([np.nan, centre[1]], [centre[0], np.nan],
+                   [np.inf, -np.inf]):
+        with pytest.raises(ValueError):
+            img.lonlat2pix(np.array([lonlat]))
+    assert np.all(_coord2pix(img._start_lon, img.pixsize_x, 4,
+                             [np.nan, np.inf, -np.inf]) == -1)
+
+
+def test_all_patches_pixels(array_image_src):
+    from uncoverml import patch
+    img = Image(array_image_src)
+    data = img.data()
+
+    patches = patch.all_patches(img, 0)
+
+    assert np.all(patches.data == patch.grid_patches(data.data, 0))
+    assert np.all(patches.mask == patch.grid_patches(data.mask, 0))
+
+
+@pytest.mark.parametrize('strip_bytes', [1, 2 ** 20])
+def test_rasterio_image_source_out(random_filename, monkeypatch,
+                                   strip_bytes):
+    # one 3 row block per read, or the whole window at once
+    monkeypatch.setattr(geoio, '_read_strip_bytes', strip_bytes)
+    filename = random_filename(ext='.tif')
+    A = Affine(1., 0, 0., 0, -1., 10.)
+    data = np.arange(2 * 80, dtype=np.float32).reshape(2, 10, 8)
+    data[0, 2, 3] = -1.
+    data[1, 4, 5] = np.nan
+    with rasterio.open(filename, 'w', driver='GTiff', width=8, height=10,
+                       count=2, dtype=np.float32, crs=crs,
+                       transform=A, nodata=-1., blockysize=3) as f:
+        f.write(data)
+    src = geoio.RasterioImageSource(filename)
+    assert src.block_shape == (8, 3)
+
+    d = src.data(1, 7, 2, 9)
+    # (x, y, band) with y counting up from the bottom of the file
+    true_d = data[:, ::-1].transpose(2, 1, 0)[1:7, 2:9]
+    assert d.shape == (6, 7, 2)
+    assert d.data.flags.c_contiguous
+    assert np.all(d.mask == ~np.isfinite(true_d) | (true_d == -1))
+    assert np.all(d[~d.mask] == true_d[~d.mask])
+
+    out = np.ma.masked_array(np.zeros((6, 7, 2)), mask=np.zeros((6, 7, 2)))
+    assert src.data(1, 7, 2, 9, out=out) is out
+    assert np.all(out.mask == d.mask)
+    assert np.all(out[~out.mask] == d[~d.mask])
+
+
+def test_intersection_cache(geotiffs, tmpdir):
+    from types import SimpleNamespace
+    from uncoverml.targets import Targets
+    target_file = str(tmpdir.join('targets.shp'))
+    open(target_file, 'w').close()
+    config = SimpleNamespace(
+        feature_sets=[SimpleNamespace(files=geotiffs[:2]),
+                      SimpleNamespace(files=geotiffs[2:])],
+        target_file=target_file, target_property='obs',
+        target_coordinates=('lon', 'lat'), patchsize=0,
+        output_dir=str(tmpdir))
+    assert geoio.load_intersection(config) is None
+
+    x = np.ma.masked_array(np.arange(8.).reshape(4, 1, 1, 2),
+                           mask=np.zeros((4, 1, 1, 2), dtype=bool))
+    x.mask[1, 0, 0, 1] = True
+    image_chunk_sets = [{geotiffs[0]: x, geotiffs[1]: x.data + 1},
+                        {geotiffs[2]: x * 2}]
+    targets = Targets(np.arange(8.).reshape(4, 2), np.arange(4.),
+                      othervals={'name': np.array(['a', 'b', 'c', 'd'])})
+    geoio.save_intersection(image_chunk_sets, targets, config)
+
+    loaded_sets, loaded_targets = geoio.load_intersection(config)
+    for loaded, saved in zip(loaded_sets, image_chunk_sets):
+        assert list(loaded) == list(saved)
+        for k in saved:
+            assert np.array_equal(loaded[k].data, np.ma.getdata(saved[k]))
+            assert np.array_equal(loaded[k].mask,
+                                  np.ma.getmaskarray(saved[k]))
+    assert np.array_equal(loaded_targets.positions, targets.positions)
+    assert np.array_equal(loaded_targets.observations, targets.observations)
+    assert np.array_equal(loaded_targets.fields['name'],
+                          targets.fields['name'])
+
+    # changing the targets invalidates the cache
+    with open(target_file, 'w') as f:
+        f.write('changed')
+    assert geoio.load_intersection(config) is None
+
+    # saving again replaces it
+    geoio.save_intersection(image_chunk_sets, targets, config)
+    assert geoio.load_intersection(config) is not None
+    cache = tmpdir.join('intersection_cache')
+    ours = os.path.dirname(geoio._intersection_dir(config))
+
+    # caches of other inputs, which another run may be using, are kept
+    # until they have gone unused for long enough
+    other_file = str(tmpdir.join('other.shp'))
+    open(other_file, 'w').close()
+    other = SimpleNamespace(**dict(vars(config), target_file=other_file))
+    geoio.save_intersection(image_chunk_sets, targets, other)
+    theirs = os.path.dirname(geoio._intersection_dir(other))
+    stale = time.time() - geoio._intersection_max_age - 1
+    os.utime(theirs, (stale, stale))
+    assert geoio.load_intersection(other) is not None
+    geoio.save_intersection(image_chunk_sets, targets, config)
+    assert theirs in [str(d) for d in cache.listdir()]
+
+    for d in cache.listdir():
+        os.utime(str(d), (stale, stale))
+    geoio.save_intersection(image_chunk_sets, targets, config)
+    assert [str(d) for d in cache.listdir()] == [ours]
+
+
+def test_load_points_tables(shapefile, tmpdir):
+    import pandas as pd
+    true_lonlats, filename = shapefile
+    lonlats, vals, othervals = geoio.load_points(filename, '3')
+    frame = pd.DataFrame(othervals)
+    frame['3'] = vals
+    frame['x'] = lonlats[:, 0]
+    frame['y'] = lonlats[:, 1]
+    frame['name'] = ['p{}'.format(i) for i in range(len(vals))]
+
+    csv_file = str(tmpdir.join('targets.csv'))
+    frame.to_csv(csv_file, index=False)
+    hdf_file = str(tmpdir.join('targets.h5'))
+    records = frame.to_records(index=False).astype(
+        [(k, 'S8' if k == 'name' else float) for k in frame.columns])
+    import tables
+    with tables.open_file(hdf_file, 'w') as f:
+        f.create_table('/', 'targets', obj=records)
+
+    for table_file in (csv_file, hdf_file):
+        t_lonlats, t_vals, t_othervals = geoio.load_points(
+            table_file, '3', coordinates=('x', 'y'))
+        assert np.array_equal(t_lonlats, true_lonlats)
+        assert np.array_equal(t_vals, vals)
+        for k, v in othervals.items():
+            assert np.array_equal(t_othervals[k], v)
+        assert list(t_othervals['name'][:2]) == ['p0', 'p1']
+
+
+def test_load_targets_sorted(shapefile, tmpdir):
+    from uncoverml import mpiops
+    true_lonlats, filename = shapefile
+    lonlats, vals, othervals = geoio.load_shapefile(filename, '3')
+    order = np.lexsort(lonlats.T)
+
+    targets = geoio.load_targets(filename, '3')
+    positions = np.concatenate(mpiops.comm.allgather(targets.positions))
+    assert np.array_equal(positions, lonlats[order])
+    assert np.array_equal(
+        np.concatenate(mpiops.comm.allgather(targets.fields['lat'])),
+        othervals['lat'][order])
+
+
+def test_load_csv_parts(shapefile, tmpdir):
+    import pandas as pd
+    true_lonlats, filename = shapefile
+    lonlats, vals, othervals = geoio.load_points(filename, '3')
+    csv_file = str(tmpdir.join('targets.csv'))
+    pd.DataFrame(othervals).assign(obs=vals).to_csv(csv_file, index=False)
+
+    parts = [geoio.load_csv(csv_file, 'obs', part=(i, 7)) for i in range(7)]
+    assert np.array_equal(np.concatenate([p[0] for p in parts]), lonlats)
+    assert np.array_equal(np.concatenate([p[1] for p in parts]), vals)
+
+    # parts without rows have the same column types as the others
+    with open(csv_file, 'w') as f:
+        f.write('lon,lat,obs\n1,2,3\n')
+    for i in range(3):
+        coords, obs, _ = geoio.load_csv(csv_file, 'obs', part=(i, 3))
+        assert coords.dtype == obs.dtype == float
+
+
+def test_route_to_bands_roundtrip(geotiffs):
+    from types import SimpleNamespace
+    from collections import OrderedDict
+    from uncoverml.targets import Targets
+    config = SimpleNamespace(
+        feature_sets=[SimpleNamespace(files=geotiffs)], io_threads=1,
+        cube_dir=None, block_rows=None)
+    lonlat = np.array([[0.5, 9.5], [7.5, 0.5], [3.5, 4.5], [1.5, 2.5]])
+    band_targets, origin = geoio._route_to_bands(
+        Targets(lonlat, np.zeros(4)), config)
+
+    src = geoio.RasterioImageSource(geotiffs[0])
+    x = features.extract_features(src, band_targets, 0)
+    result = [OrderedDict([(geotiffs[0], x)])]
+    returned = geoio._return_from_bands(result, origin)
+    x_direct = features.extract_features(src, Targets(lonlat, None), 0)
+    assert np.array_equal(returned[0][geotiffs[0]].data, x_direct.data)
+    assert np.array_equal(returned[0][geotiffs[0]].mask, x_direct.mask)
+
+
+def test_extract_subchunks_columns(array_image_src):
+    x = features.extract_subchunks(array_image_src, 0, 1, 0)
+    ny = x.shape[0] // array_image_src.full_resolution[0]
+    runs = [(0, 2), (5, 7)]
+    x_runs = features.extract_subchunks(array_image_src, 0, 1, 0,
+                                        columns=runs)
+    rows = np.concatenate([np.arange(a * ny, b * ny) for a, b in runs])
+    assert np.array_equal(x_runs.data, x.data[rows])
+    assert np.array_equal(np.ma.getmaskarray(x_runs),
+                          np.ma.getmaskarray(x)[rows])
+    assert features.extract_subchunks(array_image_src, 0, 1, 0,
+                                      columns=[]).shape == (0,) + x.shape[1:]
+
+
+@pytest.mark.parametrize('columns', [None, [(1, 3), (5, 8)]])
+def test_read_image_subchunks_block(geotiffs, columns):
+    from types import SimpleNamespace
+    config = SimpleNamespace(
+        feature_sets=[SimpleNamespace(files=geotiffs[:2]),
+                      SimpleNamespace(files=geotiffs[2:])],
+        io_threads=2, cube_dir=None, n_subchunks=2, patchsize=0,
+        block_rows=None)
+    x = geoio.read_image_subchunks(1, config, columns)
+    for tif, x_tif in zip(geotiffs, x):
+        x_src = features.extract_subchunks(geoio.RasterioImageSource(tif),
+                                           1, 2, 0, columns=columns)
+        assert np.array_equal(x_tif.data, x_src.data)
+        assert np.array_equal(x_tif.mask, np.ma.getmaskarray(x_src))
+    # the covariates of a feature set share one block
+    assert np.may_share_memory(x[0].data, x[1].data)
+    assert np.may_share_memory(x[0].mask, x[1].mask)
+    assert not np.may_share_memory(x[1].data, x[2].data)
+
+
+def test_extract_lonlat(array_image_src):
+    lonlat = features.extract_lonlat(array_image_src, 0, 1, 0)
+    image = Image(array_image_src)
+    pixels = image.lonlat2pix(lonlat)
+    nx, ny = image.xres, image.yres
+    assert lonlat.shape == (nx * ny, 2)
+    # pixel centres in x major order
+    assert np.array_equal(pixels[:, 0], np.repeat(np.arange(nx), ny))
+    assert np.array_equal(pixels[:, 1], np.tile(np.arange(ny), nx))
@@ -1,12 +1,16 @@
 import pickle
 import numpy as np
 import pytest
+from scipy.integrate import fixed_quad
 from sklearn.metrics import r2_score
 
 from uncoverml.krige import krige_methods, Krige, all_ml_models, MLKrige
 from uncoverml.models import (regressors, classifiers, apply_masked,
-                              apply_multiple_masked)
+                              apply_multiple_masked, tree_moments,
+                              QUADORDER, _normpdf, _transformed_moments)
+from uncoverml.modelcache import ModelCache
 from uncoverml.optimise.models import transformed_modelmaps
+from uncoverml.transforms import target as transforms
 
 models = {**classifiers, **regressors, **transformed_modelmaps}
 
@@ -155,3 +159,64 @@ def test_apply_multiple_masked(masked_data):
     yr = apply_multiple_masked(predict, (Xt, yt_masked))
     assert np.ma.all(yt_masked == yr)
     assert apply_multiple_masked(fit, (Xt, yt_masked)) is None
+
+
+def test_model_cache(tmpdir):
+    cache = ModelCache()
+    pk_f = str(tmpdir.join('model.pk'))
+    with open(pk_f, 'wb') as f:
+        pickle.dump([1, 2], f)
+    first = cache.load(pk_f)
+    assert cache.load(pk_f) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # a rewritten file is loaded again, replacing the old one
+    with open(pk_f, 'wb') as f:
+        pickle.dump([1, 2, 3], f)
+    assert cache.load(pk_f) == [1, 2, 3]
+    assert len(cache) == 1
+
+    cache.max_gb = 0
+    cache.load(pk_f)
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize('n_jobs', [None, 3])
+def test_tree_moments(linear_data, n_jobs):
+    yt, Xt, ys, Xs = linear_data()
+    rf = regressors['randomforest'](n_estimators=10, random_state=1)
+    rf.fit(Xt, yt)
+    y = np.array([dt.predict(Xs) for dt in rf.estimators_])
+    Ey, Vy = tree_moments(iter(rf.estimators_), Xs, n_jobs)
+    assert np.allclose(Ey, y.mean(axis=0))
+    assert np.allclose(Vy, y.var(axis=0))
+
+
+@pytest.mark.parametrize('transform', ['log', 'sqrt', 'logistic', 'rank',
+                                       'kde'])
+def test_transformed_moments(transform):
+    rnd = np.random.RandomState(1)
+    y = rnd.beta(2, 5, size=200)
+    trans = transforms.transforms[transform]()
+    trans.fit(y)
+    Ey_t = trans.transform(y[:20])
+    Vy_t = rnd.uniform(0.01, 0.5, size=20)
+
+    def expec_int(x, mu, std):
+        return trans.itransform(x) * _normpdf(x, mu, std)
+
+    def var_int(x, Ex, mu, std):
+        return (trans.itransform(x) - Ex) ** 2 * _normpdf(x, mu, std)
+
+    Ey = np.empty_like(Ey_t)
+    Vy = np.empty_like(Vy_t)
+    for i, (Eyi, Vyi) in enumerate(zip(Ey_t, Vy_t)):
+        Syi = np.sqrt(Vyi)
+        a, b = Eyi - 3 * Syi, Eyi + 3 * Syi
+        Ey[i], _ = fixed_quad(expec_int, a, b, n=QUADORDER, args=(Eyi, Syi))
+        Vy[i], _ = fixed_quad(var_int, a, b, n=QUADORDER,
+                              args=(Ey[i], Eyi, Syi))
+
+    Ey_v, Vy_v = _transformed_moments(trans, Ey_t, Vy_t)
+    np.testing.assert_allclose(Ey_v, Ey, rtol=1e-12)
+    np.testing.assert_allclose(Vy_v, Vy, rtol=1e-12)
@@ -1,5 +1,10 @@
 # import copy
 
+import os
+import shutil
+import subprocess
+import sys
+
 import numpy as np
 import pytest
 
@@ -94,3 +99,112 @@ def test_random_full_points():
     Xp = mpiops.random_full_points(X, 200)
 
     assert Xp.shape[0] <= 100
+
+
+def test_dense_statistics(mpisync, masked_array):
+    x, x_all = masked_array
+    x = np.ma.masked_array(x.data)
+    x_all = np.ma.masked_array(x_all.data)
+    assert np.all(mpiops.count(x) == x_all.count(axis=0))
+    assert np.allclose(mpiops.mean(x), x_all.data.mean(axis=0))
+    assert np.allclose(mpiops.covariance(x),
+                       np.cov(x_all.data.T, bias=True))
+
+
+def test_allgather_masked(mpisync, masked_array):
+    x, x_all = masked_array
+    x_gathered = mpiops.allgather_masked(x)
+    assert np.array_equal(x_gathered.data, x_all.data)
+    assert np.array_equal(x_gathered.mask, x_all.mask)
+
+    x_gathered = mpiops.allgather_masked(np.ma.masked_array(x.data))
+    assert np.array_equal(x_gathered.data, x_all.data)
+    assert not x_gathered.mask.any()
+
+
+def test_exchange_rows(mpisync):
+    rank, n = mpiops.chunk_index, mpiops.chunks
+    records = np.zeros(4 * n, dtype=[('rank', 'i8'), ('row', 'i8'),
+                                     ('values', 'f8', (3,))])
+    records['rank'] = rank
+    records['row'] = np.arange(4 * n)
+    records['values'] = records['row'][:, np.newaxis] + rank / 10
+    dest = records['row'][::-1] % n
+    received = mpiops.exchange_rows(records, dest)
+    # ordered by sending node, then by order on that node
+    assert np.array_equal(received['rank'], np.repeat(np.arange(n), 4))
+    rows = [r for r in range(4 * n) if (4 * n - 1 - r) % n == rank]
+    assert np.array_equal(received['row'], np.tile(rows, n))
+    assert np.allclose(received['values'],
+                       received['row'][:, np.newaxis]
+                       + received['rank'][:, np.newaxis] / 10)
+
+
+def test_shared_counter(mpisync):
+    counter = mpiops.SharedCounter()
+    drawn = [counter.next() for _ in range(3)]
+    all_drawn = np.sort(np.concatenate(mpiops.comm.allgather(drawn)))
+    counter.free()
+    assert np.array_equal(all_drawn, np.arange(3 * mpiops.chunks))
+
+
+def test_local(mpisync):
+    chunk_index = mpiops.chunk_index
+    with mpiops.local():
+        assert mpiops.chunks == 1
+        assert mpiops.chunk_index == 0
+        assert mpiops.comm.allreduce(1) == 1
+    assert mpiops.chunk_index == chunk_index
+    assert mpiops.comm.allreduce(1) == mpiops.chunks
+
+
+failing_tile = """
+import logging
+import time
+from types import SimpleNamespace
+from uncoverml import mllog, mpiops, predict
+
+mllog.configure(logging.INFO)  # which only shows node 0's log
+
+
+def read_partitions(config, tiles):
+    for tile in tiles:
+        yield tile, {}
+
+
+def render_partition(model, tile, image_out, config, partition):
+    if mpiops.MPI.COMM_WORLD.Get_rank() == 1:
+        raise ValueError("tile failed on node 1")
+    # leave node 1 a tile, staying in MPI so that its claims progress
+    end = time.time() + 1
+    while time.time() < end:
+        mpiops.MPI.COMM_WORLD.Iprobe()
+
+
+predict.read_partitions = read_partitions
+predict.render_partition = render_partition
+predict.render_tiles(None, None, SimpleNamespace(n_subchunks=2))
+"""
+
+
+@pytest.mark.skipif(shutil.which('mpirun') is None or mpiops.chunks > 1,
+                    reason="needs mpirun, outside an MPI job")
+def test_render_tiles_abort_reports(tmpdir):
+    # the log only shows node 0, but a failure elsewhere is still reported
+    script = tmpdir.join('fail.py')
+    script.write(failing_tile)
+    root = os.path.dirname(os.path.dirname(mpiops.__file__))
+    env = dict(os.environ, OMPI_ALLOW_RUN_AS_ROOT='1',
+               OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1',
+               OMPI_MCA_rmaps_base_oversubscribe='1',
+               PYTHONPATH=os.pathsep.join(
+                   [root] + os.environ.get('PYTHONPATH', '').split(
+                       os.pathsep)))
+    result = subprocess.run(['mpirun', '-n', '2', sys.executable,
+                             str(script)], env=env, timeout=120,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    assert result.returncode != 0
+    output = result.stdout + result.stderr
+    assert "Node 1: Rendering tiles failed" in output
+    assert "ValueError: tile failed on node 1" in output
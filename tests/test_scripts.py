@@ -0,0 +1,83 @@
+import os
+import pickle
+
+import numpy as np
+import rasterio
+from affine import Affine
+from click.testing import CliRunner
+
+from uncoverml.config import Config
+from uncoverml.models import modelmaps
+from uncoverml.scripts.uncoverml import cli
+
+# options added to Config since models were first pickled with it
+NEW_OPTIONS = ['parallel_write', 'cog', 'overviews', 'write_behind',
+               'prefetch', 'prefetch_gb', 'tile_columns', 'schedule',
+               'dtype', 'target_coordinates', 'lat', 'lon',
+               'dataset_pool_size', 'block_aligned', 'block_rows',
+               'io_threads', 'cube_dir', 'intersection_cache',
+               'model_cache_gb']
+
+pipeline = """
+features:
+  - name: covariates
+    type: ordinal
+    files:
+      - path: {covariate}
+    transforms:
+    imputation: none
+
+targets:
+  file: {outdir}/targets.shp
+  property: value
+
+learning:
+  algorithm: decisiontree
+  arguments: {{}}
+
+prediction:
+  quantiles: 0.95
+  outbands: 1
+
+validation:
+
+output:
+  directory: {outdir}
+"""
+
+
+def test_predict_old_config(tmpdir):
+    outdir = str(tmpdir)
+    covariate = os.path.join(outdir, 'covariate.tif')
+    data = np.arange(8 * 6, dtype=np.float32).reshape(8, 6)
+    transform = Affine(1., 0., 120., 0., -1., -20.)
+    with rasterio.open(covariate, 'w', driver='GTiff', width=6, height=8,
+                       count=1, dtype=np.float32, crs='EPSG:4326',
+                       transform=transform) as f:
+        f.write(data[np.newaxis])
+    yaml_file = os.path.join(outdir, 'old.yaml')
+    with open(yaml_file, 'w') as f:
+        f.write(pipeline.format(covariate=covariate, outdir=outdir))
+
+    config = Config(yaml_file)
+    # unconfigured options are not set on the instance, so this config
+    # pickles like one from before they existed
+    assert not set(NEW_OPTIONS) & set(vars(config))
+    model = modelmaps['decisiontree']()
+    model.fit(data.reshape(-1, 1), 2 * data.ravel())
+    model_file = os.path.join(outdir, 'old.model')
+    with open(model_file, 'wb') as f:
+        pickle.dump({'model': model, 'config': config}, f)
+
+    result = CliRunner().invoke(cli, ['predict', model_file])
+    assert result.exit_code == 0, result.output
+    tifs = [f for f in os.listdir(outdir)
+            if f.startswith('old_decisiontree') and
+            f.endswith('.tif') and 'thumbnail' not in f]
+    assert len(tifs) == 1
+    # compare the pixels at the same place, whichever way up the output is
+    rows, cols = np.mgrid[:8, :6]
+    lons, lats = transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+    with rasterio.open(os.path.join(outdir, tifs[0])) as src:
+        c, r = np.floor(~src.transform * (lons, lats)).astype(int)
+        assert np.allclose(src.read(1)[r, c], 2 * data.ravel())
@@ -241,6 +241,51 @@ def test_StandardiseTransform_caching(make_random_data):
     assert np.array_equal(x_expected, x_produced)
 
 
+def test_StandardiseTransform_float32(make_random_data):
+
+    x, mu, std = make_random_data
+    x32 = x.astype(np.float32)
+
+    standardiser = StandardiseTransform()
+    x_produced = standardiser(x32)
+
+    # the features keep their precision, the statistics do not
+    assert x_produced.dtype == np.float32
+    assert standardiser.mean.dtype == np.float64
+    assert standardiser.sd.dtype == np.float64
+    assert np.allclose(x_produced, (x - mu) / std, atol=1e-5)
+
+
+def test_feature_vector_dtype():
+    from collections import OrderedDict
+    from types import SimpleNamespace
+    from uncoverml.features import transform_features
+    from uncoverml.transforms.transformset import (build_feature_vector,
+                                                   ImageTransformSet)
+    x = np.ma.masked_array(np.arange(24, dtype=np.uint8).reshape(6, 1, 1, 4),
+                           False)
+    chunks = OrderedDict([('a', x), ('b', x)])
+
+    assert build_feature_vector(chunks, True, np.float32).dtype == int
+    assert build_feature_vector(chunks, False, np.float32).dtype == \
+        np.float32
+    assert build_feature_vector(chunks, False).dtype == np.uint8
+
+    # feature sets that are all categorical stay integer, others are in
+    # the configured precision
+    config = SimpleNamespace(cubist=False, multicubist=False, krige=False,
+                             dtype=np.dtype(np.float32))
+    categorical = ImageTransformSet(is_categorical=True, dtype=np.float32)
+    ordinal = ImageTransformSet(dtype=np.float32)
+    f, _ = transform_features([chunks, chunks], [categorical, categorical],
+                              None, config)
+    assert f.dtype == int
+    f, _ = transform_features([chunks, chunks], [categorical, ordinal],
+                              None, config)
+    assert f.dtype == np.float32
+    assert np.all(f == np.tile(x.reshape(6, 4), 4))
+
+
 def test_WhitenTransform(make_random_data):
 
     # Perform the whitening directly to the expected data
@@ -4,6 +4,7 @@ from os import makedirs
 import glob
 import csv
 import yaml
+import numpy as np
 
 from uncoverml import transforms
 
@@ -78,8 +79,10 @@ class FeatureSetConfig:
     ----------
     d : dictionary
         The section of the yaml file for a feature set
+    dtype : numpy dtype
+        The floating point type of the features
     """
-    def __init__(self, d):
+    def __init__(self, d, dtype=float):
         self.name = d['name']
         self.type = d['type']
         if d['type'] not in {'ordinal', 'categorical'}:
@@ -116,7 +119,8 @@ class FeatureSetConfig:
                                                     d['imputation'],
                                                     n_files)
         self.transform_set = transforms.ImageTransformSet(trans_i, im, trans_g,
-                                                          is_categorical)
+                                                          is_categorical,
+                                                          dtype)
 
 
 class Config:
@@ -131,6 +135,30 @@ class Config:
         The path to the yaml config file. For details on the yaml schema
         see the uncoverml documentation
     """
+    # Defaults of the options added since models were first pickled with
+    # their config. They are the only defaults: __init__ sets an option only
+    # if it is configured, so that configs pickled before an option existed
+    # still have it
+    parallel_write = False
+    cog = False
+    overviews = None
+    write_behind = 0
+    prefetch = 0
+    prefetch_gb = 4.0
+    tile_columns = 256
+    schedule = 'static'
+    dtype = np.dtype(float)
+    target_coordinates = ('lon', 'lat')
+    lat = None
+    lon = None
+    dataset_pool_size = 64
+    block_aligned = False
+    block_rows = None  # set from the covariates at run time
+    io_threads = 1
+    cube_dir = None
+    intersection_cache = True
+    model_cache_gb = 8.0
+
     def __init__(self, yaml_file):
         with open(yaml_file, 'r') as f:
             s = yaml.load(f)
@@ -157,6 +185,25 @@ class Config:
             self.outbands = s['prediction']['outbands']
         self.thumbnails = s['prediction']['thumbnails'] \
             if 'thumbnails' in s['prediction'] else 10
+        if 'parallel_write' in s['prediction']:
+            self.parallel_write = s['prediction']['parallel_write']
+        if 'cog' in s['prediction']:
+            self.cog = s['prediction']['cog']
+        if 'overviews' in s['prediction']:
+            self.overviews = s['prediction']['overviews']
+        if 'write_behind' in s['prediction']:
+            self.write_behind = s['prediction']['write_behind']
+        if 'prefetch' in s['prediction']:
+            self.prefetch = s['prediction']['prefetch']
+        if 'prefetch_gb' in s['prediction']:
+            self.prefetch_gb = s['prediction']['prefetch_gb']
+        if 'tile_columns' in s['prediction']:
+            self.tile_columns = s['prediction']['tile_columns']
+        if 'schedule' in s['prediction']:
+            self.schedule = s['prediction']['schedule']
+        if self.schedule == 'dynamic':
+            # partitions finish in any order, wherever they were predicted
+            self.parallel_write = True
 
         self.pickle = any(True for d in s['features'] if d['type'] == 'pickle')
 
@@ -198,7 +245,14 @@ class Config:
             log.info('One or both pickled files were not '
                      'found. All targets will be intersected.')
 
-        self.feature_sets = [FeatureSetConfig(k) for k in s['features']]
+        # floating point precision of the features from read to prediction
+        if 'dtype' in s:
+            self.dtype = np.dtype(s['dtype'])
+        if self.dtype not in (np.float32, np.float64):
+            raise ConfigException("dtype must be float32 or float64")
+
+        self.feature_sets = [FeatureSetConfig(k, self.dtype)
+                             for k in s['features']]
 
         if 'preprocessing' in s:
             final_transform = s['preprocessing']
@@ -210,6 +264,9 @@ class Config:
 
         self.target_file = s['targets']['file']
         self.target_property = s['targets']['property']
+        # coordinate columns of CSV and HDF5 targets
+        if 'coordinates' in s['targets']:
+            self.target_coordinates = tuple(s['targets']['coordinates'])
 
         self.resample = None
 
@@ -224,8 +281,10 @@ class Config:
         self.lon_lat = False
         if 'lon_lat' in s:
             self.lon_lat = True
-            self.lat = s['lon_lat']['lat']
-            self.lon = s['lon_lat']['lon']
+            # without lat/lon rasters they are computed from the image grid
+            lon_lat = s['lon_lat'] or {}
+            self.lat = lon_lat.get('lat')
+            self.lon = lon_lat.get('lon')
 
         # TODO pipeline this better
         self.rank_features = False
@@ -249,6 +308,21 @@ class Config:
                      'pickled files. Pickled files will not be used. '
                      'All covariates will be intersected.')
 
+        # raster I/O tuning
+        if 'io' in s:
+            if 'dataset_pool_size' in s['io']:
+                self.dataset_pool_size = s['io']['dataset_pool_size']
+            if 'model_cache_gb' in s['io']:
+                self.model_cache_gb = s['io']['model_cache_gb']
+            if 'block_aligned' in s['io']:
+                self.block_aligned = s['io']['block_aligned']
+            if 'threads' in s['io']:
+                self.io_threads = s['io']['threads']
+            if 'cube' in s['io']:
+                self.cube_dir = path.abspath(s['io']['cube'])
+            if 'intersection_cache' in s['io']:
+                self.intersection_cache = s['io']['intersection_cache']
+
         self.output_dir = s['output']['directory']
 
         # create output dir if does not exist
@@ -5,6 +5,9 @@ import pickle
 import time
 import random
 import glob
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 from subprocess import check_output
 from shlex import split as parse
@@ -16,6 +19,7 @@ from collections import OrderedDict
 import operator
 import csv
 from uncoverml import mpiops
+from uncoverml.modelcache import model_cache
 
 log = logging.getLogger(__name__)
 CONTINUOUS = 2
@@ -30,6 +34,31 @@ def save_data(filename, data):
         new_file.write(data)
 
 
+def save_array(filename, data, chunk_rows=10000):
+    """
+    Write the rows of a 2D array as comma separated text.
+
+    A chunk of rows is formatted in one go, rather than a row at a time as
+    np.savetxt does, and the digits round trip exactly.
+    """
+    row = ', '.join(['%.17g'] * data.shape[1]) + '\n'
+    with open(filename, 'w', buffering=2 ** 20) as f:
+        for start in range(0, len(data), chunk_rows):
+            chunk = data[start:start + chunk_rows]
+            f.write((row * len(chunk)) % tuple(chunk.ravel()))
+
+
+def scratch_dir():
+    """
+    Node-local storage for cubist's working files: $TMPDIR (usually job
+    local on a cluster), else /dev/shm, else the system default.
+    """
+    for d in [os.environ.get('TMPDIR'), '/dev/shm']:
+        if d and os.path.isdir(d) and os.access(d, os.W_OK):
+            return d
+    return None
+
+
 def read_data(filename):
     with open(filename, 'r') as data:
         return data.read()
@@ -220,33 +249,41 @@ class Cubist:
                enumerate(types.items())]\
             + ['t: continuous.']
         namefile_string = '\n'.join(names)
-        save_data(self._filename + '.names', namefile_string)
 
-        # bootstrap
+        # bootstrap, reproducibly for a seed whichever thread fits this
         if self.bootstrap:
-            chosen = np.random.choice(range(len(y)),
-                                      size=int(self.bootstrap/100.*len(y)),
-                                      replace=True)
+            rng = np.random.RandomState(self.seed) \
+                if self.seed is not None else np.random
+            chosen = rng.choice(range(len(y)),
+                                size=int(self.bootstrap/100.*len(y)),
+                                replace=True)
             y = y[chosen]
             x = x[chosen, :]
 
         n, _ = x.shape
 
-        # Write the data as a csv file for cubist's training
-        y_copy = deepcopy(y)
-        y_copy.shape = (n, 1)
-        data = np.concatenate((x, y_copy), axis=1)
-        np.savetxt(self._filename + '.data', data, delimiter=', ')
+        # Cubist's files are worked on in node-local storage, and removed
+        # with it afterwards
+        with tempfile.TemporaryDirectory(prefix='cubist_',
+                                         dir=scratch_dir()) as work:
+            stem = join(work, os.path.basename(self._filename))
+            save_data(stem + '.names', namefile_string)
 
-        # Run cubist and train the models
-        self._run_cubist()
+            # Write the data as a csv file for cubist's training
+            y_copy = deepcopy(y)
+            y_copy.shape = (n, 1)
+            data = np.concatenate((x, y_copy), axis=1)
+            save_array(stem + '.data', data)
 
-        '''
-        Turn the model into a rule list, which we can evaluate
-        '''
+            # Run cubist and train the models
+            self._run_cubist(stem)
+
+            '''
+            Turn the model into a rule list, which we can evaluate
+            '''
 
-        # Get and store the output model and the required data
-        modelfile = read_data(self._filename + '.model')
+            # Get and store the output model and the required data
+            modelfile = read_data(stem + '.model')
 
         # Define a function that assigns the number of rows to the rule
         def new_rule(model):
@@ -258,19 +295,11 @@ class Cubist:
         models = map(remove_first_line, modelfile.split('rules')[1:])
         rules_split = [model.split('conds')[1:] for model in models]
         self.models = [list(map(new_rule, model)) for model in rules_split]
-
-        '''
-        Complete the training by cleaning up after ourselves
-        '''
+        self._rule_sets = None
 
         # Mark that we are now trained
         self._trained = True
 
-        # Delete the files used during training
-        self._remove_files(
-            ['.tmp', '.names', '.data', '.model', '.pred']
-        )
-
     def predict_dist(self, x, interval=0.95):
         """ Predict the outputs and variances of the inputs
         This method predicts the output values that would correspond to
@@ -308,18 +337,11 @@ class Cubist:
             print('Train first')
             return
 
-        # Determine which rule to run on each row and then run the regression
-        # on each row of x to get the regression output.
+        # Run the regression of every rule each row satisfies, for each
+        # committee member
         y_pred = np.zeros((n, len(self.models)))
-        for m, model in enumerate(self.models):
-            for rule in model:
-
-                # Determine which rows satisfy this rule
-                mask = rule.satisfied(x)
-
-                # Make the prediction for the whole matrix, and keep only the
-                # rows that are correctly sized
-                y_pred[mask, m] += rule.regress(x, mask)
+        for m, rule_set in enumerate(self.compiled_models()):
+            y_pred[:, m] = rule_set.predict(x)
 
         y_mean = np.mean(y_pred, axis=1)
         y_var = np.var(y_pred, axis=1)
@@ -349,53 +371,83 @@ class Cubist:
         mean, _, _, _ = self.predict_dist(x)
         return mean
 
-    def _run_cubist(self):
+    def compiled_models(self):
+        """
+        The rules of each committee member as a RuleSet, compiled on first
+        use (so also for models pickled before they were compiled).
+        """
+        if getattr(self, '_rule_sets', None) is None:
+            self._rule_sets = [RuleSet(model) for model in self.models]
+        return self._rule_sets
+
+    def _run_cubist(self, stem):
 
         try:
             from uncoverml.cubist_config import invocation
 
         except ImportError:
-            self._remove_files(['.tmp', '.names', '.data', '.model'])
             print('\nCubist not installed, please run makecubist first')
             import sys
             sys.exit()
 
-        # Start the script and wait until it has yielded
-        command = (invocation +
-                   (' -u' if self.unbiased else '') +
-                   (' -r ' + str(self.max_rules)
-                    if self.max_rules else '') +
-                   (' -C ' + str(self.committee_members)
-                    if self.committee_members > 1 else '') +
-                   (' -n ' + str(self.neighbors)
-                    if self.neighbors else '') +
-                   (' -S ' + str(self.sampling)
-                    if self.sampling else '') +
-                   (' -e ' + str(self.extrapolation)
-                    if self.extrapolation else '') +
-                   (' -I ' + str(self.seed)
-                    if self.seed else '') +
-                   (' -i'
-                    if self.composite_model else '') +
-                   (' -a'
-                    if self.auto else '') +
-                   (' -f ' + self._filename))
-
-        results = check_output(command, shell=True).decode()
+        # Start the program and wait until it has finished
+        command = ([invocation] +
+                   (['-u'] if self.unbiased else []) +
+                   (['-r', str(self.max_rules)]
+                    if self.max_rules else []) +
+                   (['-C', str(self.committee_members)]
+                    if self.committee_members > 1 else []) +
+                   (['-n', str(self.neighbors)]
+                    if self.neighbors else []) +
+                   (['-S', str(self.sampling)]
+                    if self.sampling else []) +
+                   (['-e', str(self.extrapolation)]
+                    if self.extrapolation else []) +
+                   (['-I', str(self.seed)]
+                    if self.seed else []) +
+                   (['-i']
+                    if self.composite_model else []) +
+                   (['-a']
+                    if self.auto else []) +
+                   ['-f', stem])
+
+        results = check_output(command).decode()
 
         # Print the program output directly
         if self.print_output:
             print(results)
 
         if self.calc_usage:
+            # kept with the models, for MultiCubist.calculate_usage
             matched_str = CASES.split(STR1.split(results)[-1])[1]
             matched_str = STR2.split(matched_str)[0]
             save_data(self._filename + '.usg', matched_str)
 
-    def _remove_files(self, extensions):
-        for extension in extensions:
-            if os.path.exists(self._filename + extension):
-                os.remove(self._filename + extension)
+
+# the training data of the trees a MultiCubist worker process fits
+_tree_data = None
+
+
+def _init_tree_worker(x, y):
+    global _tree_data
+    _tree_data = (x, y)
+
+
+def _fit_tree(t, seed, cube, pk_f):
+    """
+    Fit one tree of a MultiCubist and pickle it to pk_f. This is at module
+    level so that it can run in a worker process, each of which formats
+    and parses cubist's files under its own GIL.
+    """
+    print('training tree {} using '
+          'process {}'.format(t, mpiops.chunk_index))
+    x, y = _tree_data
+    # a fork starts with its parent's random state, so trees fitted in
+    # different workers would otherwise draw the same unseeded samples
+    np.random.seed(seed)
+    cube.fit(x, y)
+    with open(pk_f, 'wb') as fp:
+        pickle.dump(cube, fp)
 
 
 class MultiCubist:
@@ -408,7 +460,7 @@ class MultiCubist:
                  neighbors=None, feature_type=None,
                  sampling=70, seed=None, extrapolation=None,
                  composite_model=False, auto=False, parallel=False,
-                 calc_usage=False, bootstrap=None):
+                 calc_usage=False, bootstrap=None, n_jobs=1):
         """
         Instantiate the multicubist class with a number of invocation
         parameters
@@ -419,6 +471,9 @@ class MultiCubist:
             number of Cubist trees
         parallel: bool
             Whether to use mpi for fitting or not
+        n_jobs: int
+            The number of trees each process fits at once, each in its
+            own worker process
 
         Other Parameters definitions can be found in Cubist.
         """
@@ -444,6 +499,7 @@ class MultiCubist:
         self.auto = auto
         self.calc_usage = calc_usage
         self.bootstrap = bootstrap
+        self.n_jobs = n_jobs
 
     def fit(self, x, y):
         """ Train the Cubist model
@@ -481,10 +537,10 @@ class MultiCubist:
             temp_ = 'temp_x_{}'.format(mpiops.chunk_index)
             temp_calc_usage = False  # dont calc usage stats for x-val
 
+        trees = []
         for t in process_trees:
-            print('training tree {} using '
-                  'process {}'.format(t, mpiops.chunk_index))
-
+            # the seeds are drawn in tree order, however the trees are fitted
+            seed = np.random.randint(0, 10000)
             cube = Cubist(name=join(self.temp_dir, temp_ + '_{}'.format(t)),
                           print_output=self.print_output,
                           unbiased=self.unbiased,
@@ -497,18 +553,35 @@ class MultiCubist:
                           extrapolation=self.extrapolation,
                           auto=self.auto,
                           composite_model=self.composite_model,
-                          seed=np.random.randint(0, 10000),
+                          seed=seed,
                           calc_usage=temp_calc_usage,
                           bootstrap=self.bootstrap)
-            cube.fit(x, y)
             if self.parallel:  # used in training
                 pk_f = join(self.temp_dir,
                             'cube_{}.pk'.format(t))
             else:  # used when parallel is false, i.e., during x-val
                 pk_f = join(self.temp_dir,
                             'cube_x_{}_p_{}.pk'.format(t, mpiops.chunk_index))
-            with open(pk_f, 'wb') as fp:
-                pickle.dump(cube, fp)
+            trees.append((t, seed, cube, pk_f))
+
+        if self.n_jobs == 1:
+            _init_tree_worker(x, y)
+            for tree in trees:
+                _fit_tree(*tree)
+            _init_tree_worker(None, None)
+        else:
+            # forked workers inherit x and y rather than have them pickled,
+            # and do not initialise MPI again on import
+            with ProcessPoolExecutor(
+                    max_workers=self.n_jobs,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_init_tree_worker,
+                    initargs=(x, y)) as executor:
+                futures = [executor.submit(_fit_tree, *tree)
+                           for tree in trees]
+                # raise any error of a tree
+                for f in futures:
+                    f.result()
 
         if self.parallel:
             mpiops.comm.barrier()
@@ -568,16 +641,10 @@ class MultiCubist:
             else:  # used when parallel is false, i.e., during x-val
                 pk_f = join(self.temp_dir,
                             'cube_x_{}_p_{}.pk'.format(i, mpiops.chunk_index))
-            with open(pk_f, 'rb') as fp:
-                c = pickle.load(fp)
-                for m, model in enumerate(c.models):
-                    for rule in model:
-                        # Determine which rows satisfy this rule
-                        mask = rule.satisfied(x)
-                        # Make the prediction for the whole matrix,
-                        # and keep only the rows that are correctly sized
-                        y_pred[mask, i * self.committee_members + m] += \
-                            rule.regress(x, mask)
+            c = model_cache.load(pk_f)
+            for m, rule_set in enumerate(c.compiled_models()):
+                y_pred[:, i * self.committee_members + m] = \
+                    rule_set.predict(x)
 
         y_mean = np.mean(y_pred, axis=1)
         y_var = np.var(y_pred, axis=1)
@@ -770,3 +837,89 @@ class Rule:
 
         prediction = self.bias + x[mask].dot(self.coefficients)
         return prediction
+
+
+class RuleSet:
+    """
+    The rules of one committee member compiled into arrays, so all of them
+    are evaluated together in a few numpy operations per chunk of rows.
+
+    As with evaluating each Rule, the prediction for a row is the sum of
+    the regressions of all the rules it satisfies.
+
+    Parameters
+    ----------
+    rules: list
+        The Rule objects of the committee member
+    """
+
+    operators = ["<", ">", "=", ">=", "<="]
+
+    chunk_rows = 65536
+
+    def __init__(self, rules):
+        self.bias = np.array([r.bias for r in rules])
+        self.coefficients = np.array([r.coefficients for r in rules])
+
+        continuous = [(i, c) for i, r in enumerate(rules)
+                      for c in r.conditions if c['type'] == CONTINUOUS]
+        categorical = [(i, c) for i, r in enumerate(rules)
+                       for c in r.conditions if c['type'] == CATEGORICAL]
+
+        # continuous conditions compare a column with a threshold
+        self.columns = np.array([c['operand_index'] for _, c in continuous],
+                                dtype=int)
+        self.operator_codes = np.array(
+            [self.operators.index(c['operator']) for _, c in continuous],
+            dtype=int)
+        self.thresholds = np.array([c['operand'] for _, c in continuous],
+                                   dtype=float)
+
+        # categorical conditions match a column with any of their values,
+        # which are laid out one condition after another
+        self.category_columns = np.array(
+            [c['operand_index'] for _, c in categorical for _ in c['values']],
+            dtype=int)
+        self.categories = np.array(
+            [v for _, c in categorical for v in c['values']], dtype=float)
+        self.category_starts = np.cumsum(
+            [0] + [len(c['values']) for _, c in categorical])[:-1]
+
+        # which rule each condition (continuous, then categorical) belongs to
+        owners = [i for i, _ in continuous] + [i for i, _ in categorical]
+        self.conditions = np.zeros((len(owners), len(rules)),
+                                   dtype=np.float32)
+        self.conditions[np.arange(len(owners)), owners] = 1
+
+    def satisfied(self, x):
+        """
+        The (n, rules) mask of the rules each row of x satisfies.
+        """
+        n_continuous = len(self.columns)
+        failed = np.empty((x.shape[0], self.conditions.shape[0]),
+                          dtype=np.float32)
+        x_columns = x[:, self.columns]
+        for code, operator in enumerate(self.operators):
+            k = np.flatnonzero(self.operator_codes == code)
+            if len(k):
+                failed[:, k] = ~Rule.comparator[operator](
+                    x_columns[:, k], self.thresholds[k])
+        if len(self.categories):
+            matched = np.isclose(self.categories,
+                                 x[:, self.category_columns])
+            failed[:, n_continuous:] = ~np.logical_or.reduceat(
+                matched, self.category_starts, axis=1)
+        # a rule is satisfied when none of its conditions failed
+        return failed.dot(self.conditions) == 0
+
+    def predict(self, x):
+        """
+        The sum of the regressions of the rules each row of x satisfies.
+        """
+        y = np.empty(x.shape[0])
+        for start in range(0, x.shape[0], self.chunk_rows):
+            x_chunk = x[start:start + self.chunk_rows]
+            regressions = x_chunk.dot(self.coefficients.T) + self.bias
+            y[start:start + self.chunk_rows] = np.where(
+                self.satisfied(x_chunk), regressions, 0).sum(axis=1)
+        return y
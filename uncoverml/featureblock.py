@@ -0,0 +1,115 @@
+"""Compact storage for blocks of masked feature vectors
+
+Most chunks of features have no missing values at all, and those that do
+only need one bit per element to say so. A FeatureBlock keeps the data and
+a packed validity bitmap (or nothing, when every element is valid) so that
+blocks are cheap to send between nodes and cheap to stack.
+
+FeatureBlocks are a wire and concatenation format only: gathers between
+nodes and the column-wise stacking of feature sets use them, and unpack to
+a masked array straight afterwards. The transforms, models and prediction
+code still receive masked arrays, with dense() as their fast path when
+nothing is masked. There is no NaN sentinel representation.
+"""
+
+import numpy as np
+
+
+def dense(x):
+    """The data of x if none of it is masked, otherwise None
+
+    Parameters
+    ----------
+    x : ndarray or MaskedArray
+        The array to check
+
+    Returns
+    -------
+    data : ndarray or None
+        The underlying data of x (not a copy), or None if x has any masked
+        elements
+    """
+    m = np.ma.getmask(x)
+    if m is np.ma.nomask or not m.any():
+        return np.ma.getdata(x)
+    return None
+
+
+class FeatureBlock:
+    """Feature data with a packed mask
+
+    Parameters
+    ----------
+    data : ndarray
+        The feature values. Values under the mask are undefined
+    bits : ndarray or None
+        The mask packed with np.packbits, with True marking missing
+        elements, or None if no element is missing
+    """
+    def __init__(self, data, bits=None):
+        self.data = data
+        self.bits = bits
+
+    @classmethod
+    def from_masked(cls, x):
+        """Pack a (masked) array into a FeatureBlock"""
+        data = np.ma.getdata(x)
+        m = np.ma.getmask(x)
+        bits = None
+        if m is not np.ma.nomask and m.any():
+            bits = np.packbits(m, axis=None)
+        return cls(data, bits)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def any_masked(self):
+        return self.bits is not None
+
+    @property
+    def mask(self):
+        """The unpacked boolean mask, or None if nothing is masked"""
+        if self.bits is None:
+            return None
+        m = np.unpackbits(self.bits, count=self.data.size)
+        return m.view(bool).reshape(self.data.shape)
+
+    def full_mask(self):
+        """The unpacked boolean mask, all False if nothing is masked"""
+        m = self.mask
+        return m if m is not None else np.zeros(self.data.shape, dtype=bool)
+
+    def valid_rows(self):
+        """Boolean array of the rows with no masked elements"""
+        m = self.mask
+        if m is None:
+            return np.ones(self.data.shape[0], dtype=bool)
+        return ~m.reshape(self.data.shape[0], -1).any(axis=1)
+
+    def to_masked(self):
+        """The block as a masked array, with a full mask"""
+        return np.ma.MaskedArray(data=self.data, mask=self.full_mask())
+
+    @staticmethod
+    def concatenate(blocks, axis=0):
+        """Join blocks along an axis, only building a mask if needed
+
+        Parameters
+        ----------
+        blocks : list of FeatureBlock
+            The blocks to join
+        axis : int
+            The axis to join them along
+
+        Returns
+        -------
+        block : FeatureBlock
+            The joined block
+        """
+        data = np.concatenate([b.data for b in blocks], axis=axis)
+        if not any(b.any_masked for b in blocks):
+            return FeatureBlock(data)
+        mask = np.concatenate([b.full_mask() for b in blocks], axis=axis)
+        return FeatureBlock(data, np.packbits(mask, axis=None))
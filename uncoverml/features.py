@@ -5,6 +5,7 @@ import pickle
 from os.path import basename
 
 from uncoverml import mpiops
+from uncoverml.featureblock import FeatureBlock
 from uncoverml.image import Image
 from uncoverml import patch
 from uncoverml import transforms
@@ -12,58 +13,187 @@ from uncoverml import transforms
 log = logging.getLogger(__name__)
 
 
-def extract_subchunks(image_source, subchunk_index, n_subchunks, patchsize):
+def _subchunk_image(image_source, subchunk_index, n_subchunks, patchsize,
+                    block_rows=None):
     equiv_chunks = n_subchunks * mpiops.chunks
     equiv_chunk_index = mpiops.chunks*subchunk_index + mpiops.chunk_index
-    image = Image(image_source, equiv_chunk_index,
-                  equiv_chunks, patchsize)
+    return Image(image_source, equiv_chunk_index,
+                 equiv_chunks, patchsize, block_rows)
+
+
+def extract_subchunks(image_source, subchunk_index, n_subchunks, patchsize,
+                      block_rows=None, columns=None, out=None):
+    """
+    The patches of a subchunk of an image, or of runs of its columns.
+
+    out may be a (pixel, 1, 1, band) masked array from `subchunk_blocks`
+    to read the pixels of a patchsize 0 subchunk into.
+    """
+    image = _subchunk_image(image_source, subchunk_index, n_subchunks,
+                            patchsize, block_rows)
+    if out is not None:
+        # read each run of columns straight into its rows of out
+        ny = image.resolution[1]
+        start = 0
+        for c in [None] if columns is None else columns:
+            stop = start + ny * (image.resolution[0] if c is None
+                                 else c[1] - c[0])
+            shp = (-1, ny, out.shape[3])
+            window = np.ma.masked_array(out.data[start:stop].reshape(shp),
+                                        out.mask[start:stop].reshape(shp),
+                                        copy=False)
+            patch.all_patches(image, patchsize, c, window)
+            start = stop
+        return out
+    if columns is not None:
+        # runs of (exclusive) column ranges, stacked in pixel order
+        side = 2 * patchsize + 1
+        x = [patch.all_patches(image, patchsize, c) for c in columns]
+        if not x:
+            shp = (0, side, side, image.channels)
+            return np.ma.masked_array(data=np.empty(shp, dtype=image.dtype),
+                                      mask=np.empty(shp, dtype=bool))
+        return np.ma.concatenate(x, axis=0)
     x = patch.all_patches(image, patchsize)
     return x
 
 
-def _image_has_targets(y_min, y_max, im):
-    encompass = im.ymin <= y_min and im.ymax >= y_max
-    edge_low = im.ymax >= y_min and im.ymax <= y_max
-    edge_high = im.ymin >= y_min and im.ymin <= y_max
-    inside = encompass or edge_low or edge_high
-    return inside
+def subchunk_blocks(image_sources, subchunk_index, n_subchunks, patchsize,
+                    block_rows=None, columns=None):
+    """
+    Buffers to extract the subchunks of images on the same grid into, as the
+    out arguments of `extract_subchunks`.
 
+    The buffers are views of the bands of one preallocated (pixel, 1, 1,
+    band) block holding all the images, so no image is allocated on its
+    own. Images with patches larger than a pixel get None.
+    """
+    if patchsize != 0 or not image_sources:
+        return [None] * len(image_sources)
+    image = _subchunk_image(image_sources[0], subchunk_index, n_subchunks,
+                            patchsize, block_rows)
+    nx = image.resolution[0] if columns is None else \
+        sum(c[1] - c[0] for c in columns)
+    bands = np.cumsum([0] + [s.full_resolution[2] for s in image_sources])
+    shp = (nx * image.resolution[1], 1, 1, bands[-1])
+    data = np.empty(shp, dtype=np.result_type(*[s.dtype
+                                                for s in image_sources]))
+    mask = np.empty(shp, dtype=bool)
+    return [np.ma.masked_array(data[..., a:b], mask[..., a:b], copy=False)
+            for a, b in zip(bands[:-1], bands[1:])]
 
-def _extract_from_chunk(image_source, targets, chunk_index, total_chunks,
-                        patchsize):
-    image_chunk = Image(image_source, chunk_index, total_chunks, patchsize)
-    # figure out which chunks I need to consider
-    y_min = targets.positions[0, 1]
-    y_max = targets.positions[-1, 1]
-    if _image_has_targets(y_min, y_max, image_chunk):
-        x = patch.patches_at_target(image_chunk, patchsize, targets)
-    else:
-        x = None
-    return x
 
+def extract_lonlat(image_source, subchunk_index, n_subchunks, patchsize,
+                   block_rows=None):
+    """
+    The (lon, lat) of the centres of the pixels of a subchunk, computed from
+    the image grid, in the order `extract_subchunks` gives the pixels.
+    """
+    image = _subchunk_image(image_source, subchunk_index, n_subchunks,
+                            patchsize, block_rows)
+    nx, ny = image.patched_shape(patchsize)
+    # pixels are in x major order
+    x, y = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    xy = np.stack((x.ravel(), y.ravel()), axis=1) + patchsize + 0.5
+    return image.pix2lonlat(xy)
 
-def extract_features(image_source, targets, n_subchunks, patchsize):
+
+def _block_windows(pixels, image_source, patchsize):
     """
-    each node gets its own share of the targets, so all nodes
-    will always have targets
+    Group target pixels into read windows aligned to the source's blocks.
+
+    Targets falling in the same block share a read, and runs of horizontally
+    adjacent blocks in a block row are coalesced into a single window.
+
+    Returns
+    -------
+    windows: list
+        of ((xmin, xmax, ymin, ymax), indices) tuples, where the (exclusive)
+        window bounds include a halo of ``patchsize`` pixels and may lie
+        outside the image, and indices are the rows of ``pixels`` it covers.
     """
-    equiv_chunks = n_subchunks * mpiops.chunks
-    x_all = []
-    for i in range(equiv_chunks):
-        x = _extract_from_chunk(image_source, targets, i, equiv_chunks,
-                                patchsize)
-        if x is not None:
-            x_all.append(x)
-    if len(x_all) > 0:
-        x_all_data = np.concatenate([a.data for a in x_all], axis=0)
-        x_all_mask = np.concatenate([a.mask for a in x_all], axis=0)
-        x_all = np.ma.masked_array(x_all_data, mask=x_all_mask)
-    else:
-        raise ValueError("All targets lie outside image boundaries")
-    assert x_all.shape[0] == targets.observations.shape[0]
+    xres, yres = image_source.full_resolution[:2]
+    bx, by = image_source.block_shape or (xres, yres)
+    y0 = image_source.block_offset(by)
+    block_x = pixels[:, 0] // bx
+    block_y = (pixels[:, 1] - y0) // by
+
+    # unique blocks are sorted by block row, then block column
+    blocks, inverse = np.unique(np.stack((block_y, block_x), axis=1), axis=0,
+                                return_inverse=True)
+    new_run = np.ones(len(blocks), dtype=bool)
+    new_run[1:] = (blocks[1:, 0] != blocks[:-1, 0]) | \
+        (blocks[1:, 1] != blocks[:-1, 1] + 1)
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], len(blocks)) - 1
+
+    run_of_target = (np.cumsum(new_run) - 1)[inverse.ravel()]
+    order = np.argsort(run_of_target, kind='mergesort')
+    splits = np.searchsorted(run_of_target[order], np.arange(1, len(starts)))
+
+    windows = []
+    for s, e, indices in zip(starts, ends, np.split(order, splits)):
+        row, col_start = blocks[s]
+        col_end = blocks[e, 1]
+        window = (max(col_start * bx, 0) - patchsize,
+                  min((col_end + 1) * bx, xres) + patchsize,
+                  max(y0 + row * by, 0) - patchsize,
+                  min(y0 + (row + 1) * by, yres) + patchsize)
+        windows.append((window, indices))
+    return windows
+
+
+def _read_window(image_source, xmin, xmax, ymin, ymax):
+    """
+    Read a window from an image source, masking any part outside the image.
+    """
+    xres, yres = image_source.full_resolution[:2]
+    cxmin, cxmax = max(xmin, 0), min(xmax, xres)
+    cymin, cymax = max(ymin, 0), min(ymax, yres)
+    d = image_source.data(cxmin, cxmax, cymin, cymax)
+    data = d.data
+    mask = np.ma.getmaskarray(d)
+    pad = ((cxmin - xmin, xmax - cxmax), (cymin - ymin, ymax - cymax), (0, 0))
+    if np.any(pad):
+        data = np.pad(data, pad, mode='constant')
+        mask = np.pad(mask, pad, mode='constant', constant_values=True)
+    return data, mask
+
+
+def extract_features(image_source, targets, patchsize):
+    """
+    Extract the image patches at the target locations.
+
+    The target locations are converted to pixels once, and only the blocks
+    of the source that contain targets are read. Every node intersects its
+    own share of the targets, and the patches are returned in target order.
+    """
+    image = Image(image_source)
+    pixels = image.lonlat2pix(targets.positions)
+
+    side = 2 * patchsize + 1
+    shp = (pixels.shape[0], side, side, image.channels)
+    x_data = np.empty(shp, dtype=image_source.dtype)
+    x_mask = np.empty(shp, dtype=bool)
+
+    for (xmin, xmax, ymin, ymax), indices in _block_windows(
+            pixels, image_source, patchsize):
+        data, mask = _read_window(image_source, xmin, xmax, ymin, ymax)
+        # patch centres relative to the (haloed) window
+        points = pixels[indices] - [xmin, ymin]
+        x_data[indices] = patch.point_patches(data, patchsize, points)
+        x_mask[indices] = patch.point_patches(mask, patchsize, points)
+
+    x_all = np.ma.masked_array(data=x_data, mask=x_mask)
     return x_all
 
 
+def _stack_columns(vectors):
+    # plain concatenation, building a mask only if a vector has missing data
+    blocks = [FeatureBlock.from_masked(v) for v in vectors]
+    return FeatureBlock.concatenate(blocks, axis=1).to_masked()
+
+
 def transform_features(feature_sets, transform_sets, final_transform, config):
     # apply feature transforms
     transformed_vectors = [t(c) for c, t in zip(feature_sets, transform_sets)]
@@ -86,7 +216,11 @@ def transform_features(feature_sets, transform_sets, final_transform, config):
             log.info('Saving featurevec for reuse')
             pickle.dump(feature_vec, open(config.featurevec, 'wb'))
 
-    x = np.ma.concatenate(transformed_vectors, axis=1)
+    x = _stack_columns(transformed_vectors)
+    # with any ordinal sets, categorical ones are cast to their precision;
+    # sets that are all categorical stay integer
+    if np.issubdtype(x.dtype, np.floating):
+        x = x.astype(config.dtype, copy=False)
     if config.cubist or config.multicubist or config.krige:
         log.warning("{}: Ignoring preprocessing "
                     "transform".format(config.algorithm))
@@ -124,7 +258,7 @@ def save_intersected_features(feature_sets, transform_sets, config):
     transformed_vectors = [t(c) for c, t in zip(feature_sets,
                                                 transform_sets_mod)]
 
-    x = np.ma.concatenate(transformed_vectors, axis=1)
+    x = _stack_columns(transformed_vectors)
     x_all = gather_features(x, node=0)
     if mpiops.chunk_index == 0:
         np.savetxt(config.rawcovariates, X=x_all.data, delimiter=',',
@@ -163,9 +297,9 @@ def cull_all_null_rows(feature_sets):
 
 def gather_features(x, node=None):
     if node:
-        x_all = np.ma.vstack(mpiops.comm.gather(x, root=node))
+        x_all = mpiops.gather_masked(x, root=node)
     else:
-        x_all = np.ma.vstack(mpiops.comm.allgather(x))
+        x_all = mpiops.allgather_masked(x)
     return x_all
 
 
@@ -2,13 +2,24 @@ from __future__ import division
 
 import os.path
 import logging
+import threading
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import codecs
 import json
+import shutil
+import time
+from xml.sax.saxutils import escape
 import pickle
+import queue
 import matplotlib.pyplot as plt
 import rasterio
+import rasterio.shutil
 from rasterio.warp import reproject
+from rasterio.crs import CRS
 from affine import Affine
 import numpy as np
 import shapefile
@@ -27,13 +38,161 @@ log = logging.getLogger(__name__)
 _lower_is_better = ['mll', 'msll', 'smse', 'log_loss']
 
 
+class DatasetPool:
+    """
+    A per-process, LRU bounded pool of open rasterio datasets keyed by path.
+
+    Opening a GeoTIFF costs a metadata round trip, which on a shared
+    filesystem dominates small windowed reads. The pool keeps the most
+    recently used handles open so repeated reads of the same covariate reuse
+    them. GDAL handles must not be used by two threads at once, so a handle
+    is leased to one thread at a time, and a thread finding all handles of a
+    file in use opens another one.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of handles kept open. Handles that are in use
+        are never evicted, so the pool may temporarily exceed this size.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._idle = OrderedDict()  # path: idle handles, least recent first
+        self._n_idle = 0
+        self._n_in_use = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def open(self, filename):
+        """
+        Lease an open, read-only dataset for ``filename``.
+
+        Use as a drop in replacement for ``rasterio.open(filename, 'r')`` in
+        a ``with`` statement; the handle is returned to the pool, not closed,
+        at the end of the block.
+        """
+        path = os.path.abspath(filename)
+        dataset = None
+        with self._lock:
+            if path in self._idle:
+                self.hits += 1
+                dataset = self._idle[path].pop()
+                self._n_idle -= 1
+                if not self._idle[path]:
+                    del self._idle[path]
+            else:
+                self.misses += 1
+            self._n_in_use += 1
+        try:
+            if dataset is None:
+                # outside the lock, so other threads' leases do not wait
+                dataset = rasterio.open(path, 'r')
+            yield dataset
+        finally:
+            with self._lock:
+                self._n_in_use -= 1
+                if dataset is not None:
+                    self._idle.setdefault(path, []).append(dataset)
+                    self._idle.move_to_end(path)
+                    self._n_idle += 1
+                evicted = self._evict()
+            for d in evicted:
+                d.close()
+
+    def _evict(self):
+        """Take the least recently used idle handles over maxsize"""
+        evicted = []
+        while self._n_idle > 0 and len(self) > self.maxsize:
+            path, idle = next(iter(self._idle.items()))
+            evicted.append(idle.pop(0))
+            self._n_idle -= 1
+            if not idle:
+                del self._idle[path]
+        return evicted
+
+    def __len__(self):
+        return self._n_idle + self._n_in_use
+
+    def close(self):
+        """
+        Close all idle pooled datasets and log the hit and miss counts.
+        """
+        with self._lock:
+            idle = [d for v in self._idle.values() for d in v]
+            self._idle.clear()
+            self._n_idle = 0
+        for dataset in idle:
+            dataset.close()
+        log.debug("Dataset pool: {} hits, {} misses".format(self.hits,
+                                                            self.misses))
+
+
+dataset_pool = DatasetPool()
+"""DatasetPool: the handle pool shared by all RasterioImageSource objects
+"""
+
+
+def close_datasets():
+    """
+    Close the shared dataset pool and report its use across all nodes.
+    """
+    hits = mpiops.comm.allreduce(dataset_pool.hits)
+    misses = mpiops.comm.allreduce(dataset_pool.misses)
+    dataset_pool.close()
+    log.info("Dataset pool: {} hits, {} misses".format(hits, misses))
+
+
 class ImageSource:
     __metaclass__ = ABCMeta
 
+    _block_shape = None
+    _y_flipped = False
+
     @abstractmethod
-    def data(self, min_x, max_x, min_y, max_y):
+    def data(self, min_x, max_x, min_y, max_y, out=None):
+        """
+        The (x, y, band) masked array of a window of the image.
+
+        Parameters
+        ----------
+        min_x, max_x, min_y, max_y : int
+            The exclusive pixel bounds of the window
+        out : MaskedArray, optional
+            An (x, y, band) masked array with a full mask to read the window
+            into, instead of allocating a new one
+
+        Returns
+        -------
+        MaskedArray
+            The window, which is out if that was given
+        """
         pass
 
+    @staticmethod
+    def _fill(out, d):
+        if out is None:
+            return d
+        out.data[...] = d.data
+        out.mask[...] = np.ma.getmaskarray(d)
+        return out
+
+    def block_offset(self, block_rows):
+        """
+        The image row of a block boundary for blocks of ``block_rows`` rows.
+
+        Image rows count up from the southern edge, whereas GeoTIFF blocks
+        are laid out from the first file row, so for north-up files the block
+        boundaries are offset by the remainder of the image height.
+        """
+        return self._full_res[1] % block_rows if self._y_flipped else 0
+
+    @property
+    def block_shape(self):
+        """(x, y) shape of the internal blocks of the source, or None"""
+        return self._block_shape
+
     @property
     def full_resolution(self):
         return self._full_res
@@ -67,13 +226,18 @@ class ImageSource:
         return self._crs
 
 
+# the data decoded per read of a RasterioImageSource, so that it is still
+# in cache when its NaNs are masked
+_read_strip_bytes = 2 ** 20
+
+
 class RasterioImageSource(ImageSource):
 
     def __init__(self, filename):
 
         self._filename = filename
         assert os.path.isfile(filename), '{} does not exist'.format(filename)
-        with rasterio.open(self._filename, 'r') as geotiff:
+        with dataset_pool.open(self._filename) as geotiff:
             self._full_res = (geotiff.width, geotiff.height, geotiff.count)
             self._nodata_value = geotiff.meta['nodata']
             # we don't support different channels with different dtypes
@@ -83,6 +247,8 @@ class RasterioImageSource(ImageSource):
                                      "with differently typed channels")
             self._dtype = np.dtype(geotiff.dtypes[0])
             self._crs = geotiff.crs
+            block_rows, block_cols = geotiff.block_shapes[0]
+            self._block_shape = (block_cols, block_rows)
 
             A = geotiff.transform
             # No shearing or rotation allowed!!
@@ -99,7 +265,13 @@ class RasterioImageSource(ImageSource):
                 self._start_lat += self._pixsize_y * self._full_res[1]
                 self._pixsize_y *= -1
 
-    def data(self, min_x, max_x, min_y, max_y):
+    def data(self, min_x, max_x, min_y, max_y, out=None):
+        shape = (max_x - min_x, max_y - min_y, self._full_res[2])
+        if out is None or out.dtype != self._dtype:
+            d = np.ma.MaskedArray(data=np.empty(shape, dtype=self._dtype),
+                                  mask=np.empty(shape, dtype=bool))
+            return self._fill(out, self.data(min_x, max_x, min_y, max_y, d))
+        assert out.shape == shape
 
         if self._y_flipped:
             min_y_new = self._full_res[1] - max_y
@@ -107,33 +279,45 @@ class RasterioImageSource(ImageSource):
             min_y = min_y_new
             max_y = max_y_new
 
-        # NOTE these are exclusive
-        window = ((min_y, max_y), (min_x, max_x))
-        with rasterio.open(self._filename, 'r') as geotiff:
-            d = geotiff.read(window=window, masked=True)
-        d = d[np.newaxis, :, :] if d.ndim == 2 else d
-        d = np.ma.transpose(d, [2, 1, 0])  # Transpose and channels at back
-
-        # if nans exist in data, mask them, i.e. convert to nodatavalue
-        # TODO: Consider removal once covariates are fixed
-        nans = np.isnan(d.data)
-        if d.mask.ndim:
-            d.mask[nans] = True
-
+        # decode straight into (band, row, col) views of the (x, y, band)
+        # buffers, reversing the rows of north-up files
+        data = out.data.transpose(2, 1, 0)
+        mask = out.mask.transpose(2, 1, 0)
         if self._y_flipped:
-            d = d[:, ::-1]
-
-        # Otherwise scikit image complains
-        m = np.ma.MaskedArray(data=np.ascontiguousarray(d.data),
-                              mask=np.ascontiguousarray(d.mask))
-
-        # # uniform mask format
-        # if np.ma.count_masked(m) == 0:
-        #     m = np.ma.masked_array(data=m.data,
-        #                            mask=np.zeros_like(m.data, dtype=bool))
-        assert m.data.ndim == 3
-        assert m.mask.ndim == 3 or m.mask.ndim == 0
-        return m
+            data = data[:, ::-1]
+            mask = mask[:, ::-1]
+
+        # read strips of whole blocks, masking each while it is in cache
+        bands, height, width = data.shape
+        block_rows = self._block_shape[1]
+        rows = block_rows * max(1, _read_strip_bytes // (
+            block_rows * width * bands * self._dtype.itemsize))
+        valid = np.empty(bands * rows * width, dtype=np.uint8)
+        floating = np.issubdtype(self._dtype, np.floating)
+        if floating:
+            nan = np.empty(bands * rows * width, dtype=bool)
+        with dataset_pool.open(self._filename) as geotiff:
+            start = min_y
+            while start < max_y:
+                stop = min((start // rows + 1) * rows, max_y)
+                # NOTE these are exclusive
+                window = ((start, stop), (min_x, max_x))
+                s = slice(start - min_y, stop - min_y)
+                geotiff.read(window=window, out=data[:, s])
+                # read_masks ignores the strides of out, so read it into a
+                # contiguous buffer
+                n = bands * (stop - start) * width
+                v = valid[:n].reshape(bands, stop - start, width)
+                geotiff.read_masks(window=window, out=v)
+                np.equal(v, 0, out=mask[:, s])
+                # if nans exist in data, mask them, i.e. convert to
+                # nodatavalue
+                # TODO: Consider removal once covariates are fixed
+                if floating:
+                    mask[:, s] |= np.isnan(
+                        data[:, s], out=nan[:n].reshape(v.shape))
+                start = stop
+        return out
 
 
 class ArrayImageSource(ImageSource):
@@ -161,16 +345,299 @@ class ArrayImageSource(ImageSource):
         self._start_lat = origin[1]
         self._crs = crs
 
-    def data(self, min_x, max_x, min_y, max_y):
+    def data(self, min_x, max_x, min_y, max_y, out=None):
         # MUST BE EXCLUSIVE
         data_window = self._data[min_x:max_x, :][:, min_y:max_y]
-        return data_window
+        return self._fill(out, data_window)
+
+
+class CubeImageSource(ImageSource):
+    """
+    An image source serving a covariate from a cube built by `build_cube`.
+
+    The covariate is stored uncompressed as a (y, x, band) ``.npy`` file
+    with a boolean mask alongside, rows counting up from the southern edge
+    like `Image`. ``data`` returns memory mapped views of these, so row
+    windows are read straight from the page cache without decoding.
+
+    Parameters
+    ----------
+    cube_dir : string
+        The directory holding the cube
+    entry : dict
+        The covariate's record in the cube's index
+    """
+    def __init__(self, cube_dir, entry):
+        self._filename = entry['source']
+        self._data = np.load(os.path.join(cube_dir, entry['data']),
+                             mmap_mode='r')
+        self._mask = np.load(os.path.join(cube_dir, entry['mask']),
+                             mmap_mode='r')
+        self._full_res = tuple(entry['full_res'])
+        self._dtype = self._data.dtype
+        self._nodata_value = entry['nodata']
+        self._pixsize_x, self._pixsize_y = entry['pixsize']
+        self._start_lon, self._start_lat = entry['origin']
+        self._crs = CRS.from_wkt(entry['crs']) if entry['crs'] else None
+        # the GeoTIFF's blocks, so that chunks and reads align the same way
+        # whether or not the cube is used (older cubes did not record them)
+        if entry.get('block_shape') is not None:
+            self._block_shape = tuple(entry['block_shape'])
+        self._y_flipped = entry.get('y_flipped', False)
+
+    def data(self, min_x, max_x, min_y, max_y, out=None):
+        # MUST BE EXCLUSIVE
+        d = self._data[min_y:max_y, min_x:max_x].transpose(1, 0, 2)
+        m = self._mask[min_y:max_y, min_x:max_x].transpose(1, 0, 2)
+        return self._fill(out, np.ma.MaskedArray(data=d, mask=m, copy=False))
+
+
+_cube_index_file = 'cube.json'
+
+# parsed cube indices by index file, with the file stamp they were read at
+_cube_indices = {}
+
+
+def _file_stamp(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+
+def build_cube(config, cube_dir, max_rows_gb=0.25):
+    """
+    Write every covariate of the config's feature sets into a cube.
+
+    Files are shared out between the nodes and copied in bands of rows of
+    at most ``max_rows_gb`` so that large covariates never have to fit in
+    memory. Node 0 writes the index once all nodes have finished.
+
+    Parameters
+    ----------
+    config : Config
+        The uncoverml config listing the covariates
+    cube_dir : string
+        The directory to write the cube into
+    max_rows_gb : float
+        The size of the row bands copied at a time
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    files = sorted({os.path.abspath(f) for s in config.feature_sets
+                    for f in s.files})
+    entries = []
+    for i in np.array_split(np.arange(len(files)),
+                            mpiops.chunks)[mpiops.chunk_index]:
+        source = RasterioImageSource(files[i])
+        res_x, res_y, bands = source.full_resolution
+        stem = '{:04d}_{}'.format(
+            i, os.path.splitext(os.path.basename(files[i]))[0])
+        entry = {'source': files[i], 'data': stem + '.npy',
+                 'mask': stem + '_mask.npy', 'stamp': _file_stamp(files[i]),
+                 'full_res': source.full_resolution,
+                 'nodata': None if source.nodata_value is None
+                 else float(source.nodata_value),
+                 'pixsize': (source.pixsize_x, source.pixsize_y),
+                 'origin': (source.origin_longitude, source.origin_latitude),
+                 'crs': source.crs.to_wkt() if source.crs else None,
+                 'block_shape': source.block_shape,
+                 'y_flipped': source._y_flipped}
+        shape = (res_y, res_x, bands)
+        data = np.lib.format.open_memmap(os.path.join(cube_dir, entry['data']),
+                                         mode='w+', dtype=source.dtype,
+                                         shape=shape)
+        mask = np.lib.format.open_memmap(os.path.join(cube_dir, entry['mask']),
+                                         mode='w+', dtype=bool, shape=shape)
+        row_bytes = res_x * bands * (source.dtype.itemsize + 1)
+        step = max(int(max_rows_gb * 1e9 // row_bytes), 1)
+        for y in range(0, res_y, step):
+            d = source.data(0, res_x, y, min(y + step, res_y))
+            data[y:y + step] = d.data.transpose(1, 0, 2)
+            mask[y:y + step] = np.ma.getmaskarray(d).transpose(1, 0, 2)
+        data.flush()
+        mask.flush()
+        del data, mask
+        log.info("Added {} to cube".format(files[i]))
+        entries.append(entry)
+
+    entries = [e for n in mpiops.comm.allgather(entries) for e in n]
+    if mpiops.chunk_index == 0:
+        with open(os.path.join(cube_dir, _cube_index_file), 'w') as f:
+            json.dump({e['source']: e for e in entries}, f, indent=2)
+    mpiops.comm.barrier()
+    close_datasets()
+
+
+def _cube_index(index_file):
+    """The parsed cube index, read again only if the file has changed"""
+    stamp = _file_stamp(index_file)
+    cached = _cube_indices.get(index_file)
+    if cached is None or cached[0] != stamp:
+        with open(index_file, 'r') as f:
+            cached = (stamp, json.load(f))
+        _cube_indices[index_file] = cached
+    return cached[1]
+
+
+def image_source(filename, config):
+    """
+    The ImageSource to read a covariate through.
+
+    This is the covariate's entry in the configured cube if there is one
+    and it is up to date, otherwise the GeoTIFF itself.
+    """
+    if config.cube_dir is not None:
+        index_file = os.path.join(config.cube_dir, _cube_index_file)
+        if os.path.exists(index_file):
+            index = _cube_index(index_file)
+            name = os.path.abspath(filename)
+            entry = index.get(name)
+            if entry is None:
+                log.warning("{} is not in the cube, reading the "
+                            "GeoTIFF".format(name))
+            elif tuple(entry['stamp']) != _file_stamp(name):
+                log.warning("{} has changed since the cube was built, "
+                            "reading the GeoTIFF".format(name))
+            else:
+                return CubeImageSource(config.cube_dir, entry)
+        else:
+            log.warning("No cube found at {}, reading the "
+                        "GeoTIFFs".format(config.cube_dir))
+    return RasterioImageSource(filename)
+
+
+def _split_target_field(record_dict, targetfield, kind):
+    if targetfield in record_dict:
+        val = record_dict.pop(targetfield)
+    else:
+        raise ValueError("Can't find target property in {}. ".format(kind) +
+                         "Candidates: {}".format(record_dict.keys()))
+    return val, record_dict
+
+
+def _parse_numbers(column):
+    """Parse a column of fixed width ASCII numbers, blanks becoming nan"""
+    try:
+        return column.astype(float)
+    except ValueError:
+        column = np.char.strip(column)
+        column[(column == b'') | (np.char.count(column, b'*') > 0)] = b'nan'
+        return column.astype(float)
+
+
+def _part_bounds(n, part):
+    """The (start, stop) rows of part (index, count) of n rows, in the
+    same proportions as np.array_split"""
+    if part is None:
+        return 0, n
+    index, count = part
+    q, r = divmod(n, count)
+    start = index * q + min(index, r)
+    return start, start + q + int(index < r)
+
+
+def _dbf_encoding(filename):
+    """
+    The text encoding named by the shapefile's .cpg file, or None if it has
+    none or names one Python does not know.
+    """
+    cpg = os.path.splitext(filename)[0] + '.cpg'
+    if not os.path.exists(cpg):
+        return None
+    with open(cpg, 'r') as f:
+        name = f.read().strip()
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        log.warning("Unknown encoding {} in {}".format(name, cpg))
+        return None
+
+
+def _decode_text(column, encoding):
+    """Decode a column of byte strings, as UTF-8 or Latin-1 if not given"""
+    if encoding is not None:
+        return np.char.decode(column, encoding)
+    try:
+        return np.char.decode(column, 'utf-8')
+    except UnicodeDecodeError:
+        return np.char.decode(column, 'latin-1')
+
+
+def _read_dbf(filename, part=None):
+    """
+    The fields of a dBase file as typed columns, in file order.
+
+    Numeric fields are parsed straight from the fixed width records into
+    float arrays, and all other fields are read as strings, decoded as the
+    .cpg file says, or as UTF-8 like pyshp does. Only the records
+    of part (index, count) are read if it is given. Returns None if the
+    records read include deleted ones, which only pyshp knows what to do
+    with, and the total number of records.
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(32)
+        counts = np.frombuffer(header[4:12], dtype='<u4, <u2, <u2')[0]
+        nrecords, header_length, record_length = (int(k) for k in counts)
+        descriptors = f.read(header_length - 32)
+        start, stop = _part_bounds(nrecords, part)
+        f.seek(header_length + start * record_length)
+        raw = np.frombuffer(f.read((stop - start) * record_length),
+                            dtype=np.uint8)
+    records = raw.reshape(stop - start, record_length)
+    if np.any(records[:, 0] == ord('*')):
+        return None, nrecords
+
+    encoding = _dbf_encoding(filename)
+    columns = OrderedDict()
+    offset = 1  # the deletion flag
+    for i in range(0, len(descriptors) - 31, 32):
+        d = descriptors[i:i + 32]
+        if d[0] == 0x0D:
+            break
+        name = d[:11].split(b'\0', 1)[0].decode('ascii')
+        kind, length = chr(d[11]), int(d[16])
+        column = np.ascontiguousarray(records[:, offset:offset + length])
+        column = column.view('S{}'.format(length)).ravel()
+        if kind in 'NF':
+            columns[name] = _parse_numbers(column)
+        else:
+            column = _decode_text(np.char.strip(column), encoding)
+            columns[name] = column.astype('<U{}'.format(length))
+        offset += length
+    return columns, nrecords
 
 
-def load_shapefile(filename, targetfield):
+def _read_shp_points(filename, part=None):
     """
-    TODO
+    The x, y coordinates of a shapefile of points, and the total number of
+    points, or (None, None) if the shapes read are not all (non-null) points
+    of the same type. Only the points of part (index, count) are read if it
+    is given.
     """
+    with open(filename, 'rb') as f:
+        header = f.read(108)
+        # Point, PointM and PointZ records all start with a type and x, y
+        shape_type = np.frombuffer(header[32:36], dtype='<i4')[0]
+        if shape_type not in (1, 11, 21) or len(header) < 108:
+            return None, None
+        file_length = 2 * int(np.frombuffer(header[24:28], dtype='>i4')[0])
+        content_length = 2 * int(np.frombuffer(header[104:108],
+                                               dtype='>i4')[0])
+        record = np.dtype([('number', '>i4'), ('length', '>i4'),
+                           ('type', '<i4'), ('x', '<f8'), ('y', '<f8'),
+                           ('rest', 'V{}'.format(content_length - 20))])
+        npoints, remainder = divmod(file_length - 100, record.itemsize)
+        if remainder:
+            return None, None
+        start, stop = _part_bounds(npoints, part)
+        f.seek(100 + start * record.itemsize)
+        points = np.frombuffer(f.read((stop - start) * record.itemsize),
+                               dtype=record)
+    if np.any(points['type'] != shape_type) or \
+            np.any(points['length'] != content_length // 2):
+        return None, None
+    return np.stack((points['x'], points['y']), axis=1), npoints
+
+
+def _load_shapefile_pyshp(filename):
     sf = shapefile.Reader(filename)
     shapefields = [f[0] for f in sf.fields[1:]]  # Skip DeletionFlag
     dtype_flags = [(f[1], f[2]) for f in sf.fields[1:]]  # Skip DeletionFlag
@@ -179,53 +646,455 @@ def load_shapefile(filename, targetfield):
     records = np.array(sf.records()).T
     record_dict = {k: np.array(r, dtype=d) for k, r, d in zip(
         shapefields, records, dtypes)}
-    if targetfield in record_dict:
-        val = record_dict.pop(targetfield)
-    else:
-        raise ValueError("Can't find target property in shapefile." +
-                         "Candidates: {}".format(record_dict.keys()))
-    othervals = record_dict
 
     # Get coordinates
     coords = []
     for shape in sf.iterShapes():
         coords.append(list(shape.__geo_interface__['coordinates']))
     label_coords = np.array(coords).squeeze()
+    return label_coords, record_dict
+
+
+def load_shapefile(filename, targetfield, part=None):
+    """
+    Read point targets from a shapefile.
+
+    Point coordinates and the numeric fields of the attribute table are
+    parsed directly into numpy arrays. Other geometries, and files with
+    deleted records, are read through pyshp.
+
+    Parameters
+    ----------
+    filename : string
+        The .shp file
+    targetfield : string
+        The field with the target values
+    part : tuple, optional
+        (index, count): read only this part of the points. Returns None if
+        the file can only be read whole, through pyshp
+
+    Returns
+    -------
+    label_coords : ndarray
+        The (n, 2) array of point coordinates
+    val : ndarray
+        The target values
+    othervals : dict
+        The other fields, by name
+    """
+    stem = os.path.splitext(filename)[0]
+    label_coords, npoints = _read_shp_points(filename, part)
+    record_dict = None
+    if label_coords is not None:
+        record_dict, nrecords = _read_dbf(stem + '.dbf', part)
+    if record_dict is None or npoints != nrecords:
+        if part is not None:
+            return None
+        label_coords, record_dict = _load_shapefile_pyshp(filename)
+    val, othervals = _split_target_field(dict(record_dict), targetfield,
+                                         'shapefile')
     return label_coords, val, othervals
 
 
-def load_targets(shapefile, targetfield):
+def _table_columns(names, columns):
+    """Columns as numeric or string arrays, by name"""
+    record_dict = OrderedDict()
+    for name, column in zip(names, columns):
+        column = np.asarray(column)
+        if column.dtype.kind in 'biuf':
+            record_dict[str(name)] = column.astype(float)
+        else:
+            if column.dtype.kind == 'S':
+                column = np.char.decode(column, 'latin-1')
+            record_dict[str(name)] = column.astype(str)
+    return record_dict
+
+
+def _split_coordinates(record_dict, coordinates, filename):
+    lon, lat = coordinates
+    if lon not in record_dict or lat not in record_dict:
+        raise ValueError("Can't find coordinate columns {} and {} in "
+                         "{}".format(lon, lat, filename))
+    return np.stack((record_dict[lon], record_dict[lat]), axis=1)
+
+
+def _read_csv_part(filename, part):
     """
-    Loads the shapefile onto node 0 then distributes it across all
-    available nodes
+    The header line and the lines of a CSV file within part (index, count)
+    of its bytes, each line belonging to the part its first byte is in.
     """
-    if mpiops.chunk_index == 0:
-        lonlat, vals, othervals = load_shapefile(shapefile, targetfield)
-        # sort by y then x
-        ordind = np.lexsort(lonlat.T)
-        vals = vals[ordind]
-        lonlat = lonlat[ordind]
-        for k, v in othervals.items():
-            othervals[k] = v[ordind]
-
-        lonlat = np.array_split(lonlat, mpiops.chunks)
-        vals = np.array_split(vals, mpiops.chunks)
-        split_othervals = {k: np.array_split(v, mpiops.chunks)
-                           for k, v in othervals.items()}
-        othervals = [{k: v[i] for k, v in split_othervals.items()}
-                     for i in range(mpiops.chunks)]
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        header = f.readline()
+        data_start = f.tell()
+
+        def line_start(pos):
+            if pos <= data_start:
+                return data_start
+            f.seek(pos - 1)
+            f.readline()
+            return f.tell()
+
+        index, count = part
+        span = size - data_start
+        start = line_start(data_start + span * index // count)
+        stop = line_start(data_start + span * (index + 1) // count)
+        f.seek(start)
+        return header + f.read(max(stop - start, 0))
+
+
+def load_csv(filename, targetfield, coordinates=('lon', 'lat'), part=None):
+    """
+    Read point targets from a CSV file with a header row.
+
+    Parameters
+    ----------
+    filename : string
+        The CSV file
+    targetfield : string
+        The column with the target values
+    coordinates : tuple
+        The names of the longitude (x) and latitude (y) columns
+    part : tuple, optional
+        (index, count): read only this part of the file, split on line
+        boundaries by size. Fields must not contain quoted newlines
+
+    Returns
+    -------
+    label_coords, val, othervals
+        As for `load_shapefile`
+    """
+    import io
+    import pandas as pd
+    # the same types on every node, whatever its part of the file holds
+    dtype = {k: float for k in tuple(coordinates) + (targetfield,)}
+    if part is None:
+        frame = pd.read_csv(filename, dtype=dtype)
     else:
-        lonlat, vals, othervals = None, None, None
+        frame = pd.read_csv(io.BytesIO(_read_csv_part(filename, part)),
+                            dtype=dtype)
+    record_dict = _table_columns(frame.columns,
+                                 (frame[k].values for k in frame.columns))
+    label_coords = _split_coordinates(record_dict, coordinates, filename)
+    val, othervals = _split_target_field(record_dict, targetfield, 'csv')
+    return label_coords, val, othervals
 
-    lonlat = mpiops.comm.scatter(lonlat, root=0)
-    vals = mpiops.comm.scatter(vals, root=0)
-    othervals = mpiops.comm.scatter(othervals, root=0)
+
+def load_hdf5(filename, targetfield, coordinates=('lon', 'lat'), part=None):
+    """
+    Read point targets from the first table of an HDF5 file.
+
+    Parameters
+    ----------
+    filename : string
+        The HDF5 file, with a table of one row per point
+    targetfield : string
+        The column with the target values
+    coordinates : tuple
+        The names of the longitude (x) and latitude (y) columns
+    part : tuple, optional
+        (index, count): read only this part of the rows
+
+    Returns
+    -------
+    label_coords, val, othervals
+        As for `load_shapefile`
+    """
+    with hdf.open_file(filename, mode='r') as f:
+        table = next(f.walk_nodes('/', 'Table'), None)
+        if table is None:
+            raise ValueError("{} has no table of targets".format(filename))
+        start, stop = _part_bounds(table.nrows, part)
+        rows = table.read(start, stop)
+    names = rows.dtype.names
+    record_dict = _table_columns(names, (rows[k] for k in names))
+    label_coords = _split_coordinates(record_dict, coordinates, filename)
+    val, othervals = _split_target_field(record_dict, targetfield, 'hdf5')
+    return label_coords, val, othervals
+
+
+def load_points(filename, targetfield, coordinates=('lon', 'lat'),
+                part=None):
+    """
+    Read point targets from a shapefile, CSV or HDF5 file, by extension.
+
+    If part (index, count) is given only that part of the points is read,
+    or None is returned if the file can only be read whole.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        return load_csv(filename, targetfield, coordinates, part)
+    if ext in ('.h5', '.hdf', '.hdf5'):
+        return load_hdf5(filename, targetfield, coordinates, part)
+    return load_shapefile(filename, targetfield, part)
+
+
+_point_keys = np.dtype([('lat', 'f8'), ('lon', 'f8'), ('index', 'i8')])
+
+
+def _point_records(loaded):
+    """
+    Pack loaded points into one record array with the same dtype on every
+    node, with a global index to keep the sort stable.
+    """
+    n = 0 if loaded is None else len(loaded[1])
+    offset = mpiops.comm.exscan(n) or 0
+    if loaded is None:
+        columns = []
+    else:
+        lonlat, vals, othervals = loaded
+        columns = [('val', vals)] + sorted(othervals.items())
+
+    # agree on the fields from the nodes that have points
+    described = mpiops.comm.allgather(
+        (n, [(k, v.dtype.kind, v.dtype.itemsize) for k, v in columns]))
+    described = [d for k, d in described if k > 0] or \
+        [d for k, d in described if d]
+    names = [k for k, _, _ in described[0]] if described else ['val']
+    dtype = list(_point_keys.descr)
+    for i in range(len(names)):
+        kinds = [d[i][1] for d in described]
+        if 'U' in kinds or 'S' in kinds:
+            size = max(d[i][2] // 4 if d[i][1] == 'U' else d[i][2]
+                       for d in described)
+            dtype.append(('c{}'.format(i), '<U{}'.format(max(size, 1))))
+        else:
+            dtype.append(('c{}'.format(i), 'f8'))
+
+    records = np.empty(n, dtype=dtype)
+    records['index'] = offset + np.arange(n)
+    if loaded is not None:
+        records['lon'] = lonlat[:, 0]
+        records['lat'] = lonlat[:, 1]
+        for i, (_, v) in enumerate(columns):
+            records['c{}'.format(i)] = v
+    return records, names
+
+
+def _sorted_points(records):
+    keys = np.empty(len(records), dtype=_point_keys)
+    for k in _point_keys.names:
+        keys[k] = records[k]
+    order = np.argsort(keys, kind='mergesort')
+    return keys[order], records[order]
+
+
+def _sort_points(records):
+    """
+    Sort the points of every node by latitude then longitude, leaving each
+    node a contiguous run of about the same number of points.
+
+    Splitters are chosen from samples of every node's sorted points, and
+    the points are moved to their new nodes in a single exchange.
+    """
+    keys, records = _sorted_points(records)
+    n = len(keys)
+    n_samples = min(n, 32 * mpiops.chunks)
+    samples = keys[np.linspace(0, n - 1, n_samples).astype(int)] \
+        if n_samples else keys[:0]
+    weights = np.full(n_samples, n / n_samples) if n_samples else \
+        np.zeros(0)
+    samples = np.concatenate(mpiops.comm.allgather(samples))
+    weights = np.concatenate(mpiops.comm.allgather(weights))
+    s = np.argsort(samples, kind='mergesort')
+    cumulative = np.cumsum(weights[s])
+    total = cumulative[-1] if len(cumulative) else 0
+    cuts = np.searchsorted(cumulative, total * np.arange(1, mpiops.chunks) /
+                           mpiops.chunks)
+    splitters = samples[s][np.minimum(cuts, len(s) - 1)] \
+        if len(s) else keys[:0]
+    dest = np.searchsorted(splitters, keys, side='right')
+
+    records = mpiops.exchange_rows(records, dest)
+    return _sorted_points(records)[1]
+
+
+def load_targets(shapefile, targetfield, coordinates=('lon', 'lat')):
+    """
+    Loads the targets across all available nodes, sorted by y then x
+
+    Each node reads its own part of the file, unless the file can only be
+    read whole, when node 0 reads it all. The points are then moved into
+    sorted order with one exchange. The targets may be in a shapefile, or
+    a CSV or HDF5 file with coordinate columns, see `load_points`.
+    """
+    # every node reads its own part of the file if the format allows
+    loaded = load_points(shapefile, targetfield, coordinates,
+                         part=(mpiops.chunk_index, mpiops.chunks))
+    if not mpiops.comm.allreduce(loaded is not None, op=mpiops.MPI.LAND):
+        loaded = load_points(shapefile, targetfield, coordinates) \
+            if mpiops.chunk_index == 0 else None
+
+    # sort by y then x
+    records, names = _point_records(loaded)
+    records = _sort_points(records)
+    lonlat = np.stack((records['lon'], records['lat']), axis=1)
+    vals = records['c0']
+    othervals = {k: records['c{}'.format(i)]
+                 for i, k in enumerate(names) if i > 0}
     log.info("Node {} has been assigned {} targets".format(mpiops.chunk_index,
                                                            lonlat.shape[0]))
     targets = Targets(lonlat, vals, othervals=othervals)
     return targets
 
 
+_intersection_index_file = 'index.json'
+# caches of other inputs are removed once they have gone unused this long
+_intersection_max_age = 30 * 24 * 3600
+
+
+def _intersection_key(config):
+    """
+    Hash of everything the intersected covariates depend on.
+
+    That is the covariate files and the target file (by path, size and
+    modification time), the target field, the patchsize and the number of
+    nodes the targets are shared between.
+    """
+    target_stem = os.path.splitext(os.path.abspath(config.target_file))[0]
+    target_files = [os.path.abspath(config.target_file)] + \
+        [target_stem + ext for ext in ('.dbf', '.shx')
+         if os.path.exists(target_stem + ext)]
+    covariates = [os.path.abspath(f) for s in config.feature_sets
+                  for f in s.files]
+    description = {'covariates': [(f, _file_stamp(f)) for f in covariates],
+                   'targets': [(f, _file_stamp(f)) for f in target_files],
+                   'property': config.target_property,
+                   'coordinates': config.target_coordinates,
+                   'patchsize': config.patchsize,
+                   'nodes': mpiops.chunks}
+    encoded = json.dumps(description, sort_keys=True).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def _intersection_dir(config):
+    return os.path.join(config.output_dir, 'intersection_cache',
+                        _intersection_key(config),
+                        'node{:04d}'.format(mpiops.chunk_index))
+
+
+def load_intersection(config):
+    """
+    The cached intersection of the targets with the covariates, if any.
+
+    Every node loads its own share of the targets and covariate values.
+    The cache is only used if it is complete on every node; covariate
+    values are memory mapped rather than read up front.
+
+    Returns
+    -------
+    result : tuple or None
+        (image_chunk_sets, targets) as returned by `image_feature_sets`
+        and `load_targets`, or None if there is no up to date cache
+    """
+    cache_dir = _intersection_dir(config)
+    index_file = os.path.join(cache_dir, _intersection_index_file)
+    if not mpiops.comm.allreduce(os.path.exists(index_file),
+                                 op=mpiops.MPI.LAND):
+        return None
+    # mark the cache as in use, so that runs on other inputs keep it
+    if mpiops.chunk_index == 0:
+        os.utime(os.path.dirname(cache_dir))
+    with open(index_file, 'r') as f:
+        index = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(cache_dir, name), mmap_mode='r')
+
+    image_chunk_sets = []
+    for feature_set in index['feature_sets']:
+        chunks = OrderedDict()
+        for entry in feature_set:
+            mask = load(entry['mask']) if entry['mask'] else False
+            chunks[entry['source']] = np.ma.MaskedArray(
+                data=load(entry['data']), mask=mask)
+        image_chunk_sets.append(chunks)
+    fields = {k: np.asarray(load(v)) for k, v in index['fields'].items()}
+    targets = Targets(np.asarray(load('positions.npy')),
+                      np.asarray(load('observations.npy')),
+                      othervals=fields)
+    log.info("Node {} loaded {} intersected targets from {}".format(
+        mpiops.chunk_index, targets.observations.shape[0], cache_dir))
+    return image_chunk_sets, targets
+
+
+def save_intersection(image_chunk_sets, targets, config):
+    """
+    Cache the intersection of the targets with the covariates.
+
+    Each node writes its share as one .npy file per covariate (and its
+    mask, if anything is masked) and per target field, so that it can be
+    loaded with `load_intersection` while the inputs are unchanged. Caches
+    of other inputs are removed once unused for `_intersection_max_age`
+    seconds, so that other runs sharing the output directory keep theirs.
+    """
+    cache_dir = _intersection_dir(config)
+    partial_dir = cache_dir + '.partial'
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
+
+    def save(name, a):
+        np.save(os.path.join(partial_dir, name), np.ma.getdata(a))
+        return name
+
+    index = {'feature_sets': [], 'fields': {}}
+    for i, chunks in enumerate(image_chunk_sets):
+        feature_set = []
+        for j, (source, x) in enumerate(chunks.items()):
+            stem = '{:03d}_{:04d}'.format(i, j)
+            mask = np.ma.getmask(x)
+            has_mask = mask is not np.ma.nomask and mask.any()
+            feature_set.append({
+                'source': source,
+                'data': save(stem + '.npy', x),
+                'mask': save(stem + '_mask.npy', mask) if has_mask else None})
+        index['feature_sets'].append(feature_set)
+    save('positions.npy', targets.positions)
+    save('observations.npy', targets.observations)
+    for k, (name, v) in enumerate(sorted(targets.fields.items())):
+        index['fields'][name] = save('field_{:03d}.npy'.format(k), v)
+    with open(os.path.join(partial_dir, _intersection_index_file), 'w') as f:
+        json.dump(index, f, indent=2)
+
+    # replace any old cache only once this one is complete
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(partial_dir, cache_dir)
+    log.info("Node {} cached its intersected targets in {}".format(
+        mpiops.chunk_index, cache_dir))
+
+    if mpiops.chunk_index == 0:
+        root, key = os.path.split(os.path.dirname(cache_dir))
+        expiry = time.time() - _intersection_max_age
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                stale = name != key and os.path.getmtime(path) < expiry
+            except OSError:  # removed by another run meanwhile
+                stale = False
+            if stale:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def block_alignment(config):
+    """
+    The block height and offset to align image chunks to.
+
+    These are read from the first covariate. Returns (None, 0), i.e. the
+    plain even splitting, if block alignment is not configured or the
+    covariate is neither tiled nor striped in multi-row blocks.
+    """
+    if not config.block_aligned:
+        return None, 0
+    source = RasterioImageSource(config.feature_sets[0].files[0])
+    block_rows = source.block_shape[1]
+    if block_rows <= 1:
+        log.info("{} is not tiled, ignoring block "
+                 "alignment".format(source._filename))
+        return None, 0
+    log.info("Aligning image chunks to {} row blocks".format(block_rows))
+    return block_rows, source.block_offset(block_rows)
+
+
 def get_image_spec(model, config):
     # temp workaround, we should have an image spec to check against
     nchannels = len(model.get_predict_tags())
@@ -237,14 +1106,227 @@ def get_image_spec(model, config):
     return eff_shape, eff_bbox, crs
 
 
+def _block_sums(data, ystart, k, nodata):
+    """
+    Sum and count the valid pixels of (band, y, x) rows starting at image
+    row ystart over the k by k blocks of the image they fall in.
+
+    Returns
+    -------
+    row : int
+        The block row of the first rows
+    sums, counts : ndarray
+        (band, block row, block column) sums and valid pixel counts
+    """
+    bands, height, width = data.shape
+    top = ystart % k
+    shp = (bands, -(-(top + height) // k), k, -(-width // k), k)
+    valid = np.zeros((bands, shp[1] * k, shp[3] * k), dtype=bool)
+    valid[:, top:top + height, :width] = data != nodata
+    values = np.zeros(valid.shape)
+    values[:, top:top + height, :width] = data
+    values[~valid] = 0
+    return (ystart // k, values.reshape(shp).sum(axis=(2, 4)),
+            valid.reshape(shp).sum(axis=(2, 4)))
+
+
+def _block_mean(sums, counts, nodata):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts
+    mean[counts == 0] = nodata
+    return mean.astype(np.float32)
+
+
+class _Decimator:
+    """
+    Accumulates a block averaged copy of an output raster as it is written.
+
+    Parameters
+    ----------
+    shape : tuple
+        (x, y) shape of the full resolution raster
+    bands : int
+        The number of bands
+    ratio : int
+        The side of the square blocks that are averaged
+    nodata : float
+        Pixels with this value are left out of the averages
+    """
+    def __init__(self, shape, bands, ratio, nodata):
+        self.ratio = ratio
+        self.nodata = nodata
+        shp = (bands, -(-shape[1] // ratio), -(-shape[0] // ratio))
+        self.sum = np.zeros(shp)
+        self.count = np.zeros(shp, dtype=int)
+
+    def add(self, data, ystart):
+        """Add (band, y, x) rows of the raster starting at row ystart"""
+        row, sums, counts = _block_sums(data, ystart, self.ratio,
+                                        self.nodata)
+        self.sum[:, row:row + sums.shape[1]] += sums
+        self.count[:, row:row + counts.shape[1]] += counts
+
+    def reduce(self):
+        """Sum the accumulations of all nodes onto node 0"""
+        self.sum = mpiops.comm.reduce(self.sum, root=0)
+        self.count = mpiops.comm.reduce(self.count, root=0)
+
+    def mean(self):
+        return _block_mean(self.sum, self.count, self.nodata)
+
+
+class _Overviews:
+    """
+    Average overview levels of an output raster, built from its rows while
+    they are in memory rather than by reading the raster back.
+
+    At factor k an overview row averages the valid pixels of a k row band
+    of the image. Rows whose band lies within one write are complete
+    straight away. The sums of bands split between writes (or nodes) are
+    kept until the rest of them has been added.
+
+    Parameters
+    ----------
+    shape : tuple
+        (x, y) shape of the full resolution raster
+    factors : list
+        The overview factors
+    nodata : float
+        Pixels with this value are left out of the averages
+    """
+    def __init__(self, shape, factors, nodata):
+        self.width, self.height = shape[:2]
+        self.factors = factors
+        self.nodata = nodata
+        self.partial = {}  # (factor, row): [sums, counts, image rows]
+
+    def shape(self, k):
+        """(x, y) shape of the overview at factor k"""
+        return -(-self.width // k), -(-self.height // k)
+
+    def complete_rows(self, ystart, height, k):
+        """The overview rows at factor k that rows ystart:ystart+height
+        cover entirely, as a (start, stop) range"""
+        stop = ystart + height
+        start = -(-ystart // k)
+        stop = -(-stop // k) if stop == self.height else stop // k
+        return start, max(start, stop)
+
+    def add(self, data, ystart):
+        """
+        Add (band, y, x) rows of the raster starting at row ystart.
+
+        Returns
+        -------
+        levels : list
+            (factor, first row, (band, y, x) overview rows) of the rows
+            these complete by themselves
+        """
+        levels = []
+        height = data.shape[1]
+        for k in self.factors:
+            row, sums, counts = _block_sums(data, ystart, k, self.nodata)
+            start, stop = self.complete_rows(ystart, height, k)
+            levels.append((k, start, _block_mean(
+                sums[:, start - row:stop - row],
+                counts[:, start - row:stop - row], self.nodata)))
+            for r in range(row, row + sums.shape[1]):
+                if start <= r < stop:
+                    continue
+                rows = min((r + 1) * k, ystart + height) - max(r * k, ystart)
+                self._add_partial((k, r), [sums[:, r - row],
+                                           counts[:, r - row], rows])
+        return levels
+
+    def _add_partial(self, key, value):
+        if key in self.partial:
+            value = [a + b for a, b in zip(self.partial[key], value)]
+        self.partial[key] = value
+
+    def merge(self):
+        """Gather the partial rows of all nodes onto node 0"""
+        gathered = mpiops.comm.gather(self.partial, root=0)
+        self.partial = {}
+        if mpiops.chunk_index == 0:
+            for partial in gathered:
+                for key, value in partial.items():
+                    self._add_partial(key, value)
+
+    def pop_complete(self):
+        """
+        The rows of which all image rows have now been added, as a list of
+        (factor, row, (band, x) overview row).
+        """
+        done = []
+        for (k, r), (sums, counts, rows) in sorted(self.partial.items()):
+            if rows == min((r + 1) * k, self.height) - r * k:
+                done.append((k, r, _block_mean(sums, counts, self.nodata)))
+                del self.partial[(k, r)]
+        return done
+
+
+_cog_options = {'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+                'compress': 'deflate', 'predictor': 3}
+
+_cog_overviews = [2, 4, 8, 16, 32]
+
+
+_vrt_dataset = """<VRTDataset rasterXSize="{width}" rasterYSize="{height}">
+  <SRS>{crs}</SRS>
+  <GeoTransform>{transform}</GeoTransform>
+  <VRTRasterBand dataType="Float32" band="1">
+    <Metadata>
+      <MDI key="image_type">{tag}</MDI>
+    </Metadata>
+    <NoDataValue>{nodata}</NoDataValue>{sources}{overviews}
+  </VRTRasterBand>
+</VRTDataset>
+"""
+
+_vrt_source = """
+    <SimpleSource>
+      <SourceFilename relativeToVRT="1">{file}</SourceFilename>
+      <SourceBand>{band}</SourceBand>
+      <SrcRect xOff="0" yOff="{src_y}" xSize="{width}" ySize="{height}"/>
+      <DstRect xOff="0" yOff="{ystart}" xSize="{width}" ySize="{height}"/>
+    </SimpleSource>"""
+
+_vrt_overview = """
+    <Overview>
+      <SourceFilename relativeToVRT="1">{file}</SourceFilename>
+      <SourceBand>{band}</SourceBand>
+    </Overview>"""
+
+# COG driver names of the GTiff predictor options
+_cog_predictors = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}
+
+
 class ImageWriter:
 
     nodata_value = np.array(-1e20, dtype='float32')
 
     def __init__(self, shape, bbox, crs, name, n_subchunks, outputdir,
-                 band_tags=None, independent=False, **kwargs):
+                 band_tags=None, independent=False, block_rows=None,
+                 block_offset=0, parallel=False, cog=False, overviews=None,
+                 thumbnails=None, write_behind=0, **kwargs):
         """
         pass in additional geotif write options in kwargs
+
+        With parallel set every node writes its own partitions straight to
+        disk as GeoTIFF parts, and node 0 joins them into one VRT per band
+        on close, instead of funnelling all partitions through node 0.
+
+        With cog set the output is tiled and compressed, with average
+        overviews at the given factors. The overviews, and thumbnails
+        decimated by an integer ratio, are averaged from the partitions as
+        they are written, rather than by reading the output back. On close
+        each band is copied with its overviews into a cloud optimised
+        GeoTIFF, or with parallel set the VRTs get them as overviews.
+
+        With write_behind > 0 the local file writes happen on a background
+        thread, so a partition is written while the next one is predicted.
+        At most write_behind partitions wait in the queue; close waits for
+        them to be written. Communication stays on the calling thread.
         """
         # affine
         self.A, _, _ = image.bbox2affine(bbox[1, 0], bbox[0, 0],
@@ -257,9 +1339,37 @@ class ImageWriter:
         self.outputdir = outputdir
         self.n_subchunks = n_subchunks
         self.independent = independent  # mpi control
-        self.sub_starts = [k[0] for k in np.array_split(
-                           np.arange(self.shape[1]),
-                           mpiops.chunks * self.n_subchunks)]
+        self.parallel = parallel and not independent
+        self.crs = crs
+        if cog:
+            kwargs = dict(_cog_options, **kwargs)
+        self.kwargs = kwargs
+        self.overviews = sorted(overviews or _cog_overviews) if cog else []
+        factors = [k for k in self.overviews if k < max(shape[0], shape[1])]
+        self._overviews = None
+        if factors and (self.parallel or mpiops.chunk_index == 0):
+            self._overviews = _Overviews(shape, factors, self.nodata_value)
+        self.thumbnail_ratio = None
+        self.thumbnails = None
+        if thumbnails and int(thumbnails) == thumbnails and not independent:
+            self.thumbnail_ratio = int(thumbnails)
+            # accumulated where the partitions are written
+            if self.parallel or mpiops.chunk_index == 0:
+                self.thumbnails = _Decimator(shape, self.outbands,
+                                             self.thumbnail_ratio,
+                                             self.nodata_value)
+        # must match the splits used to read the covariates
+        self.sub_starts = [k[0] for k in image.construct_splits(
+                           self.shape[1], mpiops.chunks * self.n_subchunks,
+                           block_rows=block_rows, block_offset=block_offset)]
+
+        self._error = None
+        self._queue = None
+        if write_behind > 0:
+            self._queue = queue.Queue(maxsize=write_behind)
+            self._writer = threading.Thread(target=self._write_behind,
+                                            daemon=True)
+            self._writer.start()
 
         # file tags don't have spaces
         if band_tags:
@@ -267,21 +1377,52 @@ class ImageWriter:
         else:
             file_tags = [str(k) for k in range(self.outbands)]
             band_tags = file_tags
+        self.band_tags = band_tags
 
         files = []
         file_names = []
 
+        if self.parallel:
+            self.files = []
+            self.parts = []
+            self.part_dir = os.path.join(outputdir, name + "_parts")
+            if mpiops.chunk_index == 0:
+                os.makedirs(self.part_dir, exist_ok=True)
+            self.file_names = [os.path.join(outputdir, name + "_" + t +
+                                            ".vrt") for t in file_tags]
+            mpiops.comm.barrier()
+            return
+
         if mpiops.chunk_index == 0:
+            if self._overviews:
+                # the full resolution bands and their overview levels are
+                # written to these first, then copied into the COGs
+                self._full_names = []
+                self._level_files = []
             for band in range(self.outbands):
                 output_filename = os.path.join(outputdir, name + "_" +
                                                file_tags[band] + ".tif")
-                f = rasterio.open(output_filename, 'w', driver='GTiff',
+                write_filename = output_filename
+                options = kwargs
+                if self._overviews:
+                    write_filename = os.path.splitext(output_filename)[0] + \
+                        "_full.tif"
+                    self._full_names.append(write_filename)
+                    self._level_files.append(OrderedDict(
+                        (k, self._create(self._level_name(write_filename, k),
+                                         *self._overviews.shape(k),
+                                         self.A * Affine.scale(k), count=1))
+                        for k in factors))
+                    # it is read once more, so left uncompressed
+                    options = {k: v for k, v in kwargs.items()
+                               if k not in ('compress', 'predictor')}
+                f = rasterio.open(write_filename, 'w', driver='GTiff',
                                   width=self.shape[0], height=self.shape[1],
                                   dtype=np.float32, count=1,
                                   crs=crs,
                                   transform=self.A,
                                   nodata=self.nodata_value,
-                                  **kwargs
+                                  **options
                                   )
                 f.update_tags(1, image_type=band_tags[band])
                 files.append(f)
@@ -307,7 +1448,8 @@ class ImageWriter:
             independent image writing by different processes, i.e., images are not chunked
         :return:
         """
-        x = x.astype(np.float32)
+        # only the first outbands of the predicted bands are written
+        x = x[:, :self.outbands].astype(np.float32)
         rows = self.shape[0]
         bands = x.shape[1]
 
@@ -316,14 +1458,20 @@ class ImageWriter:
         if x.mask is not False:
             x.data[x.mask] = self.nodata_value
 
+        if self.parallel:
+            # no communication: each node writes its own rows, in any
+            # order (within mpiops.local subchunk_index is the tile)
+            subindex = mpiops.chunks*subchunk_index + mpiops.chunk_index
+            self._submit(self._write_part, image, self.sub_starts[subindex])
+            return
+
+        self._raise_write_error()
         mpiops.comm.barrier()
         log.info("Writing partition to output file")
 
         if self.independent:
             data = np.ma.transpose(image, [2, 1, 0])  # untranspose
-            # write each band separately
-            for i, f in enumerate(self.files):
-                f.write(data[i:i+1])
+            self._submit(self._write_window, data, None)
         else:
             if mpiops.chunk_index != 0:
                 mpiops.comm.send(image, dest=0)
@@ -335,27 +1483,268 @@ class ImageWriter:
                     data = mpiops.comm.recv(source=node) \
                         if node != 0 else image
                     data = np.ma.transpose(data, [2, 1, 0])  # untranspose
-                    yend = ystart + data.shape[1]  # this is Y
-                    window = ((ystart, yend), (0, self.shape[0]))
-                    # write each band separately
-                    for i, f in enumerate(self.files):
-                        f.write(data[i:i+1], window=window)
+                    self._submit(self._write_window, data, ystart)
 
         mpiops.comm.barrier()
 
+    def _write_window(self, data, ystart):
+        """
+        Write (band, y, x) rows starting at ystart into the band files, or
+        the whole of each file if ystart is None.
+        """
+        window = None
+        if ystart is not None:
+            yend = ystart + data.shape[1]  # this is Y
+            window = ((ystart, yend), (0, self.shape[0]))
+        # write each band separately
+        for i, f in enumerate(self.files):
+            f.write(data[i:i+1], window=window)
+        if self.thumbnails and ystart is not None:
+            self.thumbnails.add(data.data, ystart)
+        if self._overviews:
+            levels = self._overviews.add(data.data, ystart or 0)
+            # rows split between partitions are complete once both are in
+            levels += [(k, r, row[:, np.newaxis]) for k, r, row
+                       in self._overviews.pop_complete()]
+            for k, start, rows in levels:
+                window = ((start, start + rows.shape[1]), (0, rows.shape[2]))
+                for i, files in enumerate(self._level_files):
+                    if rows.shape[1]:
+                        files[k].write(rows[i:i + 1], window=window)
+
+    def _submit(self, write, *args):
+        """
+        Run a local write now, or queue it for the write-behind thread.
+        """
+        if self._queue is None:
+            write(*args)
+        else:
+            # blocks while write_behind partitions are already in flight;
+            # errors are raised at the next collective check
+            self._queue.put((write, args))
+
+    def _write_behind(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            write, args = job
+            if self._error is None:
+                try:
+                    write(*args)
+                except Exception as e:
+                    self._error = e
+
+    def _raise_write_error(self):
+        """
+        Raise any error of the write-behind thread. This is a collective
+        call: every node raises if any failed, instead of the others
+        waiting forever in the next collective call.
+        """
+        failed = mpiops.comm.allreduce(self._error is not None,
+                                       op=mpiops.MPI.LOR)
+        if self._error is not None:
+            raise RuntimeError("Writing output failed") from self._error
+        if failed:
+            raise RuntimeError("Writing output failed on another node")
+
+    def _drain(self):
+        """Wait for all queued writes to finish"""
+        if self._queue is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._queue = None
+        self._raise_write_error()
+
+    def _write_part(self, image, ystart):
+        """
+        Write the rows of the output starting at ystart to their own file.
+        """
+        data = np.ma.transpose(image, [2, 1, 0]).data  # untranspose
+        height = data.shape[1]
+        filename = os.path.join(self.part_dir,
+                                "{}_{:06d}.tif".format(self.name, ystart))
+        log.info("Writing rows {}-{} to {}".format(ystart, ystart + height,
+                                                   filename))
+        with rasterio.open(filename, 'w', driver='GTiff',
+                           width=self.shape[0], height=height,
+                           dtype=np.float32, count=self.outbands,
+                           crs=self.crs,
+                           transform=self.A * Affine.translation(0, ystart),
+                           nodata=self.nodata_value, **self.kwargs) as f:
+            f.write(data)
+        if self._overviews:
+            # the overview rows of the part's own rows; those it shares
+            # with other parts are merged on close
+            for k, start, rows in self._overviews.add(data, ystart):
+                if rows.shape[1]:
+                    with self._create(self._level_name(filename, k),
+                                      rows.shape[2], rows.shape[1],
+                                      self.A * Affine.scale(k) *
+                                      Affine.translation(0, start)) as f:
+                        f.write(rows)
+        if self.thumbnails:
+            self.thumbnails.add(data, ystart)
+        self.parts.append((filename, ystart, height))
+
+    def _create(self, filename, width, height, transform, count=None):
+        """Open an uncompressed GeoTIFF of the output bands for writing"""
+        return rasterio.open(filename, 'w', driver='GTiff', width=width,
+                             height=height, dtype=np.float32,
+                             count=count or self.outbands, crs=self.crs,
+                             transform=transform, nodata=self.nodata_value)
+
+    @staticmethod
+    def _level_name(filename, k):
+        return os.path.splitext(filename)[0] + "_ovr{}.tif".format(k)
+
+    def _vrt_source(self, filename, band, width, height, ystart, src_y=0):
+        return _vrt_source.format(
+            file=os.path.relpath(filename, self.outputdir), band=band + 1,
+            width=width, height=height, ystart=ystart, src_y=src_y)
+
+    def _vrt(self, width, height, transform, tag, sources, overviews=""):
+        crs = escape(self.crs.to_wkt(), {'"': '&quot;'}) if self.crs else ''
+        return _vrt_dataset.format(
+            width=width, height=height, crs=crs, tag=tag,
+            nodata=repr(float(self.nodata_value)), sources=sources,
+            overviews=overviews,
+            transform=", ".join(repr(float(t)) for t in transform.to_gdal()))
+
+    def _write_cogs(self):
+        """
+        Copy each band with its overview levels into a cloud optimised
+        GeoTIFF, which lays the overviews out ahead of the full resolution
+        data. This reads the full resolution band once more, but GDAL uses
+        the overviews as they are rather than computing them again.
+        """
+        for levels in self._level_files:
+            for f in levels.values():
+                f.close()
+        width, height = self.shape[:2]
+        options = {'OVERVIEWS': 'FORCE_USE_EXISTING',
+                   'BLOCKSIZE': self.kwargs.get('blockxsize', 512)}
+        if 'compress' in self.kwargs:
+            options['COMPRESS'] = str(self.kwargs['compress']).upper()
+        if 'predictor' in self.kwargs:
+            options['PREDICTOR'] = _cog_predictors.get(
+                self.kwargs['predictor'], self.kwargs['predictor'])
+        for filename, full, levels, tag in zip(
+                self.file_names, self._full_names, self._level_files,
+                self.band_tags):
+            vrt = os.path.splitext(full)[0] + ".vrt"
+            overviews = "".join(_vrt_overview.format(
+                file=os.path.basename(f.name), band=1)
+                for f in levels.values())
+            with open(vrt, 'w') as f:
+                f.write(self._vrt(width, height, self.A, tag,
+                                  self._vrt_source(full, 0, width, height, 0),
+                                  overviews))
+            rasterio.shutil.copy(vrt, filename, driver='COG', **options)
+            for name in [vrt, full] + [f.name for f in levels.values()]:
+                os.remove(name)
+
+    def _write_edges(self):
+        """
+        Write the overview rows split between parts, merged from all nodes,
+        to a file per level.
+
+        Returns
+        -------
+        edges : dict
+            factor: (filename, the overview row of each of its rows)
+        """
+        done = self._overviews.pop_complete()
+        edges = {}
+        for k in self._overviews.factors:
+            rows = [(r, row) for j, r, row in done if j == k]
+            if not rows:
+                edges[k] = (None, [])
+                continue
+            filename = os.path.join(self.part_dir, "{}_edges_ovr{}.tif".format(
+                self.name, k))
+            data = np.stack([row for _, row in rows], axis=1)
+            with self._create(filename, data.shape[2], data.shape[1],
+                              self.A * Affine.scale(k)) as f:
+                f.write(data)
+            edges[k] = (filename, [r for r, _ in rows])
+        return edges
+
+    def _write_vrts(self, parts):
+        """
+        Join the parts into a VRT per band, with VRTs of the parts' overview
+        rows as its overviews.
+        """
+        parts = sorted(parts, key=lambda p: p[1])
+        width, height = self.shape[:2]
+        edges = self._write_edges() if self._overviews else {}
+        for band, (vrt, tag) in enumerate(zip(self.file_names,
+                                              self.band_tags)):
+            overviews = ""
+            for k, (edge_file, edge_rows) in edges.items():
+                w, h = self._overviews.shape(k)
+                sources = []
+                for f, y, n in parts:
+                    start, stop = self._overviews.complete_rows(y, n, k)
+                    if stop > start:
+                        sources.append(self._vrt_source(
+                            self._level_name(f, k), band, w, stop - start,
+                            start))
+                sources += [self._vrt_source(edge_file, band, w, 1, r, i)
+                            for i, r in enumerate(edge_rows)]
+                ovr = os.path.splitext(vrt)[0] + "_ovr{}.vrt".format(k)
+                with open(ovr, 'w') as f:
+                    f.write(self._vrt(w, h, self.A * Affine.scale(k), tag,
+                                      "".join(sources)))
+                overviews += _vrt_overview.format(
+                    file=os.path.basename(ovr), band=1)
+            sources = "".join(self._vrt_source(f, band, width, n, y)
+                              for f, y, n in parts)
+            with open(vrt, 'w') as f:
+                f.write(self._vrt(width, height, self.A, tag, sources,
+                                  overviews))
+
     def close(self):  # we can explicitly close rasters using this
-        if mpiops.chunk_index == 0:
+        self._drain()
+        if self.parallel:
+            parts = mpiops.comm.gather(self.parts, root=0)
+            if self._overviews:
+                self._overviews.merge()
+            if mpiops.chunk_index == 0:
+                self._write_vrts([p for n in parts for p in n])
+            if self.thumbnails:
+                self.thumbnails.reduce()
+        elif mpiops.chunk_index == 0:
             for f in self.files:
                 f.close()
+            if self._overviews:
+                self._write_cogs()
+        if self.thumbnails and mpiops.chunk_index == 0:
+            self._write_thumbnails()
         mpiops.comm.barrier()
 
+    def _thumbnail_name(self, filename):
+        return os.path.splitext(filename)[0] + '_thumbnail.tif'
+
+    def _write_thumbnails(self):
+        mean = self.thumbnails.mean()
+        transform = self.A * Affine.scale(self.thumbnails.ratio)
+        for band, f in enumerate(self.file_names):
+            with rasterio.open(self._thumbnail_name(f), 'w', driver='GTiff',
+                               height=mean.shape[1], width=mean.shape[2],
+                               count=1, dtype=np.float32, crs=self.crs,
+                               transform=transform,
+                               nodata=self.nodata_value) as dest:
+                dest.write(mean[band:band + 1])
+
     def output_thumbnails(self, ratio=10):
+        if self.thumbnail_ratio == ratio:
+            return  # written from memory on close
+
         this_chunk_files = np.array_split(self.file_names,
                                           mpiops.chunks)[mpiops.chunk_index]
         for f in this_chunk_files:
-            thumbnails = os.path.splitext(f)
-            thumbnail = thumbnails[0] + '_thumbnail' + thumbnails[1]
-            resample(f, output_tif=thumbnail, ratio=ratio)
+            resample(f, output_tif=self._thumbnail_name(f), ratio=ratio)
 
 
 def feature_names(config):
@@ -372,14 +1761,52 @@ def feature_names(config):
 
 
 def _iterate_sources(f, config):
+    """
+    Apply f to an ImageSource of every covariate in every feature set.
+
+    With ``config.io_threads`` greater than one the covariates are read
+    concurrently; f must then not communicate over MPI. The missing data
+    report, which does, is made afterwards from the main thread.
+    """
+    return _collate_sources(_read_sources(f, config), config)
+
+
+def _read_sources(f, config):
+    """
+    The results of f for every covariate, in config order.
+
+    There is no MPI communication here, so this is safe to call from a
+    background thread.
+    """
+    def read(tif):
+        return f(image_source(tif, config))
+
+    files = [tif for s in config.feature_sets for tif in s.files]
+    return _map_sources(read, config, files)
+
+
+def _map_sources(f, config, *args):
+    """
+    map(f, *args) over the covariates, on ``config.io_threads`` threads.
+    """
+    if config.io_threads > 1 and len(args[0]) > 1:
+        with ThreadPoolExecutor(config.io_threads) as executor:
+            return list(executor.map(f, *args))
+    return list(map(f, *args))
 
+
+def _collate_sources(extracted, config):
+    """
+    Report missing data and group the results of `_read_sources` into an
+    OrderedDict per feature set.
+    """
     results = []
+    extracted = iter(extracted)
     for s in config.feature_sets:
         extracted_chunks = {}
         for tif in s.files:
             name = os.path.abspath(tif)
-            image_source = RasterioImageSource(tif)
-            x = f(image_source)
+            x = next(extracted)
             # TODO this may hurt performance. Consider removal
             if type(x) is np.ma.MaskedArray:
                 count = mpiops.count(x)
@@ -409,24 +1836,128 @@ def image_resolutions(config):
     return result
 
 
-def image_subchunks(subchunk_index, config):
+def image_subchunks(subchunk_index, config, extracted=None, columns=None):
+    """
+    The feature sets of a subchunk of every covariate.
 
-    def f(image_source):
+    extracted may be the already read subchunks, as returned by
+    `read_image_subchunks`, otherwise the subchunk (or only its columns,
+    see `read_image_subchunks`) is read here.
+    """
+    if extracted is None:
+        extracted = read_image_subchunks(subchunk_index, config, columns)
+    return _collate_sources(extracted, config)
+
+
+def read_image_subchunks(subchunk_index, config, columns=None):
+    """
+    Read a subchunk of every covariate without any MPI communication.
+
+    columns may be a list of (start, stop) column ranges of the subchunk,
+    in which case only their pixels are read, in pixel order.
+
+    The covariates of each feature set are read into one preallocated block
+    (see `features.subchunk_blocks`), of which their subchunks are views.
+    """
+    def f(image_source, out):
         r = features.extract_subchunks(image_source, subchunk_index,
-                                       config.n_subchunks, config.patchsize)
+                                       config.n_subchunks, config.patchsize,
+                                       config.block_rows, columns, out)
         return r
-    result = _iterate_sources(f, config)
-    return result
+
+    files = [tif for s in config.feature_sets for tif in s.files]
+    sources = _map_sources(lambda tif: image_source(tif, config), config,
+                           files)
+    outs = []
+    for s in config.feature_sets:
+        outs += features.subchunk_blocks(
+            sources[len(outs):len(outs) + len(s.files)], subchunk_index,
+            config.n_subchunks, config.patchsize, config.block_rows, columns)
+    return _map_sources(f, config, sources, outs)
+
+
+def _route_to_bands(targets, config):
+    """
+    Send every target to the node owning the image row band it is in.
+
+    The bands are those `image.construct_splits` gives the nodes when the
+    covariates are split between them, using the grid of the first
+    covariate (all covariates share a grid).
+
+    Returns
+    -------
+    band_targets : Targets
+        The targets (positions only) in this node's band
+    origin : ndarray
+        The node and index each of them came from
+    """
+    first = config.feature_sets[0].files[0]
+    source = image_source(first, config)
+    rows = image.Image(source).lonlat2pix(targets.positions)[:, 1]
+    block_rows, block_offset = (config.block_rows, source.block_offset(
+        config.block_rows)) if config.block_rows else (None, 0)
+    starts = [b[0] for b in image.construct_splits(
+        source.full_resolution[1], mpiops.chunks, 0, block_rows,
+        block_offset)]
+    dest = np.clip(np.searchsorted(starts, rows, side='right') - 1,
+                   0, mpiops.chunks - 1)
+
+    n = targets.positions.shape[0]
+    records = np.empty(n, dtype=[('lonlat', 'f8', (2,)), ('rank', 'i8'),
+                                 ('index', 'i8')])
+    records['lonlat'] = targets.positions
+    records['rank'] = mpiops.chunk_index
+    records['index'] = np.arange(n)
+    records = mpiops.exchange_rows(records, dest)
+    band_targets = Targets(records['lonlat'], np.zeros(len(records)))
+    return band_targets, records[['rank', 'index']]
+
+
+def _return_from_bands(results, origin):
+    """
+    Send intersected covariates back to the nodes their targets came from,
+    all covariates in one exchange, and put them back in target order.
+    """
+    fields = [('index', 'i8')]
+    for i, x in enumerate(x for r in results for x in r.values()):
+        fields += [('d{}'.format(i), x.dtype, x.shape[1:]),
+                   ('m{}'.format(i), bool, x.shape[1:])]
+    records = np.empty(len(origin), dtype=fields)
+    records['index'] = origin['index']
+    for i, x in enumerate(x for r in results for x in r.values()):
+        records['d{}'.format(i)] = np.ma.getdata(x)
+        records['m{}'.format(i)] = np.ma.getmaskarray(x)
+    records = mpiops.exchange_rows(records, origin['rank'])
+    records = records[np.argsort(records['index'])]
+
+    returned = []
+    i = 0
+    for r in results:
+        chunks = OrderedDict()
+        for name in r:
+            chunks[name] = np.ma.MaskedArray(
+                data=records['d{}'.format(i)], mask=records['m{}'.format(i)])
+            i += 1
+        returned.append(chunks)
+    return returned
 
 
 def image_feature_sets(targets, config):
+    """
+    Intersect the targets with every covariate.
+
+    Each target is intersected by the node owning the row band it is in,
+    so every node only reads its own band of the covariates, and the
+    results are returned to the target's node afterwards.
+    """
+    band_targets, origin = _route_to_bands(targets, config)
 
     def f(image_source):
-        r = features.extract_features(image_source, targets,
-                                      config.n_subchunks, config.patchsize)
+        r = features.extract_features(image_source, band_targets,
+                                      config.patchsize)
         return r
     result = _iterate_sources(f, config)
-    return result
+    return _return_from_bands(result, origin)
 
 
 def semisupervised_feature_sets(targets, config):
@@ -434,14 +1965,16 @@ def semisupervised_feature_sets(targets, config):
     frac = config.subsample_fraction
 
     def f(image_source):
-        r_t = features.extract_features(image_source, targets, n_subchunks=1,
+        r_t = features.extract_features(image_source, targets,
                                         patchsize=config.patchsize)
         r_a = features.extract_subchunks(image_source, subchunk_index=0,
                                          n_subchunks=1,
-                                         patchsize=config.patchsize)
+                                         patchsize=config.patchsize,
+                                         block_rows=config.block_rows)
         if frac < 1.0:
-            np.random.seed(1)
-            r_a = r_a[np.random.rand(r_a.shape[0]) < frac]
+            # own generator: f may run in several threads at once
+            rnd = np.random.RandomState(1)
+            r_a = r_a[rnd.rand(r_a.shape[0]) < frac]
 
         r_data = np.concatenate([r_t.data, r_a.data], axis=0)
         r_mask = np.concatenate([r_t.mask, r_a.mask], axis=0)
@@ -458,10 +1991,12 @@ def unsupervised_feature_sets(config):
     def f(image_source):
         r = features.extract_subchunks(image_source, subchunk_index=0,
                                        n_subchunks=1,
-                                       patchsize=config.patchsize)
+                                       patchsize=config.patchsize,
+                                       block_rows=config.block_rows)
         if frac < 1.0:
-            np.random.seed(1)
-            r = r[np.random.rand(r.shape[0]) < frac]
+            # own generator: f may run in several threads at once
+            rnd = np.random.RandomState(1)
+            r = r[rnd.rand(r.shape[0]) < frac]
         return r
     result = _iterate_sources(f, config)
     return result
@@ -6,10 +6,25 @@ from affine import Affine
 log = logging.getLogger(__name__)
 
 
-def construct_splits(npixels, nchunks, overlap=0):
+def construct_splits(npixels, nchunks, overlap=0, block_rows=None,
+                     block_offset=0):
     # Build the equivalent windowed image
     # y bounds are EXCLUSIVE
-    y_arrays = np.array_split(np.arange(npixels), nchunks)
+    y_arrays = None
+    if block_rows:
+        # whole blocks per chunk, so no two chunks decode the same block
+        block_starts = np.arange(block_offset, npixels, block_rows)
+        if block_offset > 0:
+            block_starts = np.concatenate(([0], block_starts))
+        if len(block_starts) >= nchunks:
+            block_ends = np.append(block_starts[1:], npixels)
+            y_arrays = [np.arange(block_starts[k[0]], block_ends[k[-1]])
+                        for k in np.array_split(np.arange(len(block_starts)),
+                                                nchunks)]
+        else:
+            log.debug("Fewer blocks than chunks: ignoring block alignment")
+    if y_arrays is None:
+        y_arrays = np.array_split(np.arange(npixels), nchunks)
     y_bounds = []
     # construct the overlap
     for i, s in enumerate(y_arrays):
@@ -27,7 +42,8 @@ def construct_splits(npixels, nchunks, overlap=0):
 
 
 class Image:
-    def __init__(self, source, chunk_idx=0, nchunks=1, overlap=0):
+    def __init__(self, source, chunk_idx=0, nchunks=1, overlap=0,
+                 block_rows=None):
         assert chunk_idx >= 0 and chunk_idx < nchunks
 
         if nchunks == 1 and overlap != 0:
@@ -51,21 +67,10 @@ class Image:
         assert self.pixsize_x > 0
         assert self.pixsize_y > 0
 
-        # construct the canonical pixel<->position map
-        pix_x = range(self._full_res[0] + 1)  # outer corner of last pixel
-        coords_x = [self._start_lon + float(k) * self.pixsize_x
-                    for k in pix_x]
-        self._coords_x = coords_x
-        pix_y = range(self._full_res[1] + 1)  # ditto
-        coords_y = [self._start_lat + float(k) * self.pixsize_y
-                    for k in pix_y]
-        self._coords_y = coords_y
-        self._pix_x_to_coords = dict(zip(pix_x, coords_x))
-        self._pix_y_to_coords = dict(zip(pix_y, coords_y))
-
         # exclusive y range of this chunk in full image
-        ymin, ymax = construct_splits(self._full_res[1],
-                                      nchunks, overlap)[chunk_idx]
+        block_offset = source.block_offset(block_rows) if block_rows else 0
+        ymin, ymax = construct_splits(self._full_res[1], nchunks, overlap,
+                                      block_rows, block_offset)[chunk_idx]
         self._offset = np.array([0, ymin], dtype=int)
         # exclusive x range of this chunk (same for all chunks)
         xmin, xmax = 0, self._full_res[0]
@@ -95,12 +100,15 @@ class Image:
                                                          self.chunk_idx,
                                                          self.nchunks)
 
-    def data(self):
+    def data(self, out=None, columns=None):
         xmin = self._offset[0]
         xmax = self._offset[0] + self.resolution[0]
+        if columns is not None:
+            # only this (exclusive) range of columns
+            xmin, xmax = xmin + columns[0], xmin + columns[1]
         ymin = self._offset[1]
         ymax = self._offset[1] + self.resolution[1]
-        data = self.source.data(xmin, xmax, ymin, ymax)
+        data = self.source.data(xmin, xmax, ymin, ymax, out)
         return data
 
     @property
@@ -166,8 +174,10 @@ class Image:
 
     # @contract(xy='array[Nx2](int64),N>0')
     def _global_pix2lonlat(self, xy):
-        result = np.array([[self._pix_x_to_coords[x],
-                           self._pix_y_to_coords[y]] for x, y in xy])
+        xy = np.asarray(xy)
+        result = np.empty(xy.shape, dtype=float)
+        result[:, 0] = _pix2coord(self._start_lon, self.pixsize_x, xy[:, 0])
+        result[:, 1] = _pix2coord(self._start_lat, self.pixsize_y, xy[:, 1])
         return result
 
     # @contract(xy='array[Nx2](int64),N>0')
@@ -177,22 +187,15 @@ class Image:
 
     # @contract(lonlat='array[Nx2](float64),N>0')
     def _global_lonlat2pix(self, lonlat):
-        x = np.searchsorted(self._coords_x, lonlat[:, 0], side='right') - 1
-        x = x.astype(int)
-        ycoords = self._coords_y
-        y = np.searchsorted(ycoords, lonlat[:, 1], side='right') - 1
-        y = y.astype(int)
-
-        # We want the *closed* interval, which means moving
-        # points on the end back by 1
-        on_end_x = lonlat[:, 0] == self._coords_x[-1]
-        on_end_y = lonlat[:, 1] == self._coords_y[-1]
-        x[on_end_x] -= 1
-        y[on_end_y] -= 1
+        x = _coord2pix(self._start_lon, self.pixsize_x, self._full_res[0],
+                       lonlat[:, 0])
+        y = _coord2pix(self._start_lat, self.pixsize_y, self._full_res[1],
+                       lonlat[:, 1])
         if (not all(np.logical_and(x >= 0, x < self._full_res[0]))) or \
                 (not all(np.logical_and(y >= 0, y < self._full_res[1]))):
-            raise ValueError("Queried location is not "
-                             "in the image {}!".format(self.source._filename))
+            raise ValueError("Queried location is not in the image "
+                             "{}!".format(getattr(self.source, '_filename',
+                                                  self.source)))
 
         result = np.concatenate((x[:, np.newaxis], y[:, np.newaxis]), axis=1)
         return result
@@ -221,6 +224,39 @@ class Image:
         return result
 
 
+def _pix2coord(start, pixsize, k):
+    """
+    The coordinate of the lower corner of pixel k along one axis.
+    """
+    return start + np.asarray(k).astype(float) * pixsize
+
+
+def _coord2pix(start, pixsize, npixels, coords):
+    """
+    The pixels along one axis containing coords.
+
+    Pixels are the half open intervals between the corners given by
+    `_pix2coord`, except the last, which is closed so points on the outer
+    edge of the image fall in it. Points outside the image give -1 or
+    npixels, and missing (non-finite) coordinates give -1.
+    """
+    coords = np.asarray(coords, dtype=float)
+    with np.errstate(invalid='ignore'):
+        k = np.floor((coords - start) / pixsize)
+    missing = ~np.isfinite(k)
+    k = np.clip(np.where(missing, -1, k), -1, npixels).astype(int)
+    # the division can be out by one near a corner, so compare with the
+    # corners themselves
+    k[_pix2coord(start, pixsize, k) > coords] -= 1
+    k[(k < npixels) & (_pix2coord(start, pixsize, k + 1) <= coords)] += 1
+    k = np.clip(k, -1, npixels)
+    # We want the *closed* interval, which means moving
+    # points on the end back by 1
+    k[coords == _pix2coord(start, pixsize, npixels)] -= 1
+    k[missing] = -1
+    return k
+
+
 def bbox2affine(xmax, xmin, ymax, ymin, xres, yres):
 
     pixsize_x = (xmax - xmin) / xres
@@ -20,7 +20,8 @@ class MPIStreamHandler(logging.StreamHandler):
     Only logs messages from Node 0
     """
     def emit(self, record):
-        if mpiops.chunk_index == 0:
+        # every node is node 0 inside mpiops.local
+        if mpiops.MPI.COMM_WORLD.Get_rank() == 0:
             super().emit(record)
 
 
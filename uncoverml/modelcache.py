@@ -0,0 +1,87 @@
+"""Per-process cache of the pickled members of ensemble models
+
+RandomForestRegressorMulti and MultiCubist keep each of their members in
+its own pickle on the (usually shared) output filesystem, and predict every
+partition with all of them. The cache keeps the members in memory once
+loaded, so each is unpickled once per process rather than once per
+partition.
+"""
+
+import os
+import pickle
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class ModelCache:
+    """
+    A per-process, LRU bounded cache of unpickled model files keyed by path.
+
+    A file rewritten since it was loaded, as the members are between the
+    folds of a cross validation, is loaded again.
+
+    Parameters
+    ----------
+    max_gb : float
+        The maximum total size of the cached files, in GB. The size of a
+        pickle stands in for the size of the object it holds.
+    """
+    def __init__(self, max_gb=8.0):
+        self.max_gb = max_gb
+        self.hits = 0
+        self.misses = 0
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, filename):
+        """
+        The object pickled in ``filename``, unpickled only if it is not
+        cached.
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key in self._models:
+                self.hits += 1
+                self._models.move_to_end(key)
+                model = self._models[key]
+                # the bound may have been lowered since it was loaded
+                self._evict()
+                return model
+            self.misses += 1
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+        with self._lock:
+            # drop any older version of the file
+            for k in [k for k in self._models if k[0] == path]:
+                del self._models[k]
+            self._models[key] = model
+            self._evict()
+        return model
+
+    def _evict(self):
+        size = sum(k[2] for k in self._models)
+        while self._models and size > self.max_gb * 1e9:
+            k, _ = self._models.popitem(last=False)
+            size -= k[2]
+
+    def __len__(self):
+        return len(self._models)
+
+    def clear(self):
+        """
+        Drop all cached models and log the hit and miss counts.
+        """
+        with self._lock:
+            self._models.clear()
+        log.debug("Model cache: {} hits, {} misses".format(self.hits,
+                                                          self.misses))
+
+
+model_cache = ModelCache()
+"""ModelCache: the cache shared by all ensemble models in this process
+"""
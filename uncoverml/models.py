@@ -2,7 +2,8 @@
 
 import os
 import pickle
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 from os.path import join, isdir, abspath
 import numpy as np
 from revrand import StandardLinearModel, GeneralisedLinearModel
@@ -12,7 +13,7 @@ from revrand.btypes import Parameter, Positive
 from revrand.likelihoods import Gaussian
 from revrand.optimize import Adam
 from revrand.utils import atleast_list
-from scipy.integrate import fixed_quad
+from scipy.special import roots_legendre
 from scipy.stats import norm
 
 from sklearn.svm import SVR, SVC
@@ -26,6 +27,7 @@ from sklearn.preprocessing import LabelEncoder
 from sklearn.kernel_approximation import RBFSampler
 
 from uncoverml import mpiops
+from uncoverml.modelcache import model_cache
 from uncoverml.cubist import Cubist
 from uncoverml.cubist import MultiCubist
 from uncoverml.transforms import target as transforms
@@ -461,6 +463,63 @@ class SGDApproxGP(BasisMakerMixin, GeneralisedLinearModel,
 #
 
 
+def _n_threads(n_jobs):
+    """The number of threads n_jobs asks for, as scikit-learn reads it"""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+
+def tree_moments(trees, X, n_jobs=None):
+    """
+    The mean and (population) variance of the predictions of trees at X.
+
+    The trees are evaluated in batches on n_jobs threads, since tree
+    prediction releases the GIL, and each batch is merged into running
+    moments with the parallel form of Welford's algorithm. So at most one
+    batch of predictions is held at a time, whatever the number of trees.
+
+    Parameters
+    ----------
+    trees : iterable
+        Fitted decision trees, which may be generated lazily
+    X : ndarray
+        (N, d) array of inputs
+    n_jobs : int, optional
+        The number of threads, as for scikit-learn
+
+    Returns
+    -------
+    Ey : ndarray
+        (N,) mean of the tree predictions
+    Vy : ndarray
+        (N,) variance of the tree predictions
+    """
+    # trees predict in float32, so convert X once rather than per tree
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    n_threads = _n_threads(n_jobs)
+    trees = iter(trees)
+    n = 0
+    Ey = np.zeros(X.shape[0])
+    M2 = np.zeros(X.shape[0])
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        batch = list(islice(trees, n_threads))
+        while batch:
+            y = np.array(list(executor.map(
+                lambda dt: dt.predict(X, check_input=False), batch)))
+            k = len(batch)
+            Ey_batch = y.mean(axis=0)
+            delta = Ey_batch - Ey
+            Ey += delta * k / (n + k)
+            M2 += ((y - Ey_batch) ** 2).sum(axis=0) + \
+                delta ** 2 * n * k / (n + k)
+            n += k
+            batch = list(islice(trees, n_threads))
+    return Ey, M2 / n
+
+
 class RandomForestRegressor(RFR):
     """
     Implements a "probabilistic" output by looking at the variance of the
@@ -468,16 +527,8 @@ class RandomForestRegressor(RFR):
     """
 
     def predict_dist(self, X, interval=0.95):
-        if hasattr(self, "_notransform_predict"):
-            Ey = self._notransform_predict(X)
-        else:
-            Ey = self.predict(X)
-
-        Vy = np.zeros_like(Ey)
-        for dt in self.estimators_:
-            Vy += (dt.predict(X) - Ey)**2
-
-        Vy /= len(self.estimators_)
+        # the mean of the trees is the (untransformed) forest prediction
+        Ey, Vy = tree_moments(self.estimators_, X, self.n_jobs)
 
         # FIXME what if elements of Vy are zero?
 
@@ -545,22 +596,18 @@ class RandomForestRegressorMulti():
             print('Train first')
             return
 
-        y_pred = np.zeros((x.shape[0], self.forests * self.n_estimators))
-
-        for i in range(self.forests):
-            if self.parallel:  # used in training
-                pk_f = join(self.temp_dir,
-                            'rf_model_{}.pk'.format(i))
-            else:  # used when parallel is false, i.e., during x-val
-                pk_f = join(self.temp_dir,
-                            'rf_model_{}_{}.pk'.format(i, mpiops.chunk_index))
-            with open(pk_f, 'rb') as fp:
-                f = pickle.load(fp)
-                for m, dt in enumerate(f.estimators_):
-                    y_pred[:, i * self.n_estimators + m] = dt.predict(x)
+        def trees():
+            for i in range(self.forests):
+                if self.parallel:  # used in training
+                    pk_f = join(self.temp_dir,
+                                'rf_model_{}.pk'.format(i))
+                else:  # used when parallel is false, i.e., during x-val
+                    pk_f = join(self.temp_dir,
+                                'rf_model_{}_{}.pk'.format(
+                                    i, mpiops.chunk_index))
+                yield from model_cache.load(pk_f).estimators_
 
-        y_mean = np.mean(y_pred, axis=1)
-        y_var = np.var(y_pred, axis=1)
+        y_mean, y_var = tree_moments(trees(), x, self.kwargs.get('n_jobs'))
 
         # Determine quantiles
         ql, qu = norm.interval(interval, loc=y_mean, scale=np.sqrt(y_var))
@@ -678,34 +725,13 @@ def transform_targets(Regressor):
                 Vy = np.empty_like(Vy_t)
 
                 # Used fixed order quadrature to transform prob. estimates
-                for i, (Eyi, Vyi) in enumerate(zip(Ey_t, Vy_t)):
-
-                    # Establish bounds
-                    Syi = np.sqrt(Vyi)
-                    a, b = Eyi - 3 * Syi, Eyi + 3 * Syi  # approx 99% bounds
-
-                    # Quadrature
-                    Ey[i], _ = fixed_quad(self.__expec_int, a, b, n=QUADORDER,
-                                          args=(Eyi, Syi))
-                    Vy[i], _ = fixed_quad(self.__var_int, a, b, n=QUADORDER,
-                                          args=(Ey[i], Eyi, Syi))
+                Ey[:], Vy[:] = _transformed_moments(self.target_transform,
+                                                    Ey_t, Vy_t)
 
                 ql, qu = norm.interval(interval, loc=Ey, scale=np.sqrt(Vy))
 
                 return Ey, Vy, ql, qu
 
-        def __expec_int(self, x, mu, std):
-
-            px = _normpdf(x, mu, std)
-            Ex = self.target_transform.itransform(x) * px
-            return Ex
-
-        def __var_int(self, x, Ex, mu, std):
-
-            px = _normpdf(x, mu, std)
-            Vx = (self.target_transform.itransform(x) - Ex) ** 2 * px
-            return Vx
-
     return TransformedRegressor
 
 
@@ -956,8 +982,10 @@ class MaskRows:
         if np.ma.isMaskedArray(X):
             if np.isscalar(X.mask):
                 okrows = ~X.mask * np.ones(N, dtype=bool)
+            elif X.ndim == 2:
+                okrows = ~np.any(X.mask, axis=1)
             else:
-                okrows = np.all(~X.mask, axis=1) if X.ndim == 2 else ~X.mask
+                okrows = ~X.mask
         else:
             okrows = np.ones(N, dtype=bool)
         return okrows
@@ -1039,3 +1067,46 @@ _SQRT2PI = np.sqrt(2 * np.pi)
 def _normpdf(x, mu, std):
 
     return 1. / (_SQRT2PI * std) * np.exp(-0.5 * ((x - mu) / std)**2)
+
+
+def _transformed_moments(target_transform, Ey_t, Vy_t):
+    """
+    The expectation and variance of the inverse target transform of normal
+    latent predictions.
+
+    This is the fixed order Gauss-Legendre quadrature of
+    ``scipy.integrate.fixed_quad`` over approximate 99% bounds, evaluated for
+    all pixels at once on an (n_pixels, QUADORDER) grid of nodes rather than
+    one pixel at a time.
+
+    Parameters
+    ----------
+    target_transform : uncoverml.transforms.target transform
+        The transform whose ``itransform`` maps latent to target values.
+    Ey_t : ndarray
+        (n,) latent expectations.
+    Vy_t : ndarray
+        (n,) latent variances.
+
+    Returns
+    -------
+    Ey : ndarray
+        (n,) expectations of the targets.
+    Vy : ndarray
+        (n,) variances of the targets.
+    """
+    x, w = roots_legendre(QUADORDER)
+    Sy_t = np.sqrt(Vy_t)
+    a, b = Ey_t - 3 * Sy_t, Ey_t + 3 * Sy_t  # approx 99% bounds
+    y = (b - a)[:, np.newaxis] * (x + 1) / 2.0 + a[:, np.newaxis]
+
+    # some transforms only take vectors
+    ty = target_transform.itransform(y.ravel()).reshape(y.shape)
+    py = _normpdf(y, Ey_t[:, np.newaxis], Sy_t[:, np.newaxis])
+
+    # stored before the variance so it sees the same (rounded) expectation
+    Ey = np.empty_like(Ey_t)
+    Ey[:] = (b - a) / 2.0 * np.sum(w * (ty * py), axis=-1)
+    Vy = (b - a) / 2.0 * np.sum(w * ((ty - Ey[:, np.newaxis]) ** 2 * py),
+                                axis=-1)
+    return Ey, Vy
@@ -1,9 +1,14 @@
 import logging
 import pickle
+import sys
+import traceback
+from contextlib import contextmanager
 
 import numpy as np
 from mpi4py import MPI
 
+from uncoverml.featureblock import FeatureBlock, dense
+
 log = logging.getLogger(__name__)
 
 # We're having trouble with the MPI pickling and 64bit integers
@@ -50,6 +55,89 @@ def run_once(f, *args, **kwargs):
     return result
 
 
+def abort(message):
+    """Report the exception being handled and abort every node
+
+    The log only shows node 0's messages, so the traceback is written
+    straight to stderr, whichever node failed, before the job is killed.
+
+    Parameters
+    ----------
+    message : string
+        What failed, printed above the traceback
+    """
+    rank = MPI.COMM_WORLD.Get_rank()
+    sys.stderr.write("Node {}: {}\n".format(rank, message))
+    traceback.print_exc()
+    sys.stderr.flush()
+    MPI.COMM_WORLD.Abort(1)
+
+
+@contextmanager
+def local():
+    """Act as if this node were alone in the MPI world
+
+    Within the context comm is MPI.COMM_SELF, chunks is 1 and chunk_index
+    is 0, so collective operations only see this node's data and nothing
+    waits for the other nodes. Every node is node 0 here, so output that
+    only node 0 should write must happen outside the context.
+    """
+    global comm, chunks, chunk_index
+    world = comm, chunks, chunk_index
+    comm, chunks, chunk_index = MPI.COMM_SELF, 1, 0
+    try:
+        yield
+    finally:
+        comm, chunks, chunk_index = world
+
+
+class SharedCounter:
+    """A counter held by node 0 that any node can increment on its own
+
+    The increments are atomic one-sided operations, so the other nodes
+    take no part in them. They are only served while node 0 is busy
+    computing if the MPI library progresses one-sided operations on its
+    own (RDMA hardware, or e.g. MPICH_ASYNC_PROGRESS=1); otherwise an
+    increment can wait until node 0 next calls into MPI.
+
+    If the MPI library cannot create the window, the counter falls back to
+    a static split: node i counts i, i + chunks, i + 2 chunks and so on.
+    Creating and freeing the counter are collective.
+    """
+    def __init__(self):
+        self._value = np.zeros(1, dtype=np.int64) if chunk_index == 0 \
+            else None
+        # next may be called within local()
+        self._static = chunk_index
+        self._step = chunks
+        try:
+            self._win = MPI.Win.Create(self._value, comm=comm)
+        except MPI.Exception as e:
+            log.warning("One-sided MPI is not available ({}), so work is "
+                        "split statically".format(e))
+            self._win = None
+        else:
+            # one passive target epoch for the life of the counter
+            self._win.Lock_all()
+
+    def next(self):
+        """Increment the counter, returning its value before"""
+        if self._win is None:
+            value = self._static
+            self._static += self._step
+            return value
+        one = np.ones(1, dtype=np.int64)
+        value = np.empty(1, dtype=np.int64)
+        self._win.Fetch_and_op(one, value, 0, op=MPI.SUM)
+        self._win.Flush(0)
+        return int(value[0])
+
+    def free(self):
+        if self._win is not None:
+            self._win.Unlock_all()
+            self._win.Free()
+
+
 def sum_axis_0(x, y, dtype):
     s = np.ma.sum(np.ma.vstack((x, y)), axis=0)
     return s
@@ -77,7 +165,12 @@ min0_op = MPI.Op.Create(min_axis_0, commute=True)
 
 
 def count(x):
-    x_n_local = np.ma.count(x, axis=0).ravel()
+    x_dense = dense(x)
+    if x_dense is not None:
+        x_n_local = np.full(int(np.prod(x_dense.shape[1:])),
+                            x_dense.shape[0])
+    else:
+        x_n_local = np.ma.count(x, axis=0).ravel()
     x_n = comm.allreduce(x_n_local, op=sum0_op)
     still_masked = np.ma.count_masked(x_n)
     if still_masked != 0:
@@ -90,8 +183,13 @@ def count(x):
 
 def outer_count(x):
 
-    xnotmask = (~x.mask).astype(float)
-    x_n_outer_local = np.dot(xnotmask.T, xnotmask)
+    x_dense = dense(x)
+    if x_dense is not None:
+        d = x_dense.shape[1]
+        x_n_outer_local = np.full((d, d), float(x_dense.shape[0]))
+    else:
+        xnotmask = (~x.mask).astype(float)
+        x_n_outer_local = np.dot(xnotmask.T, xnotmask)
     x_n_outer = comm.allreduce(x_n_outer_local)
 
     return x_n_outer
@@ -99,7 +197,12 @@ def outer_count(x):
 
 def mean(x):
     x_n = count(x)
-    x_sum_local = np.ma.sum(x, axis=0)
+    # accumulate in double precision whatever the precision of x
+    x_dense = dense(x)
+    if x_dense is not None:
+        x_sum_local = np.sum(x_dense, axis=0, dtype=np.float64)
+    else:
+        x_sum_local = np.ma.sum(x, axis=0, dtype=np.float64)
     x_sum = comm.allreduce(x_sum_local, op=sum0_op)
     still_masked = np.ma.count_masked(x_sum)
     if still_masked != 0:
@@ -112,7 +215,11 @@ def mean(x):
 
 
 def minimum(x):
-    x_min_local = np.ma.min(x, axis=0)
+    x_dense = dense(x)
+    if x_dense is not None and x_dense.shape[0] > 0:
+        x_min_local = np.min(x_dense, axis=0)
+    else:
+        x_min_local = np.ma.min(x, axis=0)
     x_min = comm.allreduce(x_min_local, op=min0_op)
     still_masked = np.ma.count_masked(x_min)
     if still_masked != 0:
@@ -131,8 +238,9 @@ def sd(x):
 
 
 def power(x, exp):
-    if np.ma.count_masked(x) == 0:
-        return np.ma.masked_array(x.data**2, mask=False)
+    x_dense = dense(x)
+    if x_dense is not None:
+        return np.ma.masked_array(x_dense**exp, mask=False)
     m = np.where(~x.mask)
     xe = x[m]
     xe = xe**exp
@@ -142,18 +250,110 @@ def power(x, exp):
 
 
 def outer(x):
-    x_outer_local = np.ma.dot(x.T, x)
+    # masked elements contribute nothing to the sums, like np.ma.dot
+    x_data = np.ma.filled(x.astype(np.float64, copy=False), 0.)
+    x_outer_local = np.dot(x_data.T, x_data)
+    # a column pair with no complete rows on any node is an error
+    x_dense = dense(x)
+    if x_dense is not None:
+        empty_local = x_dense.shape[0] == 0
+    else:
+        xnotmask = (~x.mask).astype(float)
+        empty_local = (np.dot(xnotmask.T, xnotmask) == 0).any()
     out = comm.allreduce(x_outer_local)
-    still_masked = np.ma.count_masked(out)
-    if still_masked != 0:
+    if comm.allreduce(empty_local, op=MPI.LOR):
         log.info('Reported out: ' + ', '.join([str(s) for s in out]))
         raise ValueError("Can't compute outer product:"
                          " completely missing columns!")
-    if hasattr(out, 'mask'):
-        out = out.data
     return out
 
 
+def exchange_rows(x, dest):
+    """Send each row of an array to a given node, in one exchange
+
+    The rows are sent with a single Alltoallv of a contiguous datatype of
+    one row, so x must have the same (fixed size) dtype and row shape on
+    every node. Counts and displacements are in rows, which keeps them
+    within MPI's int range for exchanges of well over 2 GiB.
+
+    Parameters
+    ----------
+    x : ndarray
+        This node's rows
+    dest : ndarray
+        The node each row of x is sent to
+
+    Returns
+    -------
+    received : ndarray
+        The rows sent to this node, ordered by sending node and then by
+        their order on that node
+    """
+    order = np.argsort(dest, kind='mergesort')
+    send = np.ascontiguousarray(x[order])
+    row_bytes = x.dtype.itemsize * int(np.prod(x.shape[1:]))
+    send_counts = np.bincount(dest, minlength=chunks)
+    recv_counts = np.array(comm.alltoall(send_counts.tolist()))
+    received = np.empty((recv_counts.sum(),) + x.shape[1:], dtype=x.dtype)
+
+    def spec(counts):
+        displs = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        # MPI counts and displacements are C ints
+        assert counts.sum() < 2 ** 31, "Too many rows to exchange"
+        return counts.tolist(), displs.tolist()
+
+    row = MPI.BYTE.Create_contiguous(row_bytes).Commit()
+    try:
+        comm.Alltoallv([send.view(np.uint8).ravel(), spec(send_counts), row],
+                       [received.view(np.uint8).ravel(), spec(recv_counts),
+                        row])
+    finally:
+        row.Free()
+    return received
+
+
+def allgather_masked(x):
+    """Stack a masked array from every node, on every node
+
+    The arrays are sent as FeatureBlocks, so masks cost one bit per element
+    on the wire, and nothing at all for arrays with no missing data.
+
+    Parameters
+    ----------
+    x : MaskedArray
+        This node's rows
+
+    Returns
+    -------
+    x_all : MaskedArray
+        The rows of every node, in rank order
+    """
+    blocks = comm.allgather(FeatureBlock.from_masked(x))
+    return FeatureBlock.concatenate(blocks).to_masked()
+
+
+def gather_masked(x, root=0):
+    """Stack a masked array from every node on the root node
+
+    Parameters
+    ----------
+    x : MaskedArray
+        This node's rows
+    root : int
+        The node to gather on
+
+    Returns
+    -------
+    x_all : MaskedArray or None
+        The rows of every node, in rank order, or None if this is not the
+        root node
+    """
+    blocks = comm.gather(FeatureBlock.from_masked(x), root=root)
+    if blocks is None:
+        return None
+    return FeatureBlock.concatenate(blocks).to_masked()
+
+
 def covariance(x):
     x_mean = mean(x)
     cov = outer(x - x_mean) / outer_count(x)
@@ -171,19 +371,12 @@ def random_full_points(x, Napprox):
 
     rinds = np.random.permutation(len(x))  # random choice of indices
 
-    # Get random points per node
-    x_p_node = []
-    count = 0
-    for i in rinds:
-        if np.ma.count_masked(x[i]) > 0:
-            continue
-        if count >= npernode:
-            break
-        x_p_node.append(x[i])
-        count += 1
+    # Get random points per node, skipping those with missing data
+    valid = FeatureBlock.from_masked(x).valid_rows()
+    picked = rinds[valid[rinds]][:npernode]
 
     # one chunk can have all of one or more covariates masked
-    x_p_node = np.vstack(x_p_node) if len(x_p_node) else None
+    x_p_node = np.ma.getdata(x)[picked] if len(picked) else None
 
     all_x_p_node = comm.allgather(x_p_node)
     # filter out the None chunks
@@ -80,20 +80,26 @@ def point_patches(image, pwidth, points):
     return output
 
 
-def _image_to_data(image):
+def _image_to_data(image, columns=None, out=None):
     """
     breaks up an image object into arrays suitable for sending to the
     patching functions
     """
-    data_and_mask = image.data()
+    data_and_mask = image.data(out=out, columns=columns)
     data = data_and_mask.data
     data_dtype = data.dtype
     mask = data_and_mask.mask
     return data, mask, data_dtype
 
 
-def all_patches(image, patchsize):
-    data, mask, data_dtype = _image_to_data(image)
+def all_patches(image, patchsize, columns=None, out=None):
+    data, mask, data_dtype = _image_to_data(image, columns, out)
+    if patchsize == 0:
+        # 1x1 patches are just the pixels, so reshape (without a copy for
+        # contiguous images) rather than windowing
+        shp = (-1, 1, 1, data.shape[2])
+        return np.ma.masked_array(data=data.reshape(shp),
+                                  mask=mask.reshape(shp))
     patches = grid_patches(data, patchsize)
     patch_mask = grid_patches(mask, patchsize)
     result = np.ma.masked_array(data=patches, mask=patch_mask)
@@ -1,4 +1,7 @@
+import copy
 import logging
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from itertools import compress
 import numpy as np
 import csv
@@ -52,20 +55,64 @@ def predict(data, model, interval=0.95, **kwargs):
     return result
 
 
-def _mask(subchunk, config):
-    extracted_mask = mask_subchunks(subchunk, config)
-    mask_x = extracted_mask.reshape(extracted_mask.shape[0], 1)
-    mask_x.mask = mask_x.data != config.retain
-    return mask_x
+def _masked(subchunk, config, partition):
+    """
+    Whether each pixel of a subchunk is masked out of the prediction.
+    """
+    def read():
+        mask_data = _partition_data(partition, 'mask', mask_subchunks,
+                                    subchunk, config)
+        return mask_data.data.reshape(mask_data.shape[0]) != config.retain
+    return _partition_data(partition, 'masked', read)
 
 
 def mask_subchunks(subchunk, config):
     image_source = geoio.RasterioImageSource(config.mask)
     result = features.extract_subchunks(image_source, subchunk,
-                                        config.n_subchunks, config.patchsize)
+                                        config.n_subchunks, config.patchsize,
+                                        config.block_rows)
     return result
 
 
+Tiles = namedtuple('Tiles', ['runs', 'rows', 'npixels'])
+"""The column runs of a subchunk with pixels to predict, the (pixel order)
+rows of the subchunk they cover, and the number of pixels in the subchunk
+"""
+
+
+def _tiles(subchunk, config, partition):
+    """
+    Split a subchunk into tiles of config.tile_columns columns and find the
+    tiles with any pixels the mask retains.
+
+    Returns None if the subchunk is not tiled (no mask, or patches).
+    """
+    if not (config.mask and config.tile_columns) or config.patchsize != 0:
+        return None
+    masked = _masked(subchunk, config, partition)
+    nx = geoio.RasterioImageSource(config.mask).full_resolution[0]
+    ny = masked.shape[0] // nx
+    # pixels are in x major order
+    retained = ~masked.reshape(nx, ny)
+    starts = np.arange(0, nx, config.tile_columns)
+    active = np.add.reduceat(retained.any(axis=1), starts) > 0
+    stops = np.minimum(starts + config.tile_columns, nx)
+
+    # coalesce neighbouring active tiles into runs of columns
+    runs = []
+    for start, stop in zip(starts[active], stops[active]):
+        if runs and runs[-1][1] == start:
+            runs[-1] = (runs[-1][0], stop)
+        else:
+            runs.append((start, stop))
+    rows = np.concatenate([np.arange(start * ny, stop * ny)
+                           for start, stop in runs] or
+                          [np.zeros(0, dtype=int)])
+    log.info("Predicting {} of {} tiles of partition {}".format(
+        np.sum(active), len(starts), subchunk + 1))
+    return Tiles(runs, rows, masked.shape[0])
+
+
 def _fix_for_corrupt_data(x, feature_names):
     """
     Address this error during prediction:
@@ -114,7 +161,11 @@ def _fix_for_corrupt_data(x, feature_names):
 
     x.mask += x_isnan
 
-    isfinite = np.isfinite(x.astype(np.float32))
+    if x.dtype == np.float32:
+        # nothing can overflow, so avoid a float32 copy
+        isfinite = np.isfinite(x.data) | x.mask
+    else:
+        isfinite = np.isfinite(x.astype(np.float32))
 
     if isfinite.all():
         return x
@@ -135,24 +186,38 @@ def _fix_for_corrupt_data(x, feature_names):
     return x
 
 
-def _get_data(subchunk, config):
+def _get_data(subchunk, config, partition):
+    """
+    The transformed covariates of the pixels of a subchunk to predict.
+
+    Returns
+    -------
+    x : MaskedArray
+        The features
+    features_names : list
+        The names of the covariates
+    tiles : Tiles or None
+        The tiles of the subchunk x covers, or None if x covers it all
+    """
     features_names = geoio.feature_names(config)
+    tiles = _partition_data(partition, 'tiles', _tiles,
+                            subchunk, config, partition)
 
-    # NOTE: This returns an *untransformed* x,
-    # which is ok as we just need dummies here
     if config.mask:
-        mask_x = _mask(subchunk, config)
-        all_mask_x = np.ma.vstack(mpiops.comm.allgather(mask_x))
-        if all_mask_x.shape[0] == np.sum(all_mask_x.mask):
-            x = np.ma.zeros((mask_x.shape[0], len(features_names)),
-                            dtype=np.bool)
-            x.mask = True
+        masked = _masked(subchunk, config, partition)
+        n_retained = mpiops.comm.allreduce(int(np.sum(~masked)))
+        if n_retained == 0:
+            x = np.ma.zeros((0, len(features_names)), dtype=bool)
             log.info('Partition {} covariates are not loaded as '
                      'the partition is entirely masked.'.format(subchunk + 1))
-            return x, features_names
+            partition.pop('covariates', None)
+            return x, features_names, Tiles([], np.zeros(0, dtype=int),
+                                            masked.shape[0])
 
     transform_sets = [k.transform_set for k in config.feature_sets]
-    extracted_chunk_sets = geoio.image_subchunks(subchunk, config)
+    extracted_chunk_sets = geoio.image_subchunks(
+        subchunk, config, partition.pop('covariates', None),
+        None if tiles is None else tiles.runs)
     log.info("Applying feature transforms")
     x = features.transform_features(extracted_chunk_sets, transform_sets,
                                     config.final_transform, config)[0]
@@ -161,33 +226,68 @@ def _get_data(subchunk, config):
     if isinstance(modelmaps[config.algorithm](), BaseEnsemble) or  \
             config.multirandomforest:
         x = _fix_for_corrupt_data(x, features_names)
-    return _mask_rows(x, subchunk, config), features_names
-
-
-def _get_lon_lat(subchunk, config):
-    def _impute_lat_lon(cov_file, subchunk, config):
-        cov = geoio.RasterioImageSource(cov_file)
-        cov_data = features.extract_subchunks(cov, subchunk,
-                                              config.n_subchunks,
-                                              config.patchsize)
-        nn_imputer = transforms.NearestNeighboursImputer()
-        cov_data = nn_imputer(cov_data.reshape(cov_data.shape[0], 1))
-        return cov_data
+    return _mask_rows(x, subchunk, config, partition, tiles), \
+        features_names, tiles
+
+
+def _read_subchunk(filename, subchunk, config):
+    source = geoio.RasterioImageSource(filename)
+    return features.extract_subchunks(source, subchunk, config.n_subchunks,
+                                      config.patchsize, config.block_rows)
+
+
+def _grid_source(config):
+    """
+    A raster on the prediction grid, to compute coordinates from.
+    """
+    grid_file = config.mask if config.mask else \
+        config.feature_sets[0].files[0]
+    return geoio.RasterioImageSource(grid_file)
+
+
+def _read_lon_lat(subchunk, config):
+    """
+    The (lon, lat) of the pixels of a subchunk, computed from the image
+    grid unless lon/lat rasters are configured.
+    """
+    if config.lat is None or config.lon is None:
+        return np.ma.masked_array(features.extract_lonlat(
+            _grid_source(config), subchunk, config.n_subchunks,
+            config.patchsize, config.block_rows), mask=False)
+    lat_data = _read_subchunk(config.lat, subchunk, config)
+    lon_data = _read_subchunk(config.lon, subchunk, config)
+    return np.ma.hstack((lon_data.reshape(lon_data.shape[0], 1),
+                         lat_data.reshape(lat_data.shape[0], 1)))
+
+
+def _get_lon_lat(subchunk, config, partition, tiles=None):
     if config.lon_lat:
-        lat_data = _impute_lat_lon(config.lat, subchunk, config)
-        lon_data = _impute_lat_lon(config.lon, subchunk, config)
-        lon_lat = np.ma.hstack((lon_data, lat_data))
-        return _mask_rows(lon_lat, subchunk, config)
+        lon_lat = _partition_data(partition, 'lon_lat', _read_lon_lat,
+                                  subchunk, config)
+        # building the imputer's kdtree is collective, so only do it
+        # where some rank needs it
+        if mpiops.comm.allreduce(np.ma.count_masked(lon_lat)) > 0:
+            imputers = _partition_data(partition, 'imputers',
+                                       _lon_lat_imputers)
+            lon_lat = np.ma.hstack([imputer(lon_lat[:, [i]])
+                                    for i, imputer in enumerate(imputers)])
+        if tiles is not None:
+            lon_lat = lon_lat[tiles.rows]
+        return _mask_rows(lon_lat, subchunk, config, partition, tiles)
+
+
+def _lon_lat_imputers():
+    """
+    Imputers for the lon and lat, which are fitted on their first use.
+    """
+    return [transforms.NearestNeighboursImputer() for i in range(2)]
 
 
-def _mask_rows(x, subchunk, config):
+def _mask_rows(x, subchunk, config, partition, tiles=None):
     if config.mask:
-        mask_source = geoio.RasterioImageSource(config.mask)
-        mask_data = features.extract_subchunks(mask_source, subchunk,
-                                               config.n_subchunks,
-                                               config.patchsize)
-        mask_data = mask_data.reshape(mask_data.shape[0], 1)
-        mask_x = mask_data.data[:, 0] != config.retain
+        mask_x = _masked(subchunk, config, partition)
+        if tiles is not None:
+            mask_x = mask_x[tiles.rows]
         log.info('Areas with mask={} will be predicted'.format(config.retain))
 
         assert x.shape[0] == mask_x.shape[0], 'shape mismatch of ' \
@@ -198,21 +298,158 @@ def _mask_rows(x, subchunk, config):
     return x
 
 
-def render_partition(model, subchunk, image_out, config):
+def _partition_data(partition, key, read, *args):
+    """
+    The data of a partition under key, read with read(*args) unless it has
+    been read already.
+    """
+    if key not in partition:
+        partition[key] = read(*args)
+    return partition[key]
+
+
+def _read_partition(subchunk, config):
+    """
+    Read the covariates, mask and lon/lat of a subchunk.
+
+    There is no MPI communication here, so this can run on a background
+    thread while another partition is predicted.
+    """
+    partition = {}
+    if config.mask:
+        partition['mask'] = mask_subchunks(subchunk, config)
+    tiles = _partition_data(partition, 'tiles', _tiles,
+                            subchunk, config, partition)
+    partition['covariates'] = geoio.read_image_subchunks(
+        subchunk, config, None if tiles is None else tiles.runs)
+    if config.lon_lat:
+        partition['lon_lat'] = _read_lon_lat(subchunk, config)
+    return partition
+
+
+def _partition_gb(partition):
+    arrays = [a for k, v in partition.items()
+              if k not in ('tiles', 'imputers')
+              for a in (v if k == 'covariates' else [v])]
+    return sum(a.nbytes + np.ma.getmaskarray(a).nbytes
+               for a in arrays) / 1e9
 
-    x, feature_names = _get_data(subchunk, config)
+
+def read_partitions(config, subchunks=None):
+    """
+    Generate (subchunk, partition) for every subchunk of the image, or
+    for those subchunks (an iterable) in their order.
+
+    With config.prefetch > 0 up to that many partitions are read ahead on
+    a background thread while the current one is predicted, as long as
+    they fit in config.prefetch_gb. Otherwise the partitions are empty and
+    their data is read when it is needed.
+    """
+    subchunks = iter(range(config.n_subchunks) if subchunks is None
+                     else subchunks)
+    if config.prefetch < 1 or config.n_subchunks == 1:
+        for i in subchunks:
+            yield i, {}
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+
+        def read_next():
+            subchunk = next(subchunks, None)
+            if subchunk is not None:
+                pending.append((subchunk, executor.submit(
+                    _read_partition, subchunk, config)))
+            return subchunk is not None
+
+        while pending or read_next():
+            subchunk, future = pending.popleft()
+            partition = future.result()
+            # partitions are about the same size, so cap the read-ahead
+            # by the size of this one
+            depth = min(config.prefetch, int(config.prefetch_gb //
+                                              max(_partition_gb(partition),
+                                                  1e-9)))
+            while len(pending) < depth and read_next():
+                pass
+            yield subchunk, partition
+
+
+def render_partition(model, subchunk, image_out, config, partition=None):
+    """
+    Predict a subchunk of the image and write it out.
+
+    partition holds any of the subchunk's data already read by
+    `read_partitions`; the rest is read here.
+    """
+    partition = {} if partition is None else partition
+    x, feature_names, tiles = _get_data(subchunk, config, partition)
     total_gb = mpiops.comm.allreduce(x.nbytes / 1e9)
     log.info("Loaded {:2.4f}GB of image data".format(total_gb))
     alg = config.algorithm
     log.info("Predicting targets for {}.".format(alg))
-    y_star = predict(x, model, interval=config.quantiles,
-                     lon_lat=_get_lon_lat(subchunk, config))
+    # some models predict collectively, so only skip them everywhere
+    if mpiops.comm.allreduce(x.shape[0]) > 0:
+        y_star = predict(x, model, interval=config.quantiles,
+                         lon_lat=_get_lon_lat(subchunk, config, partition,
+                                              tiles))
+    else:
+        y_star = np.ma.masked_all((0, len(model.get_predict_tags())))
     if config.cluster and config.cluster_analysis:
         cluster_analysis(x, y_star, subchunk, config, feature_names)
     # cluster_analysis(x, y_star, subchunk, config, feature_names)
+    if tiles is not None:
+        # tiles with nothing to predict are written as nodata
+        y_tiles = y_star
+        y_star = np.ma.masked_all((tiles.npixels, y_tiles.shape[1]))
+        y_star[tiles.rows] = y_tiles
     image_out.write(y_star, subchunk)
 
 
+def render_tiles(model, image_out, config):
+    """
+    Predict the image tile by tile, handing the tiles out on demand.
+
+    The tiles are the row bands of the n_subchunks partitions of every
+    node. Each node takes the next tile from a counter shared by all nodes
+    and predicts it without any MPI communication, so nodes that draw
+    cheap, mostly masked tiles go on to the next one rather than waiting
+    for the others. image_out must write its partitions in parallel, as
+    parts placed by their rows, since they are finished in any order.
+
+    The lon/lat imputers are fitted on the first tile of each partition a
+    node predicts, and reused for its other tiles of that partition. An
+    error on any node aborts all of them, as the others would otherwise
+    wait for it forever.
+    """
+    ntiles = config.n_subchunks * mpiops.chunks
+    counter = mpiops.SharedCounter()
+    tile_config = copy.copy(config)
+    tile_config.n_subchunks = ntiles
+    nodes = mpiops.chunks
+    imputers = {}
+
+    def tiles():
+        tile = counter.next()
+        while tile < ntiles:
+            yield tile
+            tile = counter.next()
+
+    try:
+        with mpiops.local():
+            for tile, partition in read_partitions(tile_config, tiles()):
+                log.info("starting to render tile {} of {}".format(
+                    tile + 1, ntiles))
+                # the tiles of a partition share its imputers
+                partition['imputers'] = imputers.setdefault(
+                    tile // nodes, _lon_lat_imputers())
+                render_partition(model, tile, image_out, tile_config,
+                                 partition)
+    except Exception:
+        mpiops.abort("Rendering tiles failed, aborting all nodes")
+    counter.free()
+
+
 def cluster_analysis(x, y, partition_no, config, feature_names):
     """
     Parameters
@@ -22,6 +22,7 @@ import uncoverml.features
 import uncoverml.geoio
 import uncoverml.learn
 import uncoverml.mllog
+import uncoverml.modelcache
 import uncoverml.mpiops
 import uncoverml.predict
 import uncoverml.validate
@@ -56,7 +57,12 @@ def run_crossval(x_all, targets_all, config):
               help='divide each node\'s data into this many partitions')
 def learn(pipeline_file, partitions):
     config = ls.config.Config(pipeline_file)
+    ls.geoio.dataset_pool.maxsize = config.dataset_pool_size
+    ls.modelcache.model_cache.max_gb = config.model_cache_gb
+    # targets are intersected on the node owning their row band
+    config.block_rows, _ = ls.geoio.block_alignment(config)
     targets_all, x_all = _load_data(config, partitions)
+    ls.geoio.close_datasets()
 
     if config.cross_validate:
         run_crossval(x_all, targets_all, config)
@@ -86,17 +92,31 @@ def _load_data(config, partitions):
                      "dividing all data between nodes")
 
         # Make the targets
+        cached = None
         if config.train_data_pk and exists(config.train_data_pk):
             log.info('Reusing pickled training data')
             image_chunk_sets, transform_sets, targets = \
                 pickle.load(open(config.train_data_pk, 'rb'))
         else:
-            log.info('Intersecting targets as pickled train data was not '
-                     'available')
-            targets = ls.geoio.load_targets(shapefile=config.target_file,
-                                            targetfield=config.target_property)
-            # Get the image chunks and their associated transforms
-            image_chunk_sets = ls.geoio.image_feature_sets(targets, config)
+            if config.intersection_cache:
+                cached = ls.geoio.load_intersection(config)
+            if cached is not None:
+                log.info('Reusing cached intersection of the targets '
+                         'and covariates')
+                image_chunk_sets, targets = cached
+            else:
+                log.info('Intersecting targets as pickled train data was not '
+                         'available')
+                targets = ls.geoio.load_targets(
+                    shapefile=config.target_file,
+                    targetfield=config.target_property,
+                    coordinates=config.target_coordinates)
+                # Get the image chunks
+                image_chunk_sets = ls.geoio.image_feature_sets(targets,
+                                                               config)
+                if config.intersection_cache:
+                    ls.geoio.save_intersection(image_chunk_sets, targets,
+                                               config)
             transform_sets = [k.transform_set for k in config.feature_sets]
 
         if config.rawcovariates:
@@ -145,6 +165,8 @@ def _load_data(config, partitions):
               help='only use this fraction of the data for learning classes')
 def cluster(pipeline_file, subsample_fraction):
     config = ls.config.Config(pipeline_file)
+    ls.geoio.dataset_pool.maxsize = config.dataset_pool_size
+    config.block_rows, _ = ls.geoio.block_alignment(config)
 
     for f in config.feature_sets:
         if not f.transform_set.global_transforms:
@@ -165,6 +187,7 @@ def cluster(pipeline_file, subsample_fraction):
         semisupervised(config)
     else:
         unsupervised(config)
+    ls.geoio.close_datasets()
     log.info("Finished! Total mem = {:.1f} GB".format(_total_gb()))
 
 
@@ -247,6 +270,9 @@ def predict(model_or_cluster_file, partitions, mask, retain):
                  "through data".format(config.n_subchunks))
     else:
         log.info("Using memory aggressively: dividing all data between nodes")
+    ls.geoio.dataset_pool.maxsize = config.dataset_pool_size
+    ls.modelcache.model_cache.max_gb = config.model_cache_gb
+    config.block_rows, block_offset = ls.geoio.block_alignment(config)
 
     image_shape, image_bbox, image_crs = ls.geoio.get_image_spec(model, config)
 
@@ -261,14 +287,28 @@ def predict(model_or_cluster_file, partitions, mask, retain):
                                      band_tags=predict_tags[
                                                0: min(len(predict_tags),
                                                       config.outbands)],
+                                     block_rows=config.block_rows,
+                                     block_offset=block_offset,
+                                     parallel=config.parallel_write,
+                                     cog=config.cog,
+                                     overviews=config.overviews,
+                                     thumbnails=config.thumbnails,
+                                     write_behind=config.write_behind,
                                      **config.geotif_options)
 
-    for i in range(config.n_subchunks):
-        log.info("starting to render partition {}".format(i+1))
-        ls.predict.render_partition(model, i, image_out, config)
+    # the cluster analysis is written partition by partition from node 0
+    if config.schedule == 'dynamic' and not (config.cluster and
+                                             config.cluster_analysis):
+        ls.predict.render_tiles(model, image_out, config)
+    else:
+        for i, partition in ls.predict.read_partitions(config):
+            log.info("starting to render partition {}".format(i+1))
+            ls.predict.render_partition(model, i, image_out, config,
+                                        partition)
 
     # explicitly close output rasters
     image_out.close()
+    ls.geoio.close_datasets()
 
     if config.cluster and config.cluster_analysis:
         if ls.mpiops.chunk_index == 0:
@@ -283,6 +323,21 @@ def predict(model_or_cluster_file, partitions, mask, retain):
     log.info("Finished! Total mem = {:.1f} GB".format(_total_gb()))
 
 
+@cli.command('build-cube')
+@click.argument('pipeline_file')
+@click.option('-o', '--outdir', type=str, default=None,
+              help='cube directory, if not set by io: cube in the config')
+def build_cube(pipeline_file, outdir):
+    config = ls.config.Config(pipeline_file)
+    cube_dir = outdir or config.cube_dir
+    if cube_dir is None:
+        raise click.UsageError('Set io: cube in the config or pass --outdir')
+    ls.geoio.dataset_pool.maxsize = config.dataset_pool_size
+    ls.geoio.build_cube(config, cube_dir)
+    log.info("Finished! Set io: cube: {} to read from the cube".format(
+        cube_dir))
+
+
 def _total_gb():
     # given in KB so convert
     my_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024**2)
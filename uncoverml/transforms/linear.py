@@ -2,6 +2,12 @@
 import numpy as np
 
 from uncoverml import mpiops
+from uncoverml.featureblock import dense
+
+
+def _float(x):
+    """A floating point copy of x, keeping its precision if it has one"""
+    return x.astype(x.dtype if x.dtype.kind == 'f' else float)
 
 
 class CentreTransform:
@@ -9,10 +15,11 @@ class CentreTransform:
         self.mean = None
 
     def __call__(self, x):
-        x = x.astype(float)
+        x = _float(x)
         if self.mean is None:
             self.mean = mpiops.mean(x)
-        x -= self.mean
+        # masked values are undefined, so work on the data directly
+        np.ma.getdata(x)[...] -= self.mean
         return x
 
 
@@ -22,13 +29,13 @@ class StandardiseTransform:
         self.sd = None
 
     def __call__(self, x):
-        x = x.astype(float)
+        x = _float(x)
         if self.sd is None or self.mean is None:
             self.mean = mpiops.mean(x)
             self.sd = mpiops.sd(x)
 
         # Centre
-        x -= self.mean
+        np.ma.getdata(x)[...] -= self.mean
 
         # remove dimensions with no st. dev. (and hence no info)
         zero_mask = self.sd == 0.
@@ -37,7 +44,7 @@ class StandardiseTransform:
             sd = self.sd[~zero_mask]
         else:
             sd = self.sd
-        x /= sd
+        np.ma.getdata(x)[...] /= sd
         return x
 
 
@@ -48,7 +55,7 @@ class PositiveTransform:
         self.stabilizer = stabilizer
 
     def __call__(self, func, x):
-        x = x.astype(float)
+        x = _float(x)
         if self.min is None:
             self.min = mpiops.minimum(x)
 
@@ -86,7 +93,7 @@ class WhitenTransform:
         self.keep_fraction = keep_fraction
 
     def __call__(self, x):
-        x = x.astype(float)
+        x = _float(x)
         if self.mean is None or self.eigvals is None or self.eigvecs is None:
             self.mean = mpiops.mean(x)
             self.eigvals, self.eigvecs = mpiops.eigen_decomposition(x)
@@ -96,6 +103,12 @@ class WhitenTransform:
         keepdims = min(max(1, int(ndims * self.keep_fraction)), ndims)
         mat = self.eigvecs[:, -keepdims:]
         vec = self.eigvals[np.newaxis, -keepdims:]
-        x = np.ma.dot(x - self.mean, mat, strict=True) / np.sqrt(vec)
+        x_dense = dense(x)
+        if x_dense is not None:
+            x = np.ma.masked_array(np.dot(x_dense - self.mean, mat),
+                                   mask=False)
+        else:
+            x = np.ma.dot(x - self.mean, mat, strict=True)
+        x /= np.sqrt(vec)
 
         return x
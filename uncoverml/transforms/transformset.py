@@ -8,12 +8,25 @@ from uncoverml import mpiops
 log = logging.getLogger(__name__)
 
 
-def build_feature_vector(image_chunks, is_categorical):
-    dtype = int if is_categorical else float
-    for k, im in image_chunks.items():
-        image_chunks[k] = im.reshape(im.shape[0], -1).astype(dtype)
-    x_data = np.concatenate([a.data for a in image_chunks.values()], axis=1)
-    x_mask = np.concatenate([a.mask for a in image_chunks.values()], axis=1)
+def build_feature_vector(image_chunks, is_categorical, dtype=None):
+    images = [im.reshape(im.shape[0], -1) for im in image_chunks.values()]
+    # categorical features stay integer, ordinal ones are in the configured
+    # precision, or the type of the images if none is given
+    if is_categorical:
+        dtype = int
+    elif dtype is None:
+        dtype = np.result_type(*images)
+    # fill one preallocated block, casting as we go
+    n_rows = images[0].shape[0]
+    n_cols = sum(im.shape[1] for im in images)
+    x_data = np.empty((n_rows, n_cols), dtype=dtype)
+    x_mask = np.empty((n_rows, n_cols), dtype=bool)
+    start = 0
+    for im in images:
+        stop = start + im.shape[1]
+        x_data[:, start:stop] = np.ma.getdata(im)
+        x_mask[:, start:stop] = np.ma.getmaskarray(im)
+        start = stop
     x = np.ma.masked_array(data=x_data, mask=x_mask)
     return x
 
@@ -47,10 +60,11 @@ class TransformSet:
 
 class ImageTransformSet(TransformSet):
     def __init__(self, image_transforms=None, imputer=None,
-                 global_transforms=None, is_categorical=False):
+                 global_transforms=None, is_categorical=False, dtype=float):
         self.image_transforms = (image_transforms if image_transforms
                                  else [])
         self.is_categorical = is_categorical
+        self.dtype = dtype
         super().__init__(imputer, global_transforms)
 
     def __call__(self, image_chunks):
@@ -61,6 +75,7 @@ class ImageTransformSet(TransformSet):
                 transformed_chunks[lbl] = t[i](transformed_chunks[lbl])
 
         # concatenate and floating point
-        x = build_feature_vector(transformed_chunks, self.is_categorical)
+        x = build_feature_vector(transformed_chunks, self.is_categorical,
+                                 getattr(self, 'dtype', float))
         x = super().__call__(x)
         return x